@@ -6,21 +6,31 @@ Run this in commandline:
 blender --python annotate.py -- shapenet_model_number annotate object
 
 
-Need to install pandas first
-----------------------------
-cd /path/to/blender/python
-rm -rf ./lib/python3.7/site-packages/numpy
-./python -m ensurepip
-./python -m pip install pandas
+Annotations are kept with annotation_store.py (next to this file), which
+only needs the numpy that ships with Blender.
 '''
 
 import os
 import sys
 import argparse
-import socket
 import time
-import pandas as pd
+import traceback
+from collections import OrderedDict
+import numpy as np
 import bpy
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import annotation_store
+import vertex_match
+import instrumentation
+import blender_mesh
+import model_index
+
+WORKER_DONE = "WORKER_DONE"
+# Import with bpy.ops.import_scene.obj instead of blender_mesh (--ops_import)
+OPS_IMPORT = False
+# ShapeNet category folder (--dataset_dir), used instead of the model index when set
+DATASET_DIR = None
 
 test_items = [
     ("front_right", "Front Right Door", "", 1),
@@ -33,7 +43,15 @@ test_items = [
 
 def import_file(file_name, separate_objects):
     print("Running import_file(file_name={}, separate_objects={})".format(file_name, separate_objects))
-    bpy.ops.import_scene.obj(filepath=file_name, use_split_groups=separate_objects, use_split_objects=separate_objects)
+    with instrumentation.span("import", separate_objects=separate_objects) as counts:
+        if OPS_IMPORT:
+            bpy.ops.import_scene.obj(filepath=file_name, use_split_groups=separate_objects, use_split_objects=separate_objects)
+        else:
+            blender_mesh.import_obj(file_name, separate_objects)
+        meshes = [obj.data for obj in bpy.context.scene.objects if obj.type == 'MESH']
+        counts['objects'] = len(meshes)
+        counts['vertices'] = sum(len(m.vertices) for m in meshes)
+        counts['faces'] = sum(len(m.polygons) for m in meshes)
 
     # Rename to "car body" if importing as one object
     if separate_objects == False:
@@ -47,11 +65,18 @@ def import_file(file_name, separate_objects):
 
 def clear_world():
     print("Running clear_world")
-    # Delete all objects and meshes
-    for obj in bpy.data.objects:
+    # Delete all objects and meshes, and the materials and images they used so
+    # memory stays flat when one Blender session goes through many models
+    for obj in list(bpy.data.objects):
         bpy.data.objects.remove(obj, do_unlink=True)
-    for mes in bpy.data.meshes:
+    for mes in list(bpy.data.meshes):
         bpy.data.meshes.remove(mes, do_unlink=True)
+    for mat in list(bpy.data.materials):
+        bpy.data.materials.remove(mat, do_unlink=True)
+    for tex in list(bpy.data.textures):
+        bpy.data.textures.remove(tex, do_unlink=True)
+    for img in list(bpy.data.images):
+        bpy.data.images.remove(img, do_unlink=True)
 
 
 def set_mode_for_selecting(object_mode):
@@ -68,34 +93,22 @@ def set_mode_for_selecting(object_mode):
 
 def save_selected_objects_to_csv(part_type, save_path):
     print("Running save_selected_objects_to_csv")
-    vert_dicts = []
-    for obj in bpy.context.selected_objects:
-        vert_dicts.append({
-            'part_type': part_type,
-            'object_name': obj.name,
-        })
-    print(vert_dicts)
-    df = pd.DataFrame(vert_dicts)
-    if os.path.isfile(save_path):
-        df = pd.concat([pd.read_csv(save_path), df])
-    df = df.drop_duplicates()
-    df = df.sort_values(["part_type", "object_name"])
-    df.to_csv(save_path, index=False)
+    object_names = [obj.name for obj in bpy.context.selected_objects]
+    print(object_names)
+    annotation_store.open_store(save_path).add(part_type, object_names)
 
 
 def remove_selected_objects_from_csv(part_type, save_path):
     print("Running remove_selected_objects_from_csv")
-    df = pd.read_csv(save_path)
-    df = df[~((df['part_type'] == part_type) & (df['object_name'].isin([obj.name for obj in bpy.context.selected_objects])))]
-    df.to_csv(save_path, index=False)
+    object_names = [obj.name for obj in bpy.context.selected_objects]
+    annotation_store.open_store(save_path).remove(part_type, object_names)
 
 
 def toggle_hide_objects_from_csv(part_type, save_path):
     print("Running toggle_hide_objects_from_csv")
-    if not os.path.isfile(save_path):
+    if not annotation_store.exists(save_path):
         return
-    df = pd.read_csv(save_path)
-    object_names = list(df[df['part_type'] == part_type]['object_name'].values)
+    object_names = annotation_store.open_store(save_path).get(part_type)
     to_hide = False
     for object_name in object_names:
         if bpy.data.objects[object_name].hide == False:
@@ -105,174 +118,197 @@ def toggle_hide_objects_from_csv(part_type, save_path):
         bpy.data.objects[object_name].select = True
 
 
+@instrumentation.timed("export_objects")
 def save_parts_to_obj_files(save_location, object_annotation_csv):
     print("Running save_parts_to_obj_files")
-    if not os.path.isfile(object_annotation_csv):
+    if not annotation_store.exists(object_annotation_csv):
         return
-    df = pd.read_csv(object_annotation_csv)
-    part_types = list(df['part_type'].unique())
-    for part_type in part_types:
-        bpy.ops.object.select_all(action='DESELECT')
-        object_names = list(df[df['part_type'] == part_type]['object_name'].values)
-        for object_name in object_names:
-            bpy.data.objects[object_name].select = True
-        if part_type == "to_delete":
-            bpy.ops.object.delete()
-            continue
-        file_name = save_location.replace("part_type", part_type)
-        bpy.ops.export_scene.obj(filepath=file_name, use_selection=True, check_existing=False)
-        bpy.ops.object.delete()
-    file_name = save_location.replace("part_type", "car_body")
-    bpy.ops.export_scene.obj(filepath=file_name)
+    store = annotation_store.open_store(object_annotation_csv)
+    for part_type in store.part_types():
+        objects = [bpy.data.objects[object_name] for object_name in store.get(part_type)]
+        if part_type != "to_delete":
+            blender_mesh.export_obj(save_location.replace("part_type", part_type), objects)
+        for obj in objects:
+            bpy.data.objects.remove(obj, do_unlink=True)
+    blender_mesh.export_obj(save_location.replace("part_type", "car_body"), list(bpy.context.scene.objects))
 
 
 def get_selected_vertices():
+    ''' Indices of the selected vertices of the active object, as an int array '''
     print("Running get_selected_vertices")
     current_mode = bpy.context.active_object.mode
+    # Leaving edit mode writes the selection back to the mesh
     bpy.ops.object.mode_set(mode='OBJECT')
-    selected_verts = [v for v in bpy.context.active_object.data.vertices if v.select]
+    selected_verts = np.flatnonzero(get_flags(bpy.context.active_object.data.vertices, "select"))
     bpy.ops.object.mode_set(mode=current_mode)
     print("Found {} selected vertices on 'model_normalized'".format(len(selected_verts)))
     return selected_verts
 
 
+def get_flags(items, name):
+    ''' Boolean array of a flag (select, hide) of all vertices, edges or polygons '''
+    flags = np.empty(len(items), bool)
+    items.foreach_get(name, flags)
+    return flags
+
+
+def mesh_topology(mesh):
+    ''' Vertex pairs of the edges and, per loop, its vertex, edge and polygon '''
+    edges = np.empty(len(mesh.edges) * 2, np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    loop_vertices = np.empty(len(mesh.loops), np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    loop_edges = np.empty(len(mesh.loops), np.int32)
+    mesh.loops.foreach_get("edge_index", loop_edges)
+    loop_totals = np.empty(len(mesh.polygons), np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    loop_starts = np.empty(len(mesh.polygons), np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    # The loops of the polygons are back to back, in order of loop_start
+    order = np.argsort(loop_starts)
+    loop_polygons = np.repeat(order, loop_totals[order])
+    return edges.reshape(-1, 2), loop_vertices, loop_edges, loop_polygons
+
+
+def set_vertex_flags(mesh, name, vertex_mask):
+    '''
+    Sets a flag (select, hide) on the vertices of the mask and on the edges
+    and polygons made only of them, and clears it everywhere else
+    '''
+    edges, loop_vertices, _, loop_polygons = mesh_topology(mesh)
+    outside = np.bincount(loop_polygons, weights=~vertex_mask[loop_vertices], minlength=len(mesh.polygons))
+    mesh.vertices.foreach_set(name, vertex_mask)
+    mesh.edges.foreach_set(name, vertex_mask[edges].all(axis=1))
+    mesh.polygons.foreach_set(name, outside == 0)
+
+
 def select_vertices_from_list(list_of_verts):
     print("Running select_vertices_from_list")
     bpy.ops.object.mode_set(mode="OBJECT")
     obj = bpy.context.active_object
+    selected = np.zeros(len(obj.data.vertices), bool)
+    list_of_verts = np.asarray(list_of_verts, np.int64)
+    selected[list_of_verts[list_of_verts < len(selected)]] = True
+    set_vertex_flags(obj.data, "select", selected)
     bpy.ops.object.mode_set(mode="EDIT")
     bpy.ops.mesh.select_mode(type="VERT")
 
-    # bpy.ops.mesh.select_mode(type='FACE')
-    bpy.ops.mesh.select_all(action="DESELECT")
-    bpy.ops.object.mode_set(mode="OBJECT")
-    for vert in list_of_verts:
-        obj.data.vertices[vert].select = True
-    bpy.ops.object.mode_set(mode="EDIT")
-
 
-def hide_selected_vertices():
-    print("Running hide_selected_vertices")
+def hide_vertices_from_list(list_of_verts):
+    '''
+    Hides the faces made only of the listed vertices (on top of what is
+    hidden already), and the vertices and edges no visible face uses,
+    like selecting them and hiding the selected faces
+    '''
+    print("Running hide_vertices_from_list")
     current_mode = bpy.context.active_object.mode
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type='FACE')
-    bpy.ops.mesh.hide(unselected=False)
+    bpy.ops.object.mode_set(mode="OBJECT")
+    mesh = bpy.context.active_object.data
+    listed = np.zeros(len(mesh.vertices), bool)
+    list_of_verts = np.asarray(list_of_verts, np.int64)
+    listed[list_of_verts[list_of_verts < len(listed)]] = True
+
+    edges, loop_vertices, loop_edges, loop_polygons = mesh_topology(mesh)
+    outside = np.bincount(loop_polygons, weights=~listed[loop_vertices], minlength=len(mesh.polygons))
+    hidden_polygons = get_flags(mesh.polygons, "hide") | (outside == 0)
+    visible_loops = ~hidden_polygons[loop_polygons]
+    vertex_in_view = np.bincount(loop_vertices[visible_loops], minlength=len(mesh.vertices)) > 0
+    edge_in_view = np.bincount(loop_edges[visible_loops], minlength=len(mesh.edges)) > 0
+    hidden_vertices = get_flags(mesh.vertices, "hide") | (listed & ~vertex_in_view)
+    hidden_edges = get_flags(mesh.edges, "hide") | (listed[edges].all(axis=1) & ~edge_in_view)
+    mesh.polygons.foreach_set("hide", hidden_polygons)
+    mesh.edges.foreach_set("hide", hidden_edges)
+    mesh.vertices.foreach_set("hide", hidden_vertices)
+    # Hidden elements can't stay selected
+    mesh.polygons.foreach_set("select", get_flags(mesh.polygons, "select") & ~hidden_polygons)
+    mesh.edges.foreach_set("select", get_flags(mesh.edges, "select") & ~hidden_edges)
+    mesh.vertices.foreach_set("select", get_flags(mesh.vertices, "select") & ~hidden_vertices)
     bpy.ops.object.mode_set(mode=current_mode)
 
 
 def save_selected_vertices(verts, part_type, save_path):
     print("Running save_selected_vertices")
-    vert_dicts = []
-    for vert in verts:
-        print(vert)
-        vert_dicts.append({
-            'part_type': part_type,
-            'vert_index': vert.index,
-        })
-    df = pd.DataFrame(vert_dicts)
-    if os.path.isfile(save_path):
-        df = pd.concat([pd.read_csv(save_path), df])
-    df = df.drop_duplicates()
-    df = df.sort_values(["part_type", "vert_index"])
-    df.to_csv(save_path, index=False)
+    annotation_store.open_store(save_path).add(part_type, verts)
 
 
 def save_vertices_to_obj_files(save_location, vert_csv_path, coords={}):
-    if not os.path.isfile(vert_csv_path):
+    if not annotation_store.exists(vert_csv_path):
         return
     part_types = [x[0] for x in test_items]
-    # Save to vertex groups
-    for part_type in part_types:
-        print("Saving {} to a vertex group".format(part_type))
-        # Check for coordinates (happens when objects already removed)
-        if part_type in coords:
-            bpy.ops.object.mode_set(mode="OBJECT")
-            bpy.ops.object.select_all(action='SELECT')
-            for vert in bpy.context.active_object.data.vertices:
-                coord_tup = (
-                    vert.co.x,
-                    vert.co.y,
-                    vert.co.z,
-                    vert.normal.x,
-                    vert.normal.y,
-                    vert.normal.z,
-                )
-                if coord_tup in coords[part_type]:
-                    verts.append(vert.index)
-        else:
-            verts = get_verts_from_csv(part_type, vert_csv_path)
-            print("Found these verts in csv for {}: {}".format(part_type, verts))
-        if len(verts) == 0:
-            continue
-        vg = bpy.context.active_object.vertex_groups.new(name=part_type)
+    with instrumentation.span("part_masks") as counts:
+        counts['vertices'] = 0
         bpy.ops.object.mode_set(mode="OBJECT")
-        vg.add(verts, 1.0, 'ADD')
-        bpy.ops.object.mode_set(mode="EDIT")
-
-    # Separate meshes
-    for part_type in part_types:
-        print("Saving {} as its own object".format(part_type))
-        if part_type not in [v.name for v in bpy.context.object.vertex_groups]:
-            continue
-        bpy.ops.object.vertex_group_set_active(group=part_type)
-        bpy.ops.mesh.select_all(action='DESELECT')
-        bpy.ops.object.vertex_group_select()
-        names = [obj.name for obj in bpy.context.scene.objects]
-        bpy.ops.mesh.separate(type='SELECTED')
-        new_objs = [obj for obj in bpy.context.scene.objects if obj.name not in names]
-        new_objs[0].name = part_type
+        obj = bpy.context.active_object
+        if coords:
+            # Objects were already removed, find the vertices again by location
+            rows = get_vertex_rows(obj)
+        part_masks = OrderedDict()
+        for part_type in part_types:
+            print("Finding the vertices of {}".format(part_type))
+            if part_type in coords:
+                in_part = vertex_match.rows_in(rows, coords[part_type])
+            else:
+                in_part = np.zeros(len(obj.data.vertices), bool)
+                ids = get_verts_from_csv(part_type, vert_csv_path)
+                in_part[ids[ids < len(in_part)]] = True
+            if not in_part.any():
+                continue
+            part_masks[part_type] = in_part
+            counts['vertices'] += int(in_part.sum())
+
+    # Separate meshes, all parts in one pass
+    with instrumentation.span("separate") as counts:
+        parts = blender_mesh.separate_parts(obj, part_masks)
+        counts['parts'] = len(parts)
 
     # Save meshes to obj files
-    set_mode_for_selecting(False)
-    for item in bpy.context.selectable_objects:
-        item.select = False
-    for ob in bpy.context.scene.objects:
-        bpy.context.scene.objects.active = ob
-        print("Saving {} as an obj file".format(ob.name))
-        ob.select = True
-        if ob.type != 'MESH':
-            continue
-        file_name = save_location.replace("part_type", ob.name)
-        bpy.ops.export_scene.obj(filepath=file_name, use_selection=True, check_existing=False)
-        ob.select = False
-        bpy.data.objects.remove(bpy.data.objects[ob.name], True)
+    with instrumentation.span("export") as counts:
+        written = []
+        for ob in list(bpy.context.scene.objects):
+            if ob.type != 'MESH':
+                continue
+            print("Saving {} as an obj file".format(ob.name))
+            written += blender_mesh.export_obj(save_location.replace("part_type", ob.name), [ob])
+            bpy.data.objects.remove(ob, do_unlink=True)
+        counts['files'] = len(written) // 2
+        counts['bytes_written'] = instrumentation.file_bytes(written)
 
 
 def remove_selected_vertices(verts, part_type, save_path):
     print("Running remove_selected_vertices")
-    if not os.path.isfile(save_path):
+    if not annotation_store.exists(save_path):
         return
-    df = pd.read_csv(save_path)
-    df = df[~((df['part_type'] == part_type) & (df['vert_index'].isin([v.index for v in verts])))]
-    df.to_csv(save_path, index=False)
+    annotation_store.open_store(save_path).remove(part_type, verts)
 
 
 def get_verts_from_csv(part_type, save_path):
     print("Running get_verts_from_csv")
-    df = pd.read_csv(save_path)
-    verts = [int(x) for x in df[df['part_type'] == part_type]['vert_index'].values]
+    verts = annotation_store.open_store(save_path).get(part_type)
     print("Found {} {} vertices in {}".format(len(verts), part_type, save_path))
     return verts
 
 
+def get_vertex_rows(obj):
+    ''' (N, 6) array of the x, y, z, nx, ny, nz of every vertex of obj '''
+    vertices = obj.data.vertices
+    rows = np.empty((len(vertices), 6), np.float32)
+    co = np.empty(len(vertices) * 3, np.float32)
+    vertices.foreach_get("co", co)
+    rows[:, :3] = co.reshape(-1, 3)
+    vertices.foreach_get("normal", co)
+    rows[:, 3:] = co.reshape(-1, 3)
+    return rows
+
+
 def get_vertex_coordinates(vertex_csv):
     print("Running get_vertex_coordinates")
-    df = pd.read_csv(vertex_csv)
+    store = annotation_store.open_store(vertex_csv)
     bpy.ops.object.mode_set(mode='OBJECT')
+    rows = get_vertex_rows(bpy.context.active_object)
     coords = {}
-    for part_type in df['part_type'].unique():
-        coords[part_type] = []
-        vert_indices = [int(x) for x in df[df['part_type'] == part_type]['vert_index'].values]
-        for vert in bpy.context.active_object.data.vertices:
-            if vert.index in vert_indices:
-                coords[part_type].append((
-                    vert.co.x,
-                    vert.co.y,
-                    vert.co.z,
-                    vert.normal.x,
-                    vert.normal.y,
-                    vert.normal.z,
-                ))
+    for part_type in store.part_types():
+        vert_indices = store.get(part_type)
+        coords[part_type] = rows[vert_indices[vert_indices < len(rows)]]
     return coords
 
 
@@ -353,8 +389,7 @@ class HideVerticesFromCSV(bpy.types.Operator):
     bl_options = {"UNDO"}
     def invoke(self, context, event):
         verts = get_verts_from_csv(context.scene.part_type, context.scene.annot_loc)
-        select_vertices_from_list(verts)
-        hide_selected_vertices()
+        hide_vertices_from_list(verts)
         return {"FINISHED"}
 
 class UnhideAll(bpy.types.Operator):
@@ -391,17 +426,19 @@ def register(annot_file, annot_object_file):
     bpy.types.Scene.annot_object_loc = bpy.props.StringProperty(name="Annot object loc", default=annot_object_file)
 
 def get_file_locations(model):
-    host = socket.gethostname()
-    if host == 'Michaels-MacBook-Pro.local':
-        model_file = '/Users/mpeven/Downloads/02958343/{}/models/model_normalized.obj'.format(model)
-        vert_annot_file = '/Users/mpeven/Projects/DIVA/car_models/annotations/{}.csv'.format(model)
-        object_annot_file = vert_annot_file.replace('.csv', '_objects.csv')
-    elif host == 'titan':
-        model_file = '/home/mike/Projects/DIVA/car_models/02958343/{}/models/model_normalized.obj'.format(model)
-        vert_annot_file = '/home/mike/Projects/DIVA/car_models/annotations/{}.csv'.format(model)
-        object_annot_file = vert_annot_file.replace('.csv', '_objects.csv')
+    # --dataset_dir or SHAPENET_CAR_DIR, otherwise the model index (python mesh_tools/model_index.py builds it),
+    # which needs a Blender python with sqlite3
+    dataset_dir = DATASET_DIR or os.environ.get("SHAPENET_CAR_DIR")
+    index = model_index.ModelIndex() if model_index.sqlite3 is not None else None
+    if dataset_dir is not None:
+        model_file = os.path.join(dataset_dir, model, model_index.MODEL_FILE)
+    elif index is not None:
+        model_file = index.model_file(model)
     else:
-        raise ValueError("Unrecognized host: {}".format(host))
+        raise ValueError("No sqlite3 for the model index, pass --dataset_dir or set SHAPENET_CAR_DIR")
+    annotations_dir = index.get_annotations_dir() if index is not None else model_index.DEFAULT_ANNOTATIONS_DIR
+    vert_annot_file = os.path.join(annotations_dir, '{}.csv'.format(model))
+    object_annot_file = vert_annot_file.replace('.csv', '_objects.csv')
 
     return model_file, vert_annot_file, object_annot_file
 
@@ -416,31 +453,86 @@ def main(model_name, annotate_mode, object_mode, save_folder):
         set_mode_for_selecting(object_mode)
         register(vert_annot_file, object_annot_file)
     else:
-        save_location = "{}/{}_part_type.obj".format(save_folder, model_name)
-        if os.path.isfile(object_annot_file) and not os.path.isfile(vert_annot_file):
-            import_file(model_file, separate_objects=True)
-            save_parts_to_obj_files(save_location, object_annot_file)
-        elif os.path.isfile(vert_annot_file) and not os.path.isfile(object_annot_file):
-            import_file(model_file, separate_objects=False)
-            save_vertices_to_obj_files(save_location, vert_annot_file)
-        elif os.path.isfile(object_annot_file) and os.path.isfile(vert_annot_file):
-            # If both:
-            # 1 - Get locations of vertices from vert_annot_file.
-            # 2 - Remove parts to own obj files from object_annot_file.
-            # 3 - Load up the rest of the model without objects.
-            # 4 - Select the verteces based on location.
-            # 5 - Remove to their own file.
-            import_file(model_file, separate_objects=False)
-            coords = get_vertex_coordinates(vert_annot_file)
-            clear_world()
-            import_file(model_file, separate_objects=True)
-            save_parts_to_obj_files(save_location, object_annot_file)
-            car_body_file = vert_annot_file.replace(".csv", "/car_body.obj")
-            clear_world()
-            import_file(car_body_file, separate_objects=False)
-            save_vertices_to_obj_files(save_location, vert_annot_file, coords)
-        else:
-            print("No annotations for {}, can't do anything".format(model_name))
+        with instrumentation.context(model=model_name), instrumentation.span("save_out"):
+            save_out_model(model_file, vert_annot_file, object_annot_file, model_name, save_folder)
+
+def save_out_model(model_file, vert_annot_file, object_annot_file, model_name, save_folder):
+    save_location = "{}/{}_part_type.obj".format(save_folder, model_name)
+    has_objects = annotation_store.exists(object_annot_file)
+    has_vertices = annotation_store.exists(vert_annot_file)
+    if has_objects and not has_vertices:
+        import_file(model_file, separate_objects=True)
+        save_parts_to_obj_files(save_location, object_annot_file)
+    elif has_vertices and not has_objects:
+        import_file(model_file, separate_objects=False)
+        save_vertices_to_obj_files(save_location, vert_annot_file)
+    elif has_objects and has_vertices:
+        # If both:
+        # 1 - Get locations of vertices from vert_annot_file.
+        # 2 - Remove parts to own obj files from object_annot_file.
+        # 3 - Load up the rest of the model without objects.
+        # 4 - Select the verteces based on location.
+        # 5 - Remove to their own file.
+        import_file(model_file, separate_objects=False)
+        coords = get_vertex_coordinates(vert_annot_file)
+        clear_world()
+        import_file(model_file, separate_objects=True)
+        save_parts_to_obj_files(save_location, object_annot_file)
+        car_body_file = vert_annot_file.replace(".csv", "/car_body.obj")
+        clear_world()
+        import_file(car_body_file, separate_objects=False)
+        save_vertices_to_obj_files(save_location, vert_annot_file, coords)
+    else:
+        print("No annotations for {}, can't do anything".format(model_name))
+
+def save_out(model_name, save_folder):
+    '''
+    Saves out the objs of one model and clears the scene after it, whether
+    that worked or not. Returns "ok" or "failed <error>".
+    '''
+    start = time.time()
+    try:
+        main(model_name, annotate_mode=False, object_mode=False, save_folder=save_folder)
+        status = "ok"
+    except Exception as e:
+        traceback.print_exc()
+        status = "failed {!r}".format(e)
+    clear_world()
+    print("Saved out {} in {:.1f}s: {}".format(model_name, time.time() - start, status), flush=True)
+    return status
+
+def serve(save_folder):
+    '''
+    Worker mode used by save_annotations_to_obj_files: stays up and exports
+    one model per line of stdin until stdin is closed. Each model is answered
+    with a "WORKER_DONE <model> <status>" line on stdout.
+    '''
+    for line in sys.stdin:
+        model_name = line.strip()
+        if not model_name:
+            continue
+        status = save_out(model_name, save_folder)
+        print("{} {} {}".format(WORKER_DONE, model_name, status), flush=True)
+
+def batch(model_names, save_folder):
+    '''
+    Saves out several models one after the other in this Blender session,
+    going on past the ones that fail. Returns the failed models.
+    '''
+    start = time.time()
+    failed = []
+    for i, model_name in enumerate(model_names):
+        print("Model {}/{}: {}".format(i + 1, len(model_names), model_name))
+        if save_out(model_name, save_folder) != "ok":
+            failed.append(model_name)
+    print("Saved out {} models in {:.1f}s, {} failed{}".format(
+        len(model_names), time.time() - start, len(failed), ": " + " ".join(failed) if failed else ""))
+    return failed
+
+def read_queue(queue_file):
+    ''' Model ids of a queue file, one per line (blank lines and # comments are skipped) '''
+    with open(queue_file, 'r') as f:
+        return [l.split('#')[0].strip() for l in f if l.split('#')[0].strip()]
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -455,11 +547,33 @@ def str2bool(v):
 if __name__ == '__main__':
     argv = sys.argv[sys.argv.index("--") + 1:]
     parser = argparse.ArgumentParser(description='Annotate ShapeNet models with Blender.')
-    parser.add_argument('-m', '--shapenet_model_id', type=str, help='Name of the shapenet model')
+    parser.add_argument('-m', '--shapenet_model_id', type=str, nargs='+', default=[],
+        help='Name of the shapenet model (several are saved out one after the other, needs -a N)')
+    parser.add_argument('-q', '--queue', type=str,
+        help='File with the shapenet models to save out, one per line (needs -a N)')
     parser.add_argument('-o', '--object_mode', type=str2bool, nargs='?', const=True, default=True,
         help='Whether to load obj file with objects intact (alternative is model of only vertices)')
     parser.add_argument('-a', '--annotate_mode', type=str2bool, nargs='?', const=True, default=True,
         help='Loads up blender ready for annotations, rather than just saving out objs from annotations')
     parser.add_argument('-s', '--save_folder', type=str, help='Name of the folder to save the objs', default="car_models_hand_annotated")
+    parser.add_argument('-w', '--worker', action='store_true',
+        help='Read model ids from stdin and save out their objs until stdin is closed')
+    parser.add_argument('--ops_import', action='store_true',
+        help="Import models with Blender's obj importer instead of the numpy loader")
+    parser.add_argument('--dataset_dir', type=str,
+        help='ShapeNet category folder to load models from instead of the model index')
     args = parser.parse_args(argv)
-    main(args.shapenet_model_id, args.annotate_mode, args.object_mode, args.save_folder)
+    OPS_IMPORT = args.ops_import
+    DATASET_DIR = args.dataset_dir
+    models = args.shapenet_model_id + (read_queue(args.queue) if args.queue else [])
+    if args.worker:
+        serve(args.save_folder)
+    elif len(models) > 1 or args.queue:
+        if args.annotate_mode:
+            parser.error("Only one model at a time can be annotated, pass -a N to save several out")
+        if batch(models, args.save_folder):
+            sys.exit(1)
+    elif len(models) == 1:
+        main(models[0], args.annotate_mode, args.object_mode, args.save_folder)
+    else:
+        parser.error("No model given (-m or -q)")
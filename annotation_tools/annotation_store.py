@@ -0,0 +1,204 @@
+'''
+Annotation storage for annotate.py
+
+The csv files (part_type,vert_index and part_type,object_name) stay the format
+everything else reads, but they are no longer re-read and rewritten on every
+click. Each save or remove is appended to a log next to the csv ({csv}.log),
+which costs time proportional to the selection, and applied to the per-part
+sets kept in memory (boolean bitmaps for vertex indices). Once enough
+operations pile up, the csv is rewritten from memory on a background thread
+and the log is dropped. Whatever is still in the log when Blender quits is
+compacted at exit, and a leftover log is replayed the next time the store is
+opened, so a crash loses nothing.
+
+Run this file with csv paths to fold leftover logs into their csv files.
+'''
+
+import os
+import csv
+import sys
+import atexit
+import threading
+import numpy as np
+
+COMPACT_AFTER = 100
+
+_stores = {}
+
+
+def log_path(csv_path):
+    return csv_path + ".log"
+
+
+def exists(csv_path):
+    ''' True if there are annotations at csv_path, compacted or not '''
+    return any(os.path.isfile(p) for p in [csv_path, log_path(csv_path), log_path(csv_path) + ".compacting"])
+
+
+def open_store(csv_path):
+    ''' Returns the store of a csv file, one per file for the whole session '''
+    key = os.path.abspath(csv_path)
+    if key not in _stores:
+        _stores[key] = AnnotationStore(csv_path)
+    return _stores[key]
+
+
+@atexit.register
+def close_all():
+    for store in _stores.values():
+        store.compact(wait=True)
+
+
+class AnnotationStore(object):
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.log_path = log_path(csv_path)
+        self.key_column = 'object_name' if csv_path.endswith('_objects.csv') else 'vert_index'
+        self.is_vertices = self.key_column == 'vert_index'
+        self.parts = {}
+        self.lock = threading.Lock()
+        self.compaction = None
+        self.ops_since_compaction = 0
+        self._load()
+
+    def get(self, part_type):
+        ''' Sorted vertex indices (int array) or object names of a part '''
+        members = self.parts.get(part_type)
+        if members is None:
+            return np.zeros(0, np.int64) if self.is_vertices else []
+        if self.is_vertices:
+            return np.flatnonzero(members)
+        return sorted(members)
+
+    def part_types(self):
+        return sorted(part for part in self.parts if len(self.get(part)) > 0)
+
+    def add(self, part_type, keys):
+        self._apply_and_log('+', part_type, keys)
+
+    def remove(self, part_type, keys):
+        self._apply_and_log('-', part_type, keys)
+
+    def compact(self, wait=False):
+        '''
+        Rewrites the csv from memory on a background thread, operations made
+        in the meantime go to a fresh log
+        '''
+        with self.lock:
+            running = self.compaction is not None and self.compaction.is_alive()
+            if not running and (os.path.isfile(self.log_path) or os.path.isfile(self.log_path + ".compacting")):
+                self._rotate_log()
+                snapshot = {part: members.copy() for part, members in self.parts.items()}
+                self.compaction = threading.Thread(target=self._write_snapshot, args=(snapshot,))
+                self.compaction.start()
+                self.ops_since_compaction = 0
+            compaction = self.compaction
+        if wait and compaction is not None:
+            compaction.join()
+
+    def to_csv(self, csv_path):
+        ''' Writes the current annotations to any csv file in the usual format '''
+        with self.lock:
+            snapshot = {part: members.copy() for part, members in self.parts.items()}
+        _write_csv(csv_path, snapshot, self.key_column)
+
+    def _apply_and_log(self, op, part_type, keys):
+        keys = [str(k) for k in keys] if not self.is_vertices else np.asarray(keys, np.int64)
+        if len(keys) == 0:
+            return
+        with self.lock:
+            self._apply(op, part_type, keys)
+            with open(self.log_path, 'a') as f:
+                if self.is_vertices:
+                    f.write("{}\t{}\t{}\n".format(op, part_type, " ".join(map(str, keys.tolist()))))
+                else:
+                    f.write("{}\t{}\t{}\n".format(op, part_type, "\t".join(keys)))
+            self.ops_since_compaction += 1
+        if self.ops_since_compaction >= COMPACT_AFTER:
+            self.compact()
+
+    def _apply(self, op, part_type, keys):
+        if not self.is_vertices:
+            members = self.parts.setdefault(part_type, set())
+            if op == '+':
+                members.update(keys)
+            else:
+                members.difference_update(keys)
+            return
+        bitmap = self.parts.get(part_type, np.zeros(0, bool))
+        if op == '+':
+            if keys.max() >= len(bitmap):
+                bitmap = np.concatenate([bitmap, np.zeros(keys.max() + 1 - len(bitmap), bool)])
+            bitmap[keys] = True
+        else:
+            bitmap[keys[keys < len(bitmap)]] = False
+        self.parts[part_type] = bitmap
+
+    def _load(self):
+        if os.path.isfile(self.csv_path):
+            rows = {}
+            with open(self.csv_path, 'r', newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                key_index = header.index(self.key_column) if header else 1
+                part_index = header.index('part_type') if header else 0
+                for row in reader:
+                    rows.setdefault(row[part_index], []).append(row[key_index])
+            for part_type, keys in rows.items():
+                if self.is_vertices:
+                    keys = np.array(keys, dtype=np.int64)
+                self._apply('+', part_type, keys)
+        # Replay the operations made since the last compaction
+        for path in [self.log_path + ".compacting", self.log_path]:
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    words = line.rstrip('\n').split('\t')
+                    if len(words) < 3 or not line.endswith('\n'):
+                        # Half written line from a crash
+                        continue
+                    if self.is_vertices:
+                        keys = np.array(words[2].split(), dtype=np.int64)
+                    else:
+                        keys = words[2:]
+                    if len(keys):
+                        self._apply(words[0], words[1], keys)
+
+    def _rotate_log(self):
+        # Called with the lock held
+        compacting = self.log_path + ".compacting"
+        if not os.path.isfile(self.log_path):
+            return
+        if os.path.isfile(compacting):
+            # A compaction didn't finish last time, keep its operations too
+            with open(self.log_path, 'r') as src, open(compacting, 'a') as dst:
+                dst.write(src.read())
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, compacting)
+
+    def _write_snapshot(self, snapshot):
+        _write_csv(self.csv_path, snapshot, self.key_column)
+        os.remove(self.log_path + ".compacting")
+
+
+def _write_csv(csv_path, parts, key_column):
+    tmp = "{}.tmp{}".format(csv_path, os.getpid())
+    with open(tmp, 'w', newline='') as f:
+        f.write("part_type,{}\n".format(key_column))
+        for part_type in sorted(parts):
+            members = parts[part_type]
+            if key_column == 'vert_index':
+                indices = np.flatnonzero(members)
+                f.write(("{},%d\n".format(part_type) * len(indices)) % tuple(indices.tolist()))
+            else:
+                writer = csv.writer(f, lineterminator="\n")
+                for name in sorted(members):
+                    writer.writerow([part_type, name])
+    os.replace(tmp, csv_path)
+
+
+if __name__ == '__main__':
+    for csv_path in sys.argv[1:]:
+        open_store(csv_path).compact(wait=True)
@@ -1,42 +1,81 @@
 import os
+import sys
 import glob
-import socket
-import bpy
+import time
+import json
+import argparse
 import shutil
+import subprocess
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 # import pymesh
 import numpy as np
 import pickle
 import importlib.util
-spec = importlib.util.spec_from_file_location("cluster_main", "/home/mike/Projects/DIVA/car_models/cluster_main.py")
-cluster_main = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(cluster_main)
-spec = importlib.util.spec_from_file_location("utils", "/home/mike/Projects/DIVA/car_models/utils.py")
+from collections import OrderedDict
+spec = importlib.util.spec_from_file_location("utils", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "export_tools", "utils.py"))
 utils = importlib.util.module_from_spec(spec)
+# Registered so utils' functions can be sent to worker processes
+sys.modules["utils"] = utils
 spec.loader.exec_module(utils)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import geometry_cache
+import build_manifest
+import part_splitter
+import label_transfer
+import instrumentation
+import model_index
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import shape_clusters
+try:
+    import bpy
+    import blender_mesh
+except ImportError:
+    # Running headless, only save_out_parts_without_blender is available
+    bpy = None
+
+OUTPUT_FOLDER = "car_models_auto_annotated"
+MANIFEST = OUTPUT_FOLDER + "_manifest.jsonl"
+FILE_HASHES = OUTPUT_FOLDER + "_hashes.json"
+PARTS = ["front_right", "front_left", "back_right", "back_left", "trunk"]
+PART_BOXES_FILE = "part_boxes_cache.json"
+# bbox: padded part boxes of the cluster center, knn: nearest neighbor vote over its part vertices,
+# knn-normalized: the same after scaling both meshes to a common frame
+TRANSFER_MODES = ["bbox", "knn", "knn-normalized"]
+# Import with bpy.ops.import_scene.obj instead of blender_mesh (--ops_import)
+OPS_IMPORT = False
+
+# cluster center -> (part file mtimes and sizes, part boxes)
+_part_boxes = {}
+# (cluster center, normalized) -> (part file mtimes and sizes, label_transfer.LabeledPoints)
+_labeled_points = {}
+# model -> obj file, read from the model index once by get_models_to_annotate (pool workers inherit it)
+_model_files = {}
 
 def get_paths(model):
-    host = socket.gethostname()
-    if host == 'Michaels-MacBook-Pro.local':
-        model_file = '/Users/mpeven/Downloads/02958343/{}/models/model_normalized.obj'.format(model)
-        clusters_file = '/Users/mpeven/Projects/DIVA/car_models/clusters.pkl'
-    elif host == 'titan':
-        model_file = '/home/mike/Projects/DIVA/car_models/02958343/{}/models/model_normalized.obj'.format(model)
-        clusters_file = '/home/mike/Projects/DIVA/car_models/clusters.pkl'
-    else:
-        raise ValueError("Unrecognized host: {}".format(host))
+    model_file = _model_files[model] if model in _model_files else model_index.ModelIndex().model_file(model)
+    clusters_file = shape_clusters.ASSIGNMENTS_FILE
     return model_file, clusters_file
 
+def get_models_to_annotate(workers=None):
+    ''' Cluster center -> models to annotate, every model goes to the hand annotated model closest in shape '''
+    # Only models changed since the last run are read again, see model_index
+    index = model_index.ModelIndex()
+    index.update(workers=workers)
+    model_files = index.model_files()
+    _model_files.update(model_files)
+    centers = set(os.path.basename(f).split("_")[0] for f in glob.glob("car_models_hand_annotated/*.obj"))
+    return shape_clusters.get_models_to_annotate(model_files, centers, workers=workers)
+
 def get_vertices(model_file):
     # If pymesh -- pymesh.meshio.load_mesh(model_file).vertices
-    vertices = []
-    with open(model_file, "r") as f:
-        for line in f.readlines():
-            if line[:2] == "v ":
-                vertices.append(np.array([float(x) for x in line.replace("v ", "").replace("\n", "").split(" ")]))
-    return vertices
+    return geometry_cache.load_vertices(model_file)
 
 def import_file(file_name):
-    bpy.ops.import_scene.obj(filepath=file_name, use_split_groups=False, use_split_objects=False)
+    if OPS_IMPORT:
+        bpy.ops.import_scene.obj(filepath=file_name, use_split_groups=False, use_split_objects=False)
+    else:
+        blender_mesh.import_obj(file_name, separate_objects=False)
     names = [obj for obj in bpy.context.scene.objects]
     names[0].name = "car_body"
     for obj in bpy.context.scene.objects:
@@ -46,122 +85,308 @@ def import_file(file_name):
 
 def clear_world():
     # Delete all objects and meshes
-    for obj in bpy.data.objects:
+    for obj in list(bpy.data.objects):
         bpy.data.objects.remove(obj, do_unlink=True)
-    for mes in bpy.data.meshes:
+    for mes in list(bpy.data.meshes):
         bpy.data.meshes.remove(mes, do_unlink=True)
 
-def save_out_parts(file, cluter_center_part_vertices, save_path):
+def save_out_parts(file, get_part_masks, save_path):
     clear_world()
-    import_file(file)
-    # Save to vertex groups
-    for part_type, bbox_dict in cluter_center_part_vertices.items():
-        print("Saving {} to a vertex group".format(part_type))
+    with instrumentation.span("import") as counts:
+        import_file(file)
+        mesh = bpy.context.active_object.data
+        counts['vertices'] = len(mesh.vertices)
+        counts['faces'] = len(mesh.polygons)
+    with instrumentation.span("part_masks") as counts:
         bpy.ops.object.mode_set(mode="OBJECT")
-        bpy.ops.object.select_all(action='SELECT')
-        bbox_max = bbox_dict['bbox_max']
-        bbox_min = bbox_dict['bbox_min']
-        if "right" in part_type:
-            bbox_max[0] += 1
-            bbox_max[1] += .02
-            bbox_max[2] += .01
-            bbox_min[0] -= .02
-            bbox_min[1] -= .02
-            bbox_min[2] -= .01
-        if "left" in part_type:
-            bbox_max[0] += .02
-            bbox_max[1] += .02
-            bbox_max[2] += .01
-            bbox_min[0] -= 1
-            bbox_min[1] -= .02
-            bbox_min[2] -= .01
-        if "trunk" in part_type:
-            bbox_max[2] += 1
-            bbox_max[1] += 1
-            bbox_min[2] -= .02
-            bbox_min[1] -= .02
-        vertices = []
-        vert_indices = []
-        for vert in bpy.context.active_object.data.vertices:
-            vertices.append(np.array([vert.co.x, vert.co.y, vert.co.z]))
-            vert_indices.append(vert.index)
-        vertices = np.stack(vertices)
-        in_bounds = (vertices <= bbox_max) & (vertices >= bbox_min)
-        in_bounds_vertex_indices = in_bounds.all(axis=1).nonzero()[0]
-        if len(in_bounds_vertex_indices) == 0:
-            continue
-        vg = bpy.context.active_object.vertex_groups.new(name=part_type)
-        vg.add([vert_indices[int(x)] for x in in_bounds_vertex_indices], 1.0, 'ADD')
-
+        vertices = np.empty(len(mesh.vertices) * 3, np.float32)
+        mesh.vertices.foreach_get("co", vertices)
+        part_masks = get_part_masks(vertices.reshape(-1, 3), file)
+        counts['parts'] = len(part_masks)
+        counts['vertices'] = int(sum(in_part.sum() for in_part in part_masks.values()))
 
-    # Separate meshes
-    bpy.ops.object.mode_set(mode="EDIT")
-    for part_type in cluter_center_part_vertices.keys():
-        print("Saving {} as its own object".format(part_type))
-        if part_type not in [v.name for v in bpy.context.object.vertex_groups]:
-            continue
-        bpy.ops.object.vertex_group_set_active(group=part_type)
-        bpy.ops.mesh.select_all(action='DESELECT')
-        bpy.ops.object.vertex_group_select()
-        names = [obj.name for obj in bpy.context.scene.objects]
-        try:
-            bpy.ops.mesh.separate(type='SELECTED')
-        except Exception:
-            continue
-        new_objs = [obj for obj in bpy.context.scene.objects if obj.name not in names]
-        new_objs[0].name = part_type
+    # Separate meshes, all parts in one pass
+    with instrumentation.span("separate") as counts:
+        parts = blender_mesh.separate_parts(bpy.context.active_object, part_masks)
+        counts['parts'] = len(parts)
 
     # Save meshes to obj files
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type='FACE')
-    bpy.ops.mesh.select_all(action='DESELECT')
-    for item in bpy.context.selectable_objects:
-        item.select = False
-    for ob in bpy.context.scene.objects:
-        bpy.context.scene.objects.active = ob
-        print("Saving {} as an obj file".format(ob.name))
-        ob.select = True
-        if ob.type != 'MESH':
+    with instrumentation.span("export") as counts:
+        written = []
+        for ob in list(bpy.context.scene.objects):
+            if ob.type != 'MESH':
+                continue
+            print("Saving {} as an obj file".format(ob.name))
+            written += blender_mesh.export_obj(save_path + "_{}.obj".format(ob.name), [ob])
+            bpy.data.objects.remove(ob, do_unlink=True)
+        counts['files'] = len(written) // 2
+        counts['bytes_written'] = instrumentation.file_bytes(written)
+
+def save_out_parts_without_blender(file, get_part_masks, save_path):
+    # Same output as save_out_parts, straight from the obj text
+    with instrumentation.span("import") as counts:
+        mesh = geometry_cache.load_obj(file)
+        counts['vertices'] = len(mesh.vertices)
+        counts['faces'] = mesh.num_faces
+    with instrumentation.span("part_masks") as counts:
+        part_masks = get_part_masks(mesh.vertices, file)
+        counts['parts'] = len(part_masks)
+        counts['vertices'] = int(sum(in_part.sum() for in_part in part_masks.values()))
+    with instrumentation.span("separate_and_export") as counts:
+        written = part_splitter.split_obj(file, part_masks, save_path, mesh=mesh)
+        counts['files'] = len(written)
+        counts['bytes_written'] = instrumentation.file_bytes(written + [f.replace(".obj", ".mtl") for f in written])
+
+def center_part_files(cluster_center, parts=PARTS):
+    mesh_files = {}
+    for part in parts:
+        mesh_file = "car_models_hand_annotated/{}_{}.obj".format(cluster_center, part)
+        if os.path.isfile(mesh_file):
+            mesh_files[part] = mesh_file
+    return mesh_files
+
+def get_part_boxes(cluster_center, cache_file=PART_BOXES_FILE):
+    '''
+    Bounding boxes of the hand annotated parts of a cluster center.
+
+    Computed once per center and kept in memory (and in cache_file unless it
+    is None), keyed on the mtime and size of the part files so re-annotating
+    the center invalidates them. The arrays are shared between calls and
+    therefore read-only.
+    '''
+    mesh_files = center_part_files(cluster_center)
+    key = [[part, os.stat(f).st_mtime_ns, os.stat(f).st_size] for part, f in sorted(mesh_files.items())]
+
+    if cache_file is not None and not _part_boxes and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            for center, entry in json.load(f).items():
+                _part_boxes[center] = (entry['key'], _boxes_from_lists(entry['boxes']))
+    if cluster_center in _part_boxes and _part_boxes[cluster_center][0] == key:
+        return _part_boxes[cluster_center][1]
+
+    part_boxes = {}
+    for part, mesh_file in mesh_files.items():
+        cluster_center_vertices = get_vertices(mesh_file)
+        bbox_max = np.amax(cluster_center_vertices, 0)
+        bbox_min = np.amin(cluster_center_vertices, 0)
+        part_boxes[part] = {'bbox_max': bbox_max, 'bbox_min': bbox_min}
+    part_boxes = _boxes_from_lists(part_boxes)
+    _part_boxes[cluster_center] = (key, part_boxes)
+    if cache_file is not None:
+        entries = {center: {'key': k, 'boxes': {part: {name: box.tolist() for name, box in b.items()}
+                                                 for part, b in boxes.items()}}
+                   for center, (k, boxes) in _part_boxes.items()}
+        tmp = "{}.tmp{}".format(cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, cache_file)
+    return part_boxes
+
+def _boxes_from_lists(part_boxes):
+    boxes = {}
+    for part in PARTS:
+        if part not in part_boxes:
             continue
-        file_name = save_path + "_{}.obj".format(ob.name)
-        bpy.ops.export_scene.obj(filepath=file_name, use_selection=True, check_existing=False)
-        ob.select = False
-        bpy.data.objects.remove(bpy.data.objects[ob.name], True)
-
-def main():
-    if os.path.isdir("./car_models_auto_annotated"):
-        shutil.rmtree("./car_models_auto_annotated")
-    os.mkdir("car_models_auto_annotated")
-    parts = ["front_right", "front_left", "back_right", "back_left", "trunk"]
-
-    # Annotate
-    to_annotate = cluster_main.get_models_to_annotate()
-    i = 0
+        boxes[part] = {}
+        for name in ['bbox_max', 'bbox_min']:
+            boxes[part][name] = np.array(part_boxes[part][name], dtype=np.float64)
+            boxes[part][name].flags.writeable = False
+    return boxes
+
+def get_labeled_points(cluster_center, normalized=False):
+    '''
+    KD-tree over the vertices of the hand annotated parts (and car body) of a
+    cluster center, built once per center and process
+    '''
+    mesh_files = center_part_files(cluster_center, PARTS + ["car_body"])
+    key = [[part, os.stat(f).st_mtime_ns, os.stat(f).st_size] for part, f in sorted(mesh_files.items())]
+    if (cluster_center, normalized) in _labeled_points and _labeled_points[cluster_center, normalized][0] == key:
+        return _labeled_points[cluster_center, normalized][1]
+    part_vertices = OrderedDict((part, get_vertices(mesh_files[part])) for part in PARTS + ["car_body"]
+                                if part in mesh_files)
+    points = label_transfer.LabeledPoints(part_vertices, normalized=normalized)
+    _labeled_points[cluster_center, normalized] = (key, points)
+    return points
+
+def part_masks_function(cluster_center, transfer="bbox"):
+    ''' Function from the vertices of a model and its obj file to its ordered dict of part -> vertex mask '''
+    if transfer == "bbox":
+        part_boxes = get_part_boxes(cluster_center)
+        return lambda vertices, model_file: part_splitter.masks_from_boxes(
+            vertices, part_boxes, get_grid(model_file, vertices))
+    points = get_labeled_points(cluster_center, normalized=transfer == "knn-normalized")
+    return lambda vertices, model_file: part_splitter.masks_from_labels(points.transfer(vertices), points.names)
+
+def get_grid(model_file, vertices):
+    # Grid over the vertices of the obj file, which are the imported ones as long as the import kept them all in order
+    grid = geometry_cache.load_grid(model_file)
+    return grid if len(grid.vertices) == len(vertices) else None
+
+def annotate_model(model, cluster_center, use_blender=True, transfer="bbox"):
+    unannotated_mesh_file = get_paths(model)[0]
+    with instrumentation.context(model=model), instrumentation.span("annotate_model", transfer=transfer):
+        get_part_masks = part_masks_function(cluster_center, transfer)
+        save_path = "{}/{}".format(OUTPUT_FOLDER, model)
+        if use_blender:
+            save_out_parts(unannotated_mesh_file, get_part_masks, save_path)
+        else:
+            save_out_parts_without_blender(unannotated_mesh_file, get_part_masks, save_path)
+
+def read_manifest(manifest_file):
+    # Last record per model wins, so a retried model shows its latest status
+    records = {}
+    if not os.path.isfile(manifest_file):
+        return records
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Half written line from a crash
+                continue
+            records[record['model']] = record
+    return records
+
+def append_manifest(manifest_file, record):
+    with open(manifest_file, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+def run_job(job):
+    '''
+    Annotates one model and returns its manifest record. Errors are caught so
+    one bad mesh only fails its own model.
+    '''
+    model, cluster_center, use_blender, in_subprocess, transfer = job
+    start = time.time()
+    error = None
+    try:
+        if in_subprocess:
+            cmd = ['blender', '--background', '--python-exit-code', '1', '--python', os.path.abspath(__file__),
+                   '--', '--model', model, '--cluster_center', cluster_center, '--transfer', transfer]
+            if OPS_IMPORT:
+                cmd.append('--ops_import')
+            returncode = subprocess.call(cmd, stdout=subprocess.DEVNULL)
+            if returncode != 0:
+                raise RuntimeError("blender exited with code {}".format(returncode))
+        else:
+            annotate_model(model, cluster_center, use_blender, transfer)
+    except Exception as e:
+        error = repr(e)
+        # Don't leave half a model behind
+        remove_model_outputs(model)
+    return {
+        'model': model,
+        'cluster_center': cluster_center,
+        'status': 'failed' if error else 'done',
+        'duration': time.time() - start,
+        'error': error,
+    }
+
+def remove_model_outputs(model):
+    for part_file in glob.glob("{}/{}_*".format(OUTPUT_FOLDER, model)):
+        os.remove(part_file)
+    for texture_file in glob.glob("{}/textures/{}_*".format(OUTPUT_FOLDER, model)):
+        os.remove(texture_file)
+
+def model_inputs_hash(file_hashes, model, cluster_center, use_blender, transfer="bbox"):
+    ''' Hash of everything the output of a model depends on '''
+    model_file = get_paths(model)[0]
+    files = [model_file, model_file.replace(".obj", ".mtl")]
+    files += ["car_models_hand_annotated/{}_{}.obj".format(cluster_center, part) for part in PARTS]
+    if transfer == "bbox":
+        return build_manifest.inputs_hash(file_hashes, files, [cluster_center, use_blender])
+    files += ["car_models_hand_annotated/{}_car_body.obj".format(cluster_center)]
+    return build_manifest.inputs_hash(file_hashes, files, [cluster_center, use_blender, transfer])
+
+def main(use_blender=True, workers=1, fresh=False, transfer="bbox", bundles=False):
+    if fresh and os.path.isdir(OUTPUT_FOLDER):
+        shutil.rmtree(OUTPUT_FOLDER)
+    if fresh and os.path.isfile(MANIFEST):
+        os.remove(MANIFEST)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+    # Skip the models a previous run already built from the same inputs
+    with instrumentation.span("clustering"):
+        to_annotate = get_models_to_annotate(workers)
+    finished = read_manifest(MANIFEST)
+    file_hashes = build_manifest.FileHashes(FILE_HASHES)
+    # The ShapeNet files were hashed in parallel by the model index update, only changed files get hashed here
+    file_hashes.hashes.update(model_index.ModelIndex().file_hashes())
     total_models = sum([len(x) for x in to_annotate.values()])
+    jobs = []
+    inputs = {}
     for cluster_center, cluster_models in to_annotate.items():
-        print("Using annotations from model {}".format(cluster_center))
-
-        # Unannotated model loop
         for model in cluster_models:
-            print("\n\nAnnotating {}/{}.".format(i, total_models))
-            unannotated_mesh_file = get_paths(model)[0]
-            part_boxes = {}
-            for part in parts:
-                mesh_file = "car_models_hand_annotated/{}_{}.obj".format(cluster_center, part)
-                if not os.path.isfile(mesh_file):
-                    continue
-                cluster_center_vertices = get_vertices(mesh_file)
-                bbox_max = np.amax(cluster_center_vertices, 0)
-                bbox_min = np.amin(cluster_center_vertices, 0)
-                part_boxes[part] = {'bbox_max': bbox_max, 'bbox_min': bbox_min}
-            save_path = "car_models_auto_annotated/{}".format(model)
-            save_out_parts(unannotated_mesh_file, part_boxes, save_path)
-            i += 1
-    utils.correct_texture_paths("car_models_auto_annotated")
-    utils.add_metadata("car_models_auto_annotated")
-    utils.remove_faceless_models("car_models_auto_annotated")
+            inputs[model] = model_inputs_hash(file_hashes, model, cluster_center, use_blender, transfer)
+            record = finished.get(model, {})
+            if record.get('status') != 'done' or record.get('inputs') != inputs[model]:
+                remove_model_outputs(model)
+                jobs.append((model, cluster_center, use_blender, False, transfer))
+    file_hashes.save()
+    print("Annotating {} models ({} up to date)".format(len(jobs), total_models - len(jobs)))
+
+    # Blender can't be forked, so parallel Blender runs are one subprocess per model
+    if use_blender and (workers > 1 or bpy is None):
+        jobs = [(model, center, True, True, transfer) for model, center, _, _, transfer in jobs]
+        pool = ThreadPool(workers)
+    elif workers > 1:
+        pool = Pool(workers, maxtasksperchild=100)
+    else:
+        pool = None
+    results = pool.imap_unordered(run_job, jobs) if pool is not None else map(run_job, jobs)
+
+    start = time.time()
+    failed = 0
+    for i, record in enumerate(results):
+        record['inputs'] = inputs[record['model']]
+        append_manifest(MANIFEST, record)
+        if record['status'] == 'failed':
+            failed += 1
+            print("Failed on {}: {}".format(record['model'], record['error']))
+        rate = (i + 1) / (time.time() - start)
+        print("Annotated {}/{} ({:.2f} models/s, {} failed, {:.0f}s left)".format(
+            i + 1, len(jobs), rate, failed, (len(jobs) - i - 1) / rate))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if jobs:
+        elapsed = time.time() - start
+        print("Annotated {} models in {:.0f}s ({:.2f} models/s), {} failed".format(
+            len(jobs), elapsed, len(jobs) / elapsed, failed))
+
+    # Only the models built in this run still need their textures and metadata
+    models = None if fresh else set(job[0] for job in jobs)
+    if models is None or models:
+        with instrumentation.span("postprocess", models=len(models) if models is not None else None):
+            utils.postprocess(OUTPUT_FOLDER, models, workers=workers, bundles=bundles)
 
 
 
 if __name__ == '__main__':
-    main()
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Transfer part annotations from cluster centers to their cluster.')
+    parser.add_argument('--no_blender', action='store_true',
+        help='Split the models with numpy instead of Blender (no Blender install needed)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='Number of models to annotate at once')
+    parser.add_argument('--fresh', action='store_true',
+        help='Delete the previous output and manifest instead of only rebuilding what changed')
+    parser.add_argument('--transfer', choices=TRANSFER_MODES, default="bbox",
+        help='How labels are transferred from the cluster center: padded part boxes or a nearest neighbor vote')
+    parser.add_argument('--trace', type=str,
+        help='Append timing and memory records of every stage to this json lines file')
+    parser.add_argument('--bundle', action='store_true',
+        help='Also write all parts of every model to one binary {model}_parts.bundle file')
+    parser.add_argument('--ops_import', action='store_true',
+        help="Import models with Blender's obj importer instead of the numpy loader")
+    parser.add_argument('--model', type=str, help='Only annotate this model (used by the parallel driver)')
+    parser.add_argument('--cluster_center', type=str, help='Cluster center to take the annotations of --model from')
+    args = parser.parse_args(argv)
+    OPS_IMPORT = args.ops_import
+    if args.trace is not None:
+        instrumentation.configure(args.trace)
+    if args.model is not None:
+        annotate_model(args.model, args.cluster_center, use_blender=not args.no_blender, transfer=args.transfer)
+    else:
+        main(use_blender=not args.no_blender, workers=args.workers, fresh=args.fresh, transfer=args.transfer,
+             bundles=args.bundle)
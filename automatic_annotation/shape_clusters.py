@@ -0,0 +1,194 @@
+'''
+Finding the hand annotated model (cluster center) closest in shape to every
+other model of the category.
+
+Every model gets a shape descriptor: the D2 distribution (histogram of the
+distances between random pairs of surface points) next to a coarse voxel
+occupancy grid of the same points. Descriptors are computed in a process pool
+and kept in one matrix in descriptors.npz, keyed on the mtime and size of the
+model file, so adding models to the category only computes theirs. Models are
+assigned to the nearest center through a KD-tree (scipy's when it is
+installed, a blocked brute force search otherwise), which is a lookup per
+model rather than a re-clustering of the whole category. The assignment is
+kept in cluster_assignments.json.
+'''
+
+import os
+import sys
+import json
+from collections import OrderedDict
+from multiprocessing import Pool
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import geometry_cache
+import model_index
+
+DESCRIPTORS_FILE = "descriptors.npz"
+ASSIGNMENTS_FILE = "cluster_assignments.json"
+SAMPLES = 4096
+PAIRS = 65536
+D2_BINS = 64
+GRID = 8
+
+
+def surface_samples(mesh, n, random):
+    ''' n points spread uniformly over the faces of an ObjMesh (its vertices if it has no area) '''
+    counts = np.diff(mesh.face_offsets)
+    faces = np.flatnonzero(counts >= 3)
+    if len(faces):
+        # Fan triangulation: corners (0, j, j + 1) of every face
+        n_triangles = counts[faces] - 2
+        first = np.repeat(mesh.face_offsets[faces], n_triangles)
+        corner = np.arange(n_triangles.sum()) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles) + 1
+        a = mesh.vertices[mesh.face_vertices[first]].astype(np.float64)
+        b = mesh.vertices[mesh.face_vertices[first + corner]].astype(np.float64)
+        c = mesh.vertices[mesh.face_vertices[first + corner + 1]].astype(np.float64)
+        areas = np.linalg.norm(np.cross(b - a, c - a), axis=1)
+        if areas.sum() > 0:
+            picked = random.choice(len(areas), n, p=areas / areas.sum())
+            r1 = np.sqrt(random.random_sample((n, 1)))
+            r2 = random.random_sample((n, 1))
+            return (1 - r1) * a[picked] + r1 * (1 - r2) * b[picked] + r1 * r2 * c[picked]
+    vertices = np.asarray(mesh.vertices, np.float64)
+    if len(vertices) == 0:
+        return np.zeros((0, 3))
+    return vertices[random.randint(len(vertices), size=n)]
+
+
+def descriptor(points, random):
+    ''' D2 histogram followed by the GRID^3 occupancy of the points, both summing to one '''
+    out = np.zeros(D2_BINS + GRID ** 3, np.float32)
+    if len(points) == 0:
+        return out
+    low, high = points.min(0), points.max(0)
+    size = max((high - low).max(), 1e-12)
+    # Scale so the longest side is one, keeping the proportions
+    points = (points - (low + high) / 2) / size + .5
+
+    pairs = random.randint(len(points), size=(PAIRS, 2))
+    distances = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1)
+    d2, _ = np.histogram(distances, bins=D2_BINS, range=(0, np.sqrt(3)))
+    out[:D2_BINS] = d2 / PAIRS
+
+    cells = np.clip((points * GRID).astype(np.int64), 0, GRID - 1)
+    occupancy = np.bincount((cells[:, 0] * GRID + cells[:, 1]) * GRID + cells[:, 2], minlength=GRID ** 3)
+    out[D2_BINS:] = occupancy / len(points)
+    return out
+
+
+def model_descriptor(obj_file):
+    # Seeded, so the same file always gets the same descriptor
+    random = np.random.RandomState(0)
+    return descriptor(surface_samples(geometry_cache.load_obj(obj_file), SAMPLES, random), random)
+
+
+def _file_key(obj_file):
+    stat = os.stat(obj_file)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_descriptors(cache_file=DESCRIPTORS_FILE):
+    ''' Returns (models, file keys, descriptor matrix) of the cache '''
+    if not os.path.isfile(cache_file):
+        return np.zeros(0, dtype=str), np.zeros((0, 2), np.int64), np.zeros((0, D2_BINS + GRID ** 3), np.float32)
+    with np.load(cache_file) as data:
+        return data['models'], data['keys'], data['descriptors']
+
+
+def update_descriptors(model_files, cache_file=DESCRIPTORS_FILE, workers=None):
+    '''
+    Descriptors of the given models (dict of model -> obj file), as a matrix
+    with one row per model in sorted model order. Only models that are new or
+    whose file changed are computed.
+    '''
+    models, keys, descriptors = load_descriptors(cache_file)
+    rows = {model: i for i, model in enumerate(models)}
+    wanted = sorted(model_files)
+    wanted_keys = {model: _file_key(model_files[model]) for model in wanted}
+    stale = [m for m in wanted if m not in rows or list(keys[rows[m]]) != wanted_keys[m]]
+
+    if stale:
+        print("Computing shape descriptors of {} models ({} cached)".format(len(stale), len(wanted) - len(stale)))
+        with Pool(workers) as pool:
+            computed = pool.map(model_descriptor, [model_files[m] for m in stale], chunksize=8)
+        kept = ~np.isin(models, stale)
+        models = np.concatenate([models[kept], np.array(stale, dtype=str)]).astype(str)
+        keys = np.concatenate([keys[kept], np.array([wanted_keys[m] for m in stale], np.int64)])
+        descriptors = np.concatenate([descriptors[kept], np.array(computed, np.float32)])
+        tmp = "{}.tmp{}".format(cache_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, models=models, keys=keys, descriptors=descriptors)
+        os.replace(tmp, cache_file)
+        rows = {model: i for i, model in enumerate(models)}
+
+    return descriptors[[rows[m] for m in wanted]]
+
+
+class NearestCenter(object):
+    ''' Nearest neighbor index over the descriptors of the cluster centers '''
+    def __init__(self, center_descriptors):
+        self.centers = np.asarray(center_descriptors, np.float64)
+        try:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.centers)
+        except ImportError:
+            self.tree = None
+
+    def query(self, descriptors, block=4096):
+        ''' Index of the nearest center of every row of descriptors '''
+        descriptors = np.asarray(descriptors, np.float64)
+        if self.tree is not None:
+            return self.tree.query(descriptors)[1]
+        nearest = np.zeros(len(descriptors), np.int64)
+        center_norms = (self.centers ** 2).sum(axis=1)
+        for start in range(0, len(descriptors), block):
+            rows = descriptors[start:start + block]
+            nearest[start:start + block] = np.argmin(center_norms - 2 * rows.dot(self.centers.T), axis=1)
+        return nearest
+
+
+def get_models_to_annotate(model_files, centers, cache_file=DESCRIPTORS_FILE,
+                           assignments_file=ASSIGNMENTS_FILE, workers=None):
+    '''
+    Drop-in for cluster_main.get_models_to_annotate: an ordered dict of
+    cluster center -> models to annotate with its parts
+
+    model_files maps every model of the category (centers included) to its
+    obj file, centers are the hand annotated models.
+    '''
+    centers = sorted(c for c in centers if c in model_files)
+    if not centers:
+        raise ValueError("None of the hand annotated models are in the dataset")
+    descriptors = update_descriptors(model_files, cache_file, workers)
+    models = sorted(model_files)
+    rows = {model: i for i, model in enumerate(models)}
+    index = NearestCenter(descriptors[[rows[c] for c in centers]])
+
+    to_annotate = [m for m in models if m not in set(centers)]
+    nearest = index.query(descriptors[[rows[m] for m in to_annotate]]) if to_annotate else []
+    assignments = OrderedDict((model, centers[i]) for model, i in zip(to_annotate, nearest))
+    tmp = "{}.tmp{}".format(assignments_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(assignments, f, indent=1)
+    os.replace(tmp, assignments_file)
+
+    clusters = OrderedDict((center, []) for center in centers)
+    for model, center in assignments.items():
+        clusters[center].append(model)
+    return clusters
+
+
+if __name__ == '__main__':
+    import glob
+    import argparse
+    parser = argparse.ArgumentParser(description='Assign every model to the closest hand annotated model.')
+    parser.add_argument('dataset_dir', nargs='?', help='ShapeNet category folder, e.g. 02958343 (default: the indexed one)')
+    parser.add_argument('--annotated', default='car_models_hand_annotated', help='Folder of the hand annotated parts')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Processes computing descriptors')
+    args = parser.parse_args()
+    index = model_index.ModelIndex()
+    index.update(args.dataset_dir, workers=args.workers)
+    model_files = index.model_files()
+    centers = set(os.path.basename(f).split("_")[0] for f in glob.glob("{}/*.obj".format(args.annotated)))
+    for center, models in get_models_to_annotate(model_files, centers, workers=args.workers).items():
+        print("{}: {} models".format(center, len(models)))
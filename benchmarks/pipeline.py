@@ -0,0 +1,259 @@
+'''
+Benchmark suite of the Blender-independent pipeline stages on synthetic data
+(see synthetic_meshes.py):
+
+    obj_parsing             obj_io.read_obj of every model
+    bbox_transfer           part boxes of the cluster center + part_splitter, per model
+    box_queries_scan        part masks of every model for PADDINGS scaled boxes, testing all vertices
+    box_queries_grid        the same through the cached spatial_index grid of every model (built once)
+    correct_texture_paths   utils.correct_texture_paths on the exported parts
+    add_metadata            utils.add_metadata
+    remove_faceless_models  utils.remove_faceless_models
+    postprocess             utils.postprocess, the fused version of the three above
+    end_to_end              automatic_annotation.main(use_blender=False) on a dataset of its own
+
+Everything runs in a temporary folder. The results (seconds, items and rate
+per stage, plus the settings and commit) are written to a json file, and
+with --baseline every stage that got slower than the baseline by more than
+the tolerance is reported as a regression (exit code 1).
+
+python benchmarks/pipeline.py -o results.json
+python benchmarks/pipeline.py -o new.json --baseline results.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import importlib.util
+from collections import OrderedDict
+import numpy as np
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO, "mesh_tools"))
+sys.path.append(os.path.join(REPO, "export_tools"))
+import obj_io
+import part_splitter
+import geometry_cache
+import utils
+import synthetic_meshes
+
+EXPORT_FOLDER = "car_models_auto_annotated"
+# Box scales tried per model by the box query stages, like when tuning the padding
+PADDINGS = np.linspace(.9, 1.1, 20)
+
+
+class Timer(object):
+    ''' Collects the time of every stage, with the number of items it handled '''
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def stage(self, name, items, unit):
+        return _Stage(self, name, items, unit)
+
+
+class _Stage(object):
+    def __init__(self, timer, name, items, unit):
+        self.timer, self.name, self.items, self.unit = timer, name, items, unit
+
+    def __enter__(self):
+        print("Running {}".format(self.name))
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            return False
+        seconds = time.time() - self.start
+        self.timer.stages[self.name] = {
+            'seconds': seconds,
+            'items': self.items,
+            'unit': self.unit,
+            'per_second': self.items / max(seconds, 1e-9),
+        }
+        print("{:<25}{:>10.3f}s{:>12.1f} {}/s".format(self.name, seconds, self.items / max(seconds, 1e-9), self.unit))
+
+
+def folder_bytes(folder, pattern=".obj"):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder) if f.endswith(pattern))
+
+
+def get_center_boxes(centers):
+    center_boxes = {}
+    for center in centers:
+        center_boxes[center] = {}
+        for part in synthetic_meshes.PARTS:
+            part_file = "car_models_hand_annotated/{}_{}.obj".format(center, part)
+            if os.path.isfile(part_file):
+                vertices = obj_io.read_vertices(part_file)
+                center_boxes[center][part] = {'bbox_min': vertices.min(0), 'bbox_max': vertices.max(0)}
+    return center_boxes
+
+
+def export_parts(model_files, centers, folder):
+    ''' What automatic_annotation does per model with --no_blender --transfer bbox '''
+    os.makedirs(folder, exist_ok=True)
+    center_boxes = get_center_boxes(centers)
+    for i, (model, obj_file) in enumerate(model_files.items()):
+        mesh = obj_io.read_obj(obj_file)
+        part_masks = part_splitter.masks_from_boxes(mesh.vertices, center_boxes[centers[i % len(centers)]])
+        part_splitter.split_obj(obj_file, part_masks, "{}/{}".format(folder, model), mesh=mesh)
+
+
+def box_queries(model_files, centers, grids):
+    ''' Part masks of every model for every scale in PADDINGS, returns the number of vertices found '''
+    center_boxes = get_center_boxes(centers)
+    found = 0
+    for i, obj_file in enumerate(model_files.values()):
+        vertices = geometry_cache.load_vertices(obj_file)
+        grid = geometry_cache.load_grid(obj_file) if grids else None
+        for scale in PADDINGS:
+            boxes = {part: {'bbox_min': box['bbox_min'] * scale, 'bbox_max': box['bbox_max'] * scale}
+                     for part, box in center_boxes[centers[i % len(centers)]].items()}
+            masks = part_splitter.masks_from_boxes(vertices, boxes, grid)
+            found += sum(int(mask.sum()) for mask in masks.values())
+    return found
+
+
+def run_stages(timer, args):
+    model_files, centers = synthetic_meshes.make_dataset(
+        "dataset", args.models, args.centers, args.vertices, args.parts, args.materials, args.textures,
+        args.texture_kb * 1024, args.triangles)
+    os.rename("dataset/car_models_hand_annotated", "car_models_hand_annotated")
+    with open("pickup_models.json", 'w') as f:
+        json.dump([], f)
+    obj_bytes = sum(os.path.getsize(f) for f in model_files.values())
+
+    with timer.stage("obj_parsing", obj_bytes / 1e6, "MB"):
+        for obj_file in model_files.values():
+            obj_io.read_obj(obj_file)
+
+    with timer.stage("bbox_transfer", len(model_files), "models"):
+        export_parts(model_files, centers, EXPORT_FOLDER)
+
+    # Grids are persisted, so they are built before timing like a second run would find them
+    for obj_file in model_files.values():
+        geometry_cache.load_grid(obj_file)
+    queries = len(model_files) * len(PADDINGS)
+    with timer.stage("box_queries_scan", queries, "box sets"):
+        scanned = box_queries(model_files, centers, grids=False)
+    with timer.stage("box_queries_grid", queries, "box sets"):
+        if box_queries(model_files, centers, grids=True) != scanned:
+            raise RuntimeError("Grid box queries found other vertices than the full scan")
+
+    # The separate stages and the fused one each get their own copy of the export
+    shutil.copytree(EXPORT_FOLDER, "fused")
+    part_bytes = folder_bytes(EXPORT_FOLDER) / 1e6
+    with timer.stage("correct_texture_paths", part_bytes, "MB"):
+        utils.correct_texture_paths(EXPORT_FOLDER)
+    with timer.stage("add_metadata", part_bytes, "MB"):
+        utils.add_metadata(EXPORT_FOLDER)
+    with timer.stage("remove_faceless_models", part_bytes, "MB"):
+        utils.remove_faceless_models(EXPORT_FOLDER)
+    with timer.stage("postprocess", part_bytes, "MB"):
+        utils.postprocess("fused", workers=args.workers)
+
+
+def run_end_to_end(timer, args):
+    model_files, centers = synthetic_meshes.make_dataset(
+        "dataset", args.e2e_models, args.centers, args.e2e_vertices, args.parts, args.materials, args.textures,
+        args.texture_kb * 1024, args.triangles, seed=1000)
+    os.rename("dataset/car_models_hand_annotated", "car_models_hand_annotated")
+    with open("pickup_models.json", 'w') as f:
+        json.dump([], f)
+    os.environ["SHAPENET_CAR_DIR"] = os.path.abspath(os.path.join("dataset", synthetic_meshes.CATEGORY))
+    spec = importlib.util.spec_from_file_location(
+        "automatic_annotation", os.path.join(REPO, "automatic_annotation", "automatic_annotation.py"))
+    automatic_annotation = importlib.util.module_from_spec(spec)
+    # Registered so pool workers pickle its functions by name instead of importing a second copy
+    sys.modules["automatic_annotation"] = automatic_annotation
+    spec.loader.exec_module(automatic_annotation)
+    with timer.stage("end_to_end", len(model_files), "models"):
+        automatic_annotation.main(use_blender=False, workers=args.workers)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', '-C', REPO, 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    ''' Prints the change of every stage against the baseline, returns the stages that regressed '''
+    regressions = []
+    print("{:<25}{:>11}{:>11}{:>9}".format("", "baseline", "now", "change"))
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['seconds']
+        change = stage['seconds'] / max(before, 1e-9) - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<25}{:>10.3f}s{:>10.3f}s{:>8.0f}%{}".format(name, before, stage['seconds'], change * 100, flag))
+    return regressions
+
+
+def main(args):
+    timer = Timer()
+    work_dir = tempfile.mkdtemp(prefix="benchmark_", dir=args.tmp_dir)
+    cwd = os.getcwd()
+    try:
+        os.makedirs(os.path.join(work_dir, "stages"))
+        os.chdir(os.path.join(work_dir, "stages"))
+        run_stages(timer, args)
+        if args.e2e_models > 0:
+            os.makedirs(os.path.join(work_dir, "end_to_end"))
+            os.chdir(os.path.join(work_dir, "end_to_end"))
+            run_end_to_end(timer, args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'settings': vars(args),
+        'stages': timer.stages,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Slower than the baseline: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Blender-independent pipeline stages.')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='Json file to write the results to')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=.2, help='Slowdown that counts as a regression')
+    parser.add_argument('-m', '--models', type=int, default=50, help='Models in the per-stage dataset')
+    parser.add_argument('-n', '--vertices', type=int, default=100000, help='Vertices per model (about)')
+    parser.add_argument('--e2e_models', type=int, default=1000, help='Models in the end-to-end dataset (0 skips it)')
+    parser.add_argument('--e2e_vertices', type=int, default=10000, help='Vertices per end-to-end model')
+    parser.add_argument('-c', '--centers', type=int, default=2)
+    parser.add_argument('-p', '--parts', type=int, default=5)
+    parser.add_argument('--materials', type=int, default=4)
+    parser.add_argument('--textures', type=int, default=2)
+    parser.add_argument('--texture_kb', type=int, default=64)
+    parser.add_argument('--triangles', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--tmp_dir', default=None, help='Where the temporary data goes (needs a few GB)')
+    main(parser.parse_args())
@@ -0,0 +1,178 @@
+'''
+Procedural ShapeNet-like car models for benchmarks.
+
+A model is a box shaped body with its doors and trunk as separate panels just
+outside of it, every surface a grid of quads (or triangles) with uvs and
+normals, split over a number of materials that use a number of texture
+images. The size of every model is jittered a little so the part boxes of one
+model still roughly fit the others, like the cars of one cluster.
+
+make_dataset writes the same layout the pipeline reads:
+
+    {root}/02958343/{model}/models/model_normalized.obj/.mtl
+    {root}/02958343/{model}/images/texture_{i}.jpg
+    {root}/car_models_hand_annotated/{center}_{part}.obj/.mtl
+
+python benchmarks/synthetic_meshes.py /tmp/synthetic -m 20 -n 100000
+'''
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import obj_io
+import part_splitter
+
+CATEGORY = "02958343"
+PARTS = ["front_right", "front_left", "back_right", "back_left", "trunk"]
+BODY_LOW = np.array([-1, 0, -2])
+BODY_HIGH = np.array([1, .8, 2])
+# Panels as (origin, u side, v side) facing out along u x v, a little outside of the body
+PANELS = OrderedDict([
+    ("front_right", ([1.01, .2, -1.], [0, .5, 0], [0, 0, .9])),
+    ("front_left", ([-1.01, .2, -.1], [0, .5, 0], [0, 0, -.9])),
+    ("back_right", ([1.01, .2, .1], [0, .5, 0], [0, 0, .9])),
+    ("back_left", ([-1.01, .2, 1.], [0, .5, 0], [0, 0, -.9])),
+    ("trunk", ([-.8, .81, 1.2], [0, 0, .7], [1.6, 0, 0])),
+])
+
+
+def sheet(origin, u, v, n_vertices, triangles=False):
+    '''
+    A grid over the parallelogram origin + s * u + t * v with about n_vertices
+    vertices. Returns (vertices, uvs, normal, face corner arrays).
+    '''
+    origin, u, v = (np.asarray(x, np.float64) for x in (origin, u, v))
+    n = max(int(np.sqrt(n_vertices)), 2)
+    s, t = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n), indexing='ij')
+    s, t = s.ravel(), t.ravel()
+    vertices = origin + s[:, None] * u + t[:, None] * v
+    normal = np.cross(u, v)
+    normal /= np.linalg.norm(normal)
+    i, j = np.meshgrid(np.arange(n - 1), np.arange(n - 1), indexing='ij')
+    corner = (i * n + j).ravel()
+    quads = np.stack([corner, corner + n, corner + n + 1, corner + 1], axis=1)
+    if triangles:
+        faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+    else:
+        faces = quads
+    return vertices, np.stack([s, t], axis=1), normal, faces
+
+
+def box_sheets(low, high):
+    size = high - low
+    ex, ey, ez = np.diag(size)
+    return [
+        (low, ez, ey), (low + ex, ey, ez),            # left, right
+        (low, ex, ez), (low + ey, ez, ex),            # bottom, top
+        (low, ey, ex), (low + ez, ex, ey),            # front, back
+    ]
+
+
+def make_car(n_vertices=100000, n_parts=5, n_materials=4, triangles=False, seed=0):
+    '''
+    Returns (ObjMesh, ordered dict of part -> boolean vertex mask) of a car
+    with about n_vertices vertices and the first n_parts of PARTS
+    '''
+    rng = np.random.RandomState(seed)
+    scale = rng.uniform(.95, 1.05, 3)
+    parts = list(PANELS)[:n_parts]
+    # Three fifths of the vertices go to the body
+    body_budget = n_vertices * 3 // 5 if parts else n_vertices
+    surfaces = [("car_body", s) for s in box_sheets(BODY_LOW, BODY_HIGH)]
+    surfaces += [(part, PANELS[part]) for part in parts]
+    budgets = [body_budget // 6] * 6 + [(n_vertices - body_budget) // max(len(parts), 1)] * len(parts)
+
+    vertices, uvs, normals, faces, face_normals, owner = [], [], [], [], [], []
+    n = 0
+    for (name, (origin, u, v)), budget in zip(surfaces, budgets):
+        sheet_vertices, sheet_uvs, normal, sheet_faces = sheet(origin, u, v, budget, triangles)
+        vertices.append(sheet_vertices)
+        uvs.append(sheet_uvs)
+        faces.append(sheet_faces + n)
+        face_normals.append(np.full(len(sheet_faces), len(normals)))
+        normals.append(normal)
+        owner.append(np.full(len(sheet_vertices), name, dtype=object))
+        n += len(sheet_vertices)
+
+    vertices = (np.concatenate(vertices) * scale).astype(np.float32)
+    faces = np.concatenate(faces)
+    corners = faces.shape[1]
+    face_normals = np.repeat(np.concatenate(face_normals), corners)
+    # Materials in contiguous runs of faces, like exported models
+    face_materials = (np.arange(len(faces)) * n_materials // len(faces)).astype(np.int32)
+    mesh = obj_io.ObjMesh(
+        vertices,
+        uvs=np.concatenate(uvs).astype(np.float32),
+        normals=np.array(normals, np.float32),
+        face_offsets=np.arange(len(faces) + 1, dtype=np.int64) * corners,
+        face_vertices=faces.ravel().astype(np.int64),
+        face_uvs=faces.ravel().astype(np.int64),
+        face_normals=face_normals.astype(np.int64),
+        face_materials=face_materials,
+        face_groups=np.zeros(len(faces), np.int32),
+        materials=["material_{}".format(i) for i in range(n_materials)],
+        groups=["car"],
+    )
+    owner = np.concatenate(owner)
+    part_masks = OrderedDict((part, owner == part) for part in parts)
+    return mesh, part_masks
+
+
+def write_model(model_dir, mesh, n_textures=2, texture_bytes=1 << 16, seed=0):
+    ''' Writes a model the way ShapeNet lays it out, returns its obj file '''
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(model_dir, "models"), exist_ok=True)
+    os.makedirs(os.path.join(model_dir, "images"), exist_ok=True)
+    for i in range(n_textures):
+        with open(os.path.join(model_dir, "images", "texture_{}.jpg".format(i)), 'wb') as f:
+            f.write(rng.bytes(texture_bytes))
+    materials = OrderedDict()
+    for i, name in enumerate(mesh.materials):
+        lines = ["Ka 0 0 0", "Kd {:.3f} {:.3f} {:.3f}".format(*rng.random_sample(3)), "Ks 0 0 0", "d 1"]
+        if n_textures:
+            lines.append("map_Kd ../images/texture_{}.jpg".format(i % n_textures))
+        materials[name] = lines
+    obj_file = os.path.join(model_dir, "models", "model_normalized.obj")
+    obj_io.write_mtl(obj_file.replace(".obj", ".mtl"), materials)
+    obj_io.write_obj(obj_file, mesh, mtllib="model_normalized.mtl")
+    return obj_file
+
+
+def make_dataset(root, n_models=20, n_centers=2, n_vertices=100000, n_parts=5, n_materials=4, n_textures=2,
+                 texture_bytes=1 << 16, triangles=False, seed=0):
+    '''
+    Writes n_models synthetic models under root, the first n_centers of them
+    hand annotated. Returns (model -> obj file, list of centers).
+    '''
+    model_files = OrderedDict()
+    centers = []
+    annotated_dir = os.path.join(root, "car_models_hand_annotated")
+    os.makedirs(annotated_dir, exist_ok=True)
+    for i in range(n_models):
+        model = "synthetic{:05d}".format(i)
+        mesh, part_masks = make_car(n_vertices, n_parts, n_materials, triangles, seed + i)
+        model_files[model] = write_model(os.path.join(root, CATEGORY, model), mesh, n_textures, texture_bytes,
+                                         seed + i)
+        if i < n_centers:
+            part_splitter.split_obj(model_files[model], part_masks, os.path.join(annotated_dir, model), mesh=mesh)
+            centers.append(model)
+    return model_files, centers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic ShapeNet-like car dataset.')
+    parser.add_argument('root', help='Folder to write the dataset to')
+    parser.add_argument('-m', '--models', type=int, default=20)
+    parser.add_argument('-c', '--centers', type=int, default=2, help='Number of hand annotated models')
+    parser.add_argument('-n', '--vertices', type=int, default=100000, help='Vertices per model (about)')
+    parser.add_argument('-p', '--parts', type=int, default=5)
+    parser.add_argument('--materials', type=int, default=4)
+    parser.add_argument('--textures', type=int, default=2)
+    parser.add_argument('--texture_kb', type=int, default=64)
+    parser.add_argument('--triangles', action='store_true', help='Triangles instead of quads')
+    args = parser.parse_args()
+    make_dataset(args.root, args.models, args.centers, args.vertices, args.parts, args.materials, args.textures,
+                 args.texture_kb * 1024, args.triangles)
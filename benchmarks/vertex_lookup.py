@@ -0,0 +1,106 @@
+'''
+Benchmark of the vertex lookups annotate.py does when it saves out a model that
+has both object and vertex annotations: picking the rows of the annotated
+vertices (get_vertex_coordinates) and finding them again in the re-imported
+mesh (save_vertices_to_obj_files).
+
+The old list based versions are quadratic, so they are timed on a sample of the
+vertices and scaled up to the full mesh.
+
+python benchmarks/vertex_lookup.py -n 500000
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import vertex_match
+
+PARTS = ["front_right", "front_left", "back_right", "back_left", "trunk"]
+
+
+def make_mesh(n_vertices, annotated_fraction, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = np.empty((n_vertices, 6), np.float32)
+    rows[:, :3] = rng.uniform(-1, 1, (n_vertices, 3))
+    # Split vertices: same position, different normal
+    rows[1::4, :3] = rows[0::4, :3][:len(rows[1::4])]
+    normals = rng.normal(size=(n_vertices, 3))
+    rows[:, 3:] = normals / np.linalg.norm(normals, axis=1, keepdims=True)
+    annotated = rng.choice(n_vertices, int(n_vertices * annotated_fraction), replace=False)
+    part_indices = dict(zip(PARTS, np.array_split(np.sort(annotated), len(PARTS))))
+    return rows, part_indices
+
+
+def round_trip(rows, seed=1):
+    # What export + import does to the vertices: 6 decimals, new order, recomputed normals
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(rows))
+    out = rows[order].copy()
+    out[:, :3] = np.round(out[:, :3], 6)
+    out[:, 3:] += rng.uniform(-1e-5, 1e-5, out[:, 3:].shape)
+    return out, order
+
+
+def old_coordinates(rows, part_indices, sample):
+    coords = {}
+    for part_type, indices in part_indices.items():
+        vert_indices = [int(x) for x in indices]
+        coords[part_type] = []
+        for index in range(sample):
+            if index in vert_indices:
+                coords[part_type].append(tuple(rows[index].tolist()))
+    return coords
+
+
+def old_match(rows, coords, sample):
+    verts = []
+    for part_type in coords:
+        part_coords = [tuple(c) for c in coords[part_type]]
+        for index in range(sample):
+            if tuple(rows[index].tolist()) in part_coords:
+                verts.append(index)
+    return verts
+
+
+def main(n_vertices, annotated_fraction, sample):
+    rows, part_indices = make_mesh(n_vertices, annotated_fraction)
+    reimported, order = round_trip(rows)
+    print("{} vertices, {} annotated".format(n_vertices, sum(len(x) for x in part_indices.values())))
+
+    start = time.time()
+    coords = {part: rows[indices] for part, indices in part_indices.items()}
+    new_coordinates = time.time() - start
+    start = time.time()
+    found = {part: np.flatnonzero(vertex_match.rows_in(reimported, c)) for part, c in coords.items()}
+    new_match = time.time() - start
+    for part, indices in part_indices.items():
+        expected = np.sort(np.flatnonzero(np.isin(order, indices)))
+        if not np.array_equal(found[part], expected):
+            print("Warning: {} matched {} vertices, expected {}".format(part, len(found[part]), len(expected)))
+
+    sample = min(sample, n_vertices)
+    start = time.time()
+    old_coordinates(rows, part_indices, sample)
+    old_coordinates_time = (time.time() - start) * n_vertices / sample
+    full_coords = {part: [tuple(r) for r in rows[indices].tolist()] for part, indices in part_indices.items()}
+    start = time.time()
+    old_match(rows, full_coords, sample)
+    old_match_time = (time.time() - start) * n_vertices / sample
+
+    print("{:<25}{:>12}{:>12}{:>10}".format("", "old (est.)", "new", "speedup"))
+    for name, old, new in [("get_vertex_coordinates", old_coordinates_time, new_coordinates),
+                           ("coordinate matching", old_match_time, new_match)]:
+        print("{:<25}{:>11.2f}s{:>11.3f}s{:>9.0f}x".format(name, old, new, old / max(new, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark annotate.py vertex lookups.')
+    parser.add_argument('-n', '--vertices', type=int, default=500000)
+    parser.add_argument('-a', '--annotated_fraction', type=float, default=0.1)
+    parser.add_argument('-s', '--sample', type=int, default=200,
+        help='Number of vertices the old implementation is timed on')
+    args = parser.parse_args()
+    main(args.vertices, args.annotated_fraction, args.sample)
@@ -0,0 +1,17 @@
+'''
+Writes the part bundles (see mesh_tools/part_bundle.py) of an export folder
+that was post-processed without --bundle:
+
+python export_tools/convert_to_bundles.py car_models_hand_annotated
+'''
+
+import argparse
+import utils
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bundle the exported parts of every model into one binary file.')
+    parser.add_argument('folder', help='Export folder, e.g. car_models_auto_annotated')
+    parser.add_argument('-m', '--models', nargs='+', help='Only bundle these models')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of processes')
+    args = parser.parse_args()
+    utils.convert_to_bundles(args.folder, args.models, args.workers)
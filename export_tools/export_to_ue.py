@@ -5,54 +5,121 @@ To do this, you will need to do the following:
 1. Enable both "Python Editor Script Plugin" and "Editor Scripting Utilities" in plugins
 2. Click "Window" -> "Developer Tools" -> "Output Log"
 3. Click "Cmd" and switch to "Python"
-4. Type in the full path of this script
+4. Type in the full path of this script (add --full to delete and re-import everything)
+
+The unreal module only exists inside the editor, so it is imported by the
+functions that need it and the rest can be used (and tested) outside.
 '''
 
-import unreal
 import glob
 import os
+import sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import build_manifest
+
+CAR_MODELS_DIRECTORY = '/home/mike/Projects/DIVA/car_models/car_models_hand_annotated'
+DESTINATION_PATH = '/Game/ShapenetManual'
+BATCH_SIZE = 50
+# Bump when build_import_options changes, so every asset is imported again
+IMPORT_SETTINGS_VERSION = 1
+
+def main(car_models_directory=CAR_MODELS_DIRECTORY, destination_path=DESTINATION_PATH, batch_size=BATCH_SIZE,
+         full=False):
+    '''
+    Imports the obj files of car_models_directory into destination_path
 
-def main():
-    car_models_directory = '/home/mike/Projects/DIVA/car_models/car_models_hand_annotated'
-    destination_path = '/Game/ShapenetManual'
+    Only files whose obj, mtl or textures changed since they were last
+    imported (or whose asset is gone from the project) are imported, in
+    batches of batch_size with the packages saved once per batch. The hashes
+    are kept in {car_models_directory}_ue_import.json. With full, the
+    destination is deleted and everything is imported again.
+    '''
+    import unreal
+    manifest = build_manifest.BuildManifest(car_models_directory.rstrip("/") + "_ue_import.json")
 
     # Get all obj files
     files_to_import = get_all_obj_files(car_models_directory)
+    assets = {asset_name(f): f for f in files_to_import}
 
-    # Delete existing
-    unreal.EditorAssetLibrary.delete_directory(directory_path=destination_path)
+    if full:
+        # Delete existing
+        unreal.EditorAssetLibrary.delete_directory(directory_path=destination_path)
+        manifest.outputs.clear()
+    else:
+        # Delete the assets whose obj file is gone
+        for asset in sorted(set(manifest.outputs) - set(assets)):
+            asset_path = "{}/{}".format(destination_path, asset)
+            if unreal.EditorAssetLibrary.does_asset_exist(asset_path):
+                unreal.EditorAssetLibrary.delete_asset(asset_path)
+            manifest.forget(asset)
+
+    inputs = {asset: manifest.inputs_hash(import_inputs(f), [destination_path, IMPORT_SETTINGS_VERSION])
+              for asset, f in assets.items()}
+    stale = [asset for asset in sorted(assets)
+             if not manifest.is_fresh(asset, inputs[asset])
+             or not unreal.EditorAssetLibrary.does_asset_exist("{}/{}".format(destination_path, asset))]
+    print("Importing {} assets ({} up to date)".format(len(stale), len(assets) - len(stale)))
+    batches = [stale[i:i + batch_size] for i in range(0, len(stale), batch_size)]
 
     # Create progress bar
-    with unreal.ScopedSlowTask(len(files_to_import), "Importing Assets") as slow_task:
+    with unreal.ScopedSlowTask(len(stale), "Importing Assets") as slow_task:
         slow_task.make_dialog(True)
-        for idx, file in enumerate(files_to_import):
+        imported = 0
+        for batch in batches:
             # Update progress bar
             if slow_task.should_cancel():
-                exit()
-            slow_task.enter_progress_frame(1, "Importing Assets ({}/{})".format(idx+1, len(files_to_import)))
+                break
+            slow_task.enter_progress_frame(len(batch), "Importing Assets ({}/{})".format(
+                imported + len(batch), len(stale)))
 
-            # Import mesh and textures
-            task = build_import_task(file, destination_path)
-            unreal.AssetToolsHelpers.get_asset_tools().import_asset_tasks([task])
+            # Import meshes and textures
+            tasks = [build_import_task(assets[asset], destination_path) for asset in batch]
+            unreal.AssetToolsHelpers.get_asset_tools().import_asset_tasks(tasks)
 
             # Save data
             unreal.EditorLoadingAndSavingUtils.save_dirty_packages(save_map_packages=False, save_content_packages=True)
+            for asset, task in zip(batch, tasks):
+                if task.get_editor_property('imported_object_paths'):
+                    manifest.record(asset, inputs[asset])
+                else:
+                    print("Failed to import {}".format(assets[asset]))
+            manifest.save()
+            imported += len(batch)
+    manifest.save()
+
+def asset_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
 
+def import_inputs(obj_file):
+    ''' The files an import of obj_file reads: the obj, its mtl and the textures of the mtl '''
+    files = [obj_file]
+    mtl_file = obj_file.replace(".obj", ".mtl")
+    if os.path.isfile(mtl_file):
+        files.append(mtl_file)
+        for l in open(mtl_file, 'r'):
+            words = l.split()
+            if len(words) > 1 and 'map_' in words[0]:
+                files.append(os.path.normpath(os.path.join(os.path.dirname(mtl_file), words[-1])))
+    return files
 
 def get_all_obj_files(directory):
     return sorted(glob.glob(os.path.join(directory, '*.obj')))
 
 def build_import_task(filename, destination):
+    import unreal
     task = unreal.AssetImportTask()
     task.set_editor_property('automated', True)
     task.set_editor_property('filename', filename)
     task.set_editor_property('destination_path', destination)
     task.set_editor_property('replace_existing', True)
-    task.set_editor_property('save', True)
+    # Packages are saved once per batch
+    task.set_editor_property('save', False)
     task.set_editor_property('options', build_import_options())
     return task
 
 def build_import_options():
+    import unreal
     options = unreal.FbxImportUI()
     # unreal.FbxImportUI
     options.set_editor_property('import_mesh', True)
@@ -70,4 +137,12 @@ def build_import_options():
     return options
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Import the annotated obj files into Unreal Engine.')
+    parser.add_argument('-d', '--directory', default=CAR_MODELS_DIRECTORY, help='Folder of the obj files')
+    parser.add_argument('--destination', default=DESTINATION_PATH, help='Content folder to import into')
+    parser.add_argument('-b', '--batch_size', type=int, default=BATCH_SIZE,
+        help='Number of files per import_asset_tasks call (packages are saved after each)')
+    parser.add_argument('--full', action='store_true',
+        help='Delete the destination and import everything, instead of only what changed')
+    args = parser.parse_args()
+    main(args.directory, args.destination, args.batch_size, args.full)
@@ -1,27 +1,192 @@
 import os
+import sys
 import shutil
 import glob
+import queue
+import argparse
+import threading
 import subprocess
 import utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import build_manifest
+import instrumentation
+import model_index
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "annotation_tools"))
+import annotation_store
 
-def main():
+BLENDER_SCRIPT = 'annotate_with_blender.py'
+WORKER_DONE = "WORKER_DONE"
+
+def main(workers=None, jobs_per_worker=50, incremental=False, bundles=False):
     folder = "car_models_hand_annotated"
-    remove_all_files(folder)
-    save_out_annotations(folder)
-    utils.correct_texture_paths(folder)
-    utils.add_metadata(folder)
+    manifest = build_manifest.BuildManifest(folder + "_build.json")
+    inputs = {model: annotation_inputs_hash(manifest, model) for model in get_annotated_models()}
+    if incremental:
+        models = remove_stale_files(folder, manifest, inputs)
+    else:
+        remove_all_files(folder)
+        manifest.outputs.clear()
+        models = set(inputs)
+    print("Saving out {} models ({} up to date)".format(len(models), len(inputs) - len(models)))
+    if not models:
+        return
+    failed = save_out_annotations(folder, workers, jobs_per_worker, models)
+    with instrumentation.span("postprocess", models=len(models)):
+        utils.postprocess(folder, models if incremental else None, remove_faceless=False, workers=workers,
+                          bundles=bundles)
+    for model in models:
+        if model not in failed:
+            manifest.record(model, inputs[model])
+    manifest.save()
 
 def remove_all_files(folder):
     if os.path.isdir(folder):
         shutil.rmtree(folder)
     os.mkdir(folder)
 
-def save_out_annotations(save_folder):
-    models_annotated = set(x.split("_")[0].split(".csv")[0].replace("annotations/", "") for x in glob.glob("annotations/*.csv"))
+def remove_model_files(folder, model):
+    for model_file in glob.glob("{}/{}_*".format(folder, model)) + glob.glob("{}/textures/{}_*".format(folder, model)):
+        os.remove(model_file)
+
+def annotation_inputs_hash(manifest, model):
+    # The ShapeNet model itself is left out, it never changes
+    files = glob.glob("annotations/{}/*.obj".format(model)) + [BLENDER_SCRIPT]
+    return manifest.inputs_hash(files, annotation_values(model))
+
+def annotation_values(model):
+    '''
+    The annotations of a model as (csv, part, members) lines. They are read
+    through the annotation store, so the hash doesn't change when its log is
+    compacted into the csv.
+    '''
+    values = []
+    for csv_path in ["annotations/{}.csv".format(model), "annotations/{}_objects.csv".format(model)]:
+        if not annotation_store.exists(csv_path):
+            continue
+        # Not open_store, which would compact the csv at exit
+        store = annotation_store.AnnotationStore(csv_path)
+        for part_type in store.part_types():
+            members = store.get(part_type)
+            members = members.tolist() if store.is_vertices else members
+            values.append("{} {} {}".format(os.path.basename(csv_path), part_type, " ".join(map(str, members))))
+    return values
+
+def remove_stale_files(folder, manifest, inputs):
+    '''
+    Deletes the output of models whose annotations changed or disappeared,
+    returns the models that need to be saved out again
+    '''
+    os.makedirs(folder, exist_ok=True)
+    for model in list(manifest.outputs):
+        if model not in inputs:
+            remove_model_files(folder, model)
+            manifest.forget(model)
+    stale = set(model for model, h in inputs.items() if not manifest.is_fresh(model, h))
+    for model in stale:
+        remove_model_files(folder, model)
+    return stale
+
+def get_annotated_models():
+    index = model_index.ModelIndex()
+    index.update_annotations("annotations")
+    return set(index.annotated())
+
+def save_out_annotations(save_folder, workers=None, jobs_per_worker=50, models=None):
+    '''
+    Exports the annotated models (all of them unless models is given) and
+    returns the ones that failed. Without workers each model gets its own
+    Blender process, otherwise a pool of long-lived Blender workers is used.
+    '''
+    models_annotated = get_annotated_models() if models is None else models
     print(models_annotated)
-    for model in models_annotated:
-        cmd = 'blender --background --python annotate_with_blender.py -- -m {} -a N -o N -s {}'.format(model, save_folder)
-        subprocess.call(cmd, shell=True)
+    if workers:
+        failed = save_out_annotations_with_workers(save_folder, models_annotated, workers, jobs_per_worker)
+    else:
+        failed = []
+        for model in models_annotated:
+            cmd = 'blender --background --python-exit-code 1 --python {} -- -m {} -a N -o N -s {}'.format(
+                BLENDER_SCRIPT, model, save_folder)
+            if subprocess.call(cmd, shell=True) != 0:
+                failed.append(model)
+    if failed:
+        print("Failed to save out {}".format(sorted(failed)))
+    return failed
+
+def start_worker(save_folder):
+    cmd = ['blender', '--background', '--python', BLENDER_SCRIPT, '--', '--worker', '-s', save_folder]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+def stop_worker(proc):
+    proc.stdin.close()
+    proc.wait()
+
+def run_in_worker(proc, model):
+    ''' Sends one model to a worker and waits for its answer, returns True if it saved out '''
+    try:
+        proc.stdin.write(model + "\n")
+        proc.stdin.flush()
+    except BrokenPipeError:
+        return False
+    for line in proc.stdout:
+        words = line.split(" ", 2)
+        if words[0] == WORKER_DONE and words[1] == model:
+            return words[2].strip() == "ok"
+    # Blender died on this model
+    return False
+
+def save_out_annotations_with_workers(save_folder, models, workers, jobs_per_worker):
+    '''
+    Hands the models out to a fixed number of Blender processes that stay up
+    between models. A worker is replaced after jobs_per_worker models (Blender
+    slowly leaks memory) or after a failure. Returns the models that failed.
+    '''
+    jobs = queue.Queue()
+    for model in models:
+        jobs.put(model)
+    failed = []
+
+    def work():
+        proc = None
+        jobs_done = 0
+        while True:
+            try:
+                model = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if proc is None:
+                proc = start_worker(save_folder)
+                jobs_done = 0
+            print("Saving out {}".format(model))
+            ok = run_in_worker(proc, model)
+            jobs_done += 1
+            if not ok:
+                failed.append(model)
+            if not ok or jobs_done >= jobs_per_worker:
+                stop_worker(proc)
+                proc = None
+        if proc is not None:
+            stop_worker(proc)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Save out the annotated models as obj files.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+        help='Number of long-lived Blender processes to use (default: one Blender launch per model)')
+    parser.add_argument('-j', '--jobs_per_worker', type=int, default=50,
+        help='Restart a Blender worker after this many models')
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help='Only save out the models whose annotations changed since the last run')
+    parser.add_argument('--trace', type=str,
+        help='Append timing and memory records of every stage (Blender workers included) to this json lines file')
+    parser.add_argument('--bundle', action='store_true',
+        help='Also write all parts of every model to one binary {model}_parts.bundle file')
+    args = parser.parse_args()
+    if args.trace is not None:
+        instrumentation.configure(args.trace)
+    main(args.workers, args.jobs_per_worker, args.incremental, args.bundle)
@@ -1,20 +1,36 @@
 import os
+import sys
 # import pymesh
 import glob
 import subprocess
 import numpy as np
 import shutil
 import json
+import re
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import geometry_cache
+import build_manifest
+import obj_io
+import instrumentation
+import part_bundle
+import model_index
+
+# ioctl number of FICLONE (linux/fs.h)
+FICLONE = 0x40049409
+
+PICKUP_MODELS_FILE = "pickup_models.json"
+# Pickups the text clustering misses
+EXTRA_PICKUP_MODELS = ['12f2905dc029f59a2479fbc7da5ed22b']
+METADATA_COLUMNS = ['model', 'part', 'hinge', 'rotation', 'bbox_min', 'bbox_max']
+
+USEMTL_LINE = re.compile(rb'^usemtl ([^\r\n]*)', re.M)
 
 def create_ply_files():
-    root_dir = './02958343'
     os.makedirs('ply_files', exist_ok=True)
-    for model_dir in sorted(glob.glob(root_dir + "/*")):
-        model_name = os.path.basename(model_dir)
-        model_file_obj = model_dir + "/models/model_normalized.obj"
-        if not os.path.isfile(model_file_obj):
-            continue
+    for model_name, model_file_obj in model_index.ModelIndex().model_files().items():
         model_file_ply = 'ply_files/{}.ply'.format(model_name)
         mesh = pymesh.load_mesh(model_file_obj)
         pymesh.save_mesh(model_file_ply, mesh, use_float=True)
@@ -28,15 +44,110 @@ def is_relative(im_path):
         return True
     return False
 
-def correct_texture_paths(folder):
+def model_files(folder, pattern, models=None):
+    ''' Files in folder matching pattern, only those of the given models if models isn't None '''
+    files = glob.glob("{}/{}".format(folder, pattern))
+    if models is None:
+        return files
+    return [f for f in files if os.path.basename(f).split("_")[0] in models]
+
+def is_up_to_date(src, dst):
+    if not os.path.isfile(dst):
+        return False
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime <= dst_stat.st_mtime
+
+def reflink(src, dst):
+    ''' Copy-on-write clone of src (btrfs, xfs), returns False where that isn't supported '''
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except (ImportError, OSError):
+        if os.path.isfile(dst):
+            os.remove(dst)
+        return False
+
+def stage_file(src, dst, link_to=None):
+    '''
+    Puts the contents of src at dst as cheaply as possible and returns the
+    number of bytes actually copied. link_to is an already staged file with
+    the same contents, on the same filesystem as dst.
+    '''
+    # Never write into an existing dst, it may be a hardlink to a source
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for existing in [link_to, src]:
+        if existing is None or os.stat(existing).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+            continue
+        try:
+            os.link(existing, dst)
+            return 0
+        except OSError:
+            pass
+    if reflink(src, dst):
+        return 0
+    shutil.copyfile(src, dst)
+    return os.path.getsize(dst)
+
+def stage_textures(copies, workers=8):
+    '''
+    Copies textures into place, copies is a dict of destination -> source
+
+    Every source is read once no matter how many parts of a model use it, and
+    sources with identical contents are staged once and hardlinked to the
+    other destinations. Files are hardlinked or reflinked from the source when
+    the filesystem allows it and copied otherwise, on a thread pool.
+    Returns (bytes copied, bytes saved).
+    '''
+    copies = {dst: src for dst, src in copies.items() if not is_up_to_date(src, dst)}
+    sources = sorted(set(copies.values()))
+    with ThreadPool(workers) as pool:
+        hashes = dict(zip(sources, pool.map(build_manifest.file_sha1, sources)))
+    groups = {}
+    for dst, src in sorted(copies.items()):
+        groups.setdefault(hashes[src], []).append((dst, src))
+
+    def stage_group(group):
+        first_dst, first_src = group[0]
+        copied = stage_file(first_src, first_dst)
+        for dst, src in group[1:]:
+            copied += stage_file(src, dst, link_to=first_dst)
+        return copied
+
+    with ThreadPool(workers) as pool:
+        copied = sum(pool.map(stage_group, list(groups.values())))
+    total = sum(os.path.getsize(src) for src in copies.values())
+    return copied, total - copied
+
+def resolve_texture_path(im_path_full, model_name):
+    ''' Finds the texture a map_ line points to, returns None if there's no such file '''
+    if os.path.isfile(im_path_full):
+        return im_path_full
+    im_path_guesses = [
+        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full),
+        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full).replace(".jpg", ".JPG"),
+        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full).replace(".JPG", ".jpg")
+    ]
+    for im_path_guess in im_path_guesses:
+        if os.path.isfile(im_path_guess):
+            print("Changing {} to {}".format(im_path_full, im_path_guess))
+            return im_path_guess
+    return None
+
+def correct_texture_paths(folder, models=None):
     '''
     Updates all materials and textures to have unique names
     Change the texture path in the mtl files to be relative
     Copies the texture files over to the new relative location
+
+    With models, only the files of those (freshly exported) models are touched
+    and the rest of the textures folder is kept.
     '''
 
     # Edit the materials in the obj files
-    for object_file in tqdm(glob.glob("{}/*.obj".format(folder)), ncols=100, desc="updating obj files"):
+    for object_file in tqdm(model_files(folder, "*.obj", models), ncols=100, desc="updating obj files"):
         model_name = object_file.split("/")[-1].split("_")[0]
         lines = [l for l in open(object_file, 'r')]
         for i, l in enumerate(lines):
@@ -52,13 +163,13 @@ def correct_texture_paths(folder):
 
     # Create path for texture ims
     texture_dir = "{}/textures".format(folder)
-    if os.path.isdir(texture_dir):
+    if os.path.isdir(texture_dir) and models is None:
         shutil.rmtree(texture_dir)
-    else:
-        os.makedirs(texture_dir)
+    os.makedirs(texture_dir, exist_ok=True)
+    texture_copies = {}
 
     # Edit the materials and image paths in the mtl files
-    for texture_file in tqdm(glob.glob("{}/*.mtl".format(folder)), ncols=100, desc="updating mtl files"):
+    for texture_file in tqdm(model_files(folder, "*.mtl", models), ncols=100, desc="updating mtl files"):
         model_name = texture_file.split("/")[-1].split("_")[0]
         lines = [l for l in open(texture_file, 'r')]
 
@@ -80,30 +191,24 @@ def correct_texture_paths(folder):
                 new_im_path = "./textures/{}_{}".format(model_name, os.path.basename(im_path_full))
 
                 # Change path to make sure it exists
-                if not os.path.isfile(im_path_full):
-                    im_path_guesses = [
-                        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full),
-                        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full).replace(".jpg", ".JPG"),
-                        "/home/mike/Projects/DIVA/car_models/02958343/{}/{}".format(model_name, im_path_full).replace(".JPG", ".jpg")
-                    ]
-                    for im_path_guess in im_path_guesses:
-                        if os.path.isfile(im_path_guess):
-                            print("Changing {} to {}".format(im_path_full, im_path_guess))
-                            im_path_full = im_path_guess
-                            break
-                if not os.path.isfile(im_path_full):
+                im_path_full = resolve_texture_path(im_path_full, model_name)
+                if im_path_full is None:
                     print(texture_file)
-                    print("No file at {}".format(im_path_full))
+                    print("No file at {}".format(words[1]))
                     exit()
 
-                # Copy file over
-                shutil.copyfile(im_path_full, "{}/{}_{}".format(texture_dir, model_name, os.path.basename(im_path_full)))
-                lines[i] = l.replace(im_path_full, new_im_path)
+                # Copy file over (after the loop)
+                texture_copies["{}/{}_{}".format(texture_dir, model_name, os.path.basename(im_path_full))] = im_path_full
+                lines[i] = l.replace(words[1], new_im_path)
 
         # Edit texture file
         with open(texture_file, 'w') as f:
             f.writelines(lines)
 
+    copied, saved = stage_textures(texture_copies)
+    print("Staged textures: {:.1f} MB copied, {:.1f} MB saved by deduplicating and linking".format(
+        copied / 1e6, saved / 1e6))
+
 def check_texture_paths(folder):
     for texture_file in glob.glob("{}/*.mtl".format(folder)):
         lines = [l for l in open(texture_file, 'r')]
@@ -116,62 +221,178 @@ def check_texture_paths(folder):
             if "DIVA" in words[1]:
                 print("Not relative at {}".format(words[1]))
 
-def add_metadata(folder):
-    import cluster_on_text
+def get_pickup_models(cache_file=PICKUP_MODELS_FILE):
+    '''
+    Set of the pickup truck models, their trunk opens the other way. The
+    text clustering is only run again when cluster_on_text changed since
+    cache_file was written. Without cluster_on_text the cached list is used
+    as it is.
+    '''
+    try:
+        import cluster_on_text
+    except ImportError:
+        cluster_on_text = None
+    inputs = None
+    if cluster_on_text is not None:
+        inputs = build_manifest.inputs_hash(
+            build_manifest.FileHashes(), [cluster_on_text.__file__], EXTRA_PICKUP_MODELS)
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        # Files from before the inputs hash are a plain list
+        if not isinstance(cached, dict):
+            cached = {'inputs': None, 'models': cached}
+        if cluster_on_text is None or cached['inputs'] == inputs:
+            return set(cached['models'])
+    if cluster_on_text is None:
+        raise ImportError("cluster_on_text is needed to find the pickup models, there is no {}".format(cache_file))
+    pickup_models = []
     for c in cluster_on_text.cluster():
         if 'pickup' in c['name']:
-            pickup_models = c['models']
-    pickup_models.append('12f2905dc029f59a2479fbc7da5ed22b')
+            pickup_models += c['models']
+    pickup_models = sorted(set(pickup_models + EXTRA_PICKUP_MODELS))
+    if cache_file is not None:
+        data = json.dumps({'inputs': inputs, 'models': pickup_models})
+        atomic_write(cache_file, lambda f: f.write(data.encode('utf-8')))
+    return set(pickup_models)
+
+def model_metadata(parts, part_vertices, is_pickup):
+    '''
+    Hinge points, rotation axes and bounding boxes of all the parts of a model
+    at once
+
+    parts is a list of part names and part_vertices the matching list of
+    (N, 3) vertex arrays. The car body and empty parts are skipped. Returns a
+    dict of columns (see METADATA_COLUMNS), all points are in the (x, -z, y)
+    frame of the metadata files.
+    '''
+    keep = [i for i, part in enumerate(parts) if part != "car_body" and len(part_vertices[i])]
+    parts = [parts[i] for i in keep]
+    n_parts = len(parts)
+    if n_parts == 0:
+        return empty_metadata()
+    rotations = np.zeros((n_parts, 3), np.int8)
+    for i, part in enumerate(parts):
+        if part == "trunk":
+            rotations[i] = [-1, 0, 0] if is_pickup else [1, 0, 0]
+        elif 'right' in part:
+            rotations[i] = [0, 0, -1]
+        elif 'left' in part:
+            rotations[i] = [0, 0, 1]
+        else:
+            raise ValueError("Don't know part {}".format(part))
+
+    # One contiguous column per axis with the parts back to back
+    counts = np.array([len(part_vertices[i]) for i in keep])
+    vertices = np.concatenate([part_vertices[i] for i in keep]).astype(np.float32)
+    columns = np.ascontiguousarray(vertices.T)
+    part_of = np.repeat(np.arange(n_parts), counts)
+    first = np.zeros(n_parts, np.int64)
+    np.cumsum(counts[:-1], out=first[1:])
+    low = np.minimum.reduceat(columns, first, axis=1).T
+    high = np.maximum.reduceat(columns, first, axis=1).T
+    # Medians are a linear time selection per part, there are only a handful of parts
+    medians = np.array([[np.median(c) for c in np.split(columns[axis], first[1:])] for axis in range(2)],
+                       np.float32).T
+
+    # Trunks hinge at the top (bottom for pickups) of their front edge, doors at the middle
+    is_trunk = np.array([part == "trunk" for part in parts])
+    target = np.stack([medians[:, 0], medians[:, 1], low[:, 2]], axis=1)
+    target[is_trunk, 1] = low[is_trunk, 1] if is_pickup else high[is_trunk, 1]
+    distance = np.zeros(len(vertices), np.float32)
+    for axis in range(3):
+        distance += np.abs(columns[axis] - np.repeat(target[:, axis], counts))
+    # First vertex at the smallest distance in every part, like np.argmin
+    closest = np.flatnonzero(distance == np.minimum.reduceat(distance, first)[part_of])
+    hinges = vertices[closest[np.searchsorted(part_of[closest], np.arange(n_parts))]]
+
+    return {
+        'part': np.array(parts, dtype=str),
+        'hinge': to_metadata_frame(hinges),
+        'rotation': rotations,
+        'bbox_min': to_metadata_frame(np.stack([low[:, 0], low[:, 1], high[:, 2]], axis=1)),
+        'bbox_max': to_metadata_frame(np.stack([high[:, 0], high[:, 1], low[:, 2]], axis=1)),
+    }
+
+def to_metadata_frame(points):
+    return np.stack([points[:, 0], -points[:, 2], points[:, 1]], axis=1).astype(np.float32)
+
+def empty_metadata():
+    return {
+        'part': np.zeros(0, dtype=str),
+        'hinge': np.zeros((0, 3), np.float32),
+        'rotation': np.zeros((0, 3), np.int8),
+        'bbox_min': np.zeros((0, 3), np.float32),
+        'bbox_max': np.zeros((0, 3), np.float32),
+    }
+
+def metadata_json(metadata):
+    ''' The {model}_metadata.json contents of a model_metadata result '''
+    return {
+        part: {
+            'hinge_x': float(hinge[0]),
+            'hinge_y': float(hinge[1]),
+            'hinge_z': float(hinge[2]),
+            'rotation': rotation.tolist(),
+        }
+        for part, hinge, rotation in zip(metadata['part'], metadata['hinge'], metadata['rotation'])
+    }
+
+def metadata_table_path(folder):
+    return "{}_metadata.npz".format(folder.rstrip("/"))
+
+def load_metadata_table(table_file):
+    '''
+    Dataset-wide metadata as a dict of columns, one row per part: model,
+    part, hinge (N, 3), rotation (N, 3), bbox_min (N, 3), bbox_max (N, 3)
+    '''
+    if not os.path.isfile(table_file):
+        table = empty_metadata()
+        table['model'] = np.zeros(0, dtype=str)
+        return table
+    with np.load(table_file) as data:
+        return {column: data[column] for column in METADATA_COLUMNS}
 
-    models_annotated = set(x.split("/")[-1].split("_")[0] for x in glob.glob(folder + "/*") if os.path.isfile(x))
+def save_metadata_table(table_file, model_tables, models=None):
+    '''
+    Writes the metadata of every model in model_tables (model -> columns) to
+    the dataset table. With models, the rows of the other models already in
+    the table are kept.
+    '''
+    tables = []
+    if models is not None:
+        old = load_metadata_table(table_file)
+        kept = ~np.isin(old['model'], list(set(models) | set(model_tables)))
+        tables.append({column: values[kept] for column, values in old.items()})
+    for model_name in sorted(model_tables):
+        table = dict(model_tables[model_name])
+        table['model'] = np.full(len(table['part']), model_name)
+        tables.append(table)
+    columns = {}
+    for column in METADATA_COLUMNS:
+        values = [t[column] for t in tables if len(t[column])]
+        columns[column] = np.concatenate(values) if values else empty_metadata().get(column, np.zeros(0, dtype=str))
+    for column in ['model', 'part']:
+        columns[column] = columns[column].astype(str)
+    atomic_write(table_file, lambda f: np.savez(f, **columns))
+
+def add_metadata(folder, models=None, json_metadata=True):
+    pickup_models = get_pickup_models()
+
+    models_annotated = set(x.split("/")[-1].split("_")[0] for x in model_files(folder, "*.obj", models))
+    model_tables = {}
     for model_name in tqdm(models_annotated, desc="Adding metadata", ncols=100):
-        json_dict = {}
-        for part_file in glob.glob("{}/{}*.obj".format(folder, model_name)):
-            # print(part_file)
-            part = os.path.basename(part_file).replace(".obj", "").replace(model_name + "_", "")
-            vertices = []
-            with open(part_file, "r") as f:
-                for line in f.readlines():
-                    if line[:2] == "v ":
-                        vertices.append(np.array([float(x) for x in line.replace("v ", "").replace("\n", "").split(" ")]))
-            if len(vertices) == 0:
-                continue
-            vertices = np.stack(vertices)
-            # print("min z (front of car): ", vertices[np.argmin(vertices[:,2])])
-            # print("median y (up and down): ", np.median(vertices[:,1]))
-            max_z = np.max(vertices[:,2])
-            min_z = np.min(vertices[:,2])
-            max_y = np.max(vertices[:,1])
-            min_y = np.min(vertices[:,1])
-            median_y = np.median(vertices[:,1])
-            median_x = np.median(vertices[:,0])
-            if part == "trunk" and model_name not in pickup_models:
-                best_point = np.argmin(np.sum(np.abs(vertices[:,:] - np.array([median_x, max_y, min_z])), 1))
-                rotation = [1, 0, 0]
-            elif part == "trunk" and model_name in pickup_models:
-                best_point = np.argmin(np.sum(np.abs(vertices[:,:] - np.array([median_x, min_y, min_z])), 1))
-                rotation = [-1, 0, 0]
-            elif part == "car_body":
-                continue
-            else:
-                best_point = np.argmin(np.sum(np.abs(vertices[:,:] - np.array([median_x, median_y, min_z])), 1))
-                if 'right' in part:
-                    rotation = [0, 0, -1]
-                elif 'left' in part:
-                    rotation = [0, 0, 1]
-                else:
-                    raise ValueError("Don't know part {}".format(part))
-            json_dict[part] = {
-                'hinge_x': vertices[best_point][0],
-                'hinge_y': -vertices[best_point][2],
-                'hinge_z': vertices[best_point][1],
-                'rotation': rotation,
-            }
-        with open("{}/{}_metadata.json".format(folder, model_name), 'w') as fp:
-            json.dump(json_dict, fp)
-
-def remove_faceless_models(folder):
-    for obj_file in glob.glob("{}/*.obj".format(folder)):
+        part_files = sorted(glob.glob("{}/{}*.obj".format(folder, model_name)))
+        parts = [os.path.basename(f).replace(".obj", "").replace(model_name + "_", "") for f in part_files]
+        vertices = [geometry_cache.load_vertices(f) for f in part_files]
+        model_tables[model_name] = model_metadata(parts, vertices, model_name in pickup_models)
+        if json_metadata:
+            with open("{}/{}_metadata.json".format(folder, model_name), 'w') as fp:
+                json.dump(metadata_json(model_tables[model_name]), fp)
+    save_metadata_table(metadata_table_path(folder), model_tables, models)
+
+def remove_faceless_models(folder, models=None):
+    for obj_file in model_files(folder, "*.obj", models):
         has_face = False
         lines = [l for l in open(obj_file, 'r')]
         for i, l in enumerate(lines):
@@ -184,6 +405,206 @@ def remove_faceless_models(folder):
             os.remove(obj_file)
             os.remove(obj_file.replace(".obj", ".mtl"))
 
+def bundle_path(folder, model_name):
+    ''' All parts of a model in one file next to its obj files, read it with part_bundle.PartBundle '''
+    return "{}/{}{}".format(folder, model_name, part_bundle.BUNDLE_SUFFIX)
+
+def bundle_job(job):
+    folder, model_name, obj_files, metadata = job
+    part_bundle.bundle_model(bundle_path(folder, model_name), obj_files, metadata)
+
+def convert_to_bundles(folder, models=None, workers=None):
+    '''
+    Writes the part bundles of an export folder that was post-processed
+    without them, with the metadata of the dataset table
+    '''
+    obj_files = {}
+    for obj_file in model_files(folder, "*.obj", models):
+        obj_files.setdefault(os.path.basename(obj_file).split("_")[0], []).append(obj_file)
+    table = load_metadata_table(metadata_table_path(folder))
+    jobs = []
+    for model_name, files in sorted(obj_files.items()):
+        rows = table['model'] == model_name
+        jobs.append((folder, model_name, files, {column: table[column][rows] for column in METADATA_COLUMNS[1:]}))
+    with Pool(workers) as pool:
+        for _ in tqdm(pool.imap_unordered(bundle_job, jobs), total=len(jobs), ncols=100, desc="Bundling models"):
+            pass
+
+def atomic_write(file_name, write):
+    ''' Calls write(f) on a temporary file and moves it over file_name once it's complete '''
+    tmp = "{}.tmp{}".format(file_name, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, file_name)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+def rewrite_obj(obj_file, model_name, keep_faceless=True):
+    '''
+    Prefixes the material names of an obj file with the model name in one
+    streaming pass. Returns whether the file has faces and its vertices. A
+    file without faces is left alone unless keep_faceless (it is about to be
+    removed otherwise).
+    '''
+    def rename(match):
+        name = match.group(1)
+        if model_name.encode('utf-8') in name:
+            return match.group(0)
+        return b"usemtl " + model_name.encode('utf-8') + b"_" + name
+
+    tmp = "{}.tmp{}".format(obj_file, os.getpid())
+    has_face = False
+    vertices = []
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in obj_io.iter_chunks(obj_file):
+                has_face = has_face or chunk.startswith(b"f ") or b"\nf " in chunk
+                vertices.append(obj_io.chunk_vertices(chunk))
+                f.write(USEMTL_LINE.sub(rename, chunk))
+        if has_face or keep_faceless:
+            os.replace(tmp, obj_file)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+    vertices = np.concatenate(vertices) if vertices else np.zeros((0, 3), np.float32)
+    return has_face, vertices
+
+def rewrite_mtl(mtl_file, model_name, texture_dir):
+    '''
+    Prefixes the material names of an mtl file with the model name and points
+    its textures at texture_dir. Returns the texture copies to make (dict of
+    destination -> source) and the texture paths that don't exist.
+    '''
+    copies = {}
+    missing = []
+    lines = [l for l in open(mtl_file, 'r')]
+    for i, l in enumerate(lines):
+        words = l.replace('\n','').split(' ')
+
+        # Change the material name
+        if words[0] == 'newmtl':
+            if model_name not in words[1]:
+                lines[i] = l.replace(words[1], model_name + "_" + words[1])
+
+        # Change the texture image path
+        if 'map_' in words[0]:
+            new_im_path = "./textures/{}_{}".format(model_name, os.path.basename(words[1]))
+            im_path_full = resolve_texture_path(words[1], model_name)
+            if im_path_full is None:
+                missing.append(words[1])
+                continue
+            copies["{}/{}_{}".format(texture_dir, model_name, os.path.basename(im_path_full))] = im_path_full
+            lines[i] = l.replace(words[1], new_im_path)
+
+    atomic_write(mtl_file, lambda f: f.write("".join(lines).encode('utf-8')))
+    return copies, missing
+
+def postprocess_model(job):
+    '''
+    Everything correct_texture_paths, add_metadata and remove_faceless_models
+    do to one model, reading each of its files once
+    '''
+    folder, model_name, obj_files, is_pickup, remove_faceless, json_metadata, bundle = job
+    texture_dir = "{}/textures".format(folder)
+    copies, missing = {}, []
+    parts, part_vertices, part_files = [], [], []
+    with instrumentation.context(model=model_name):
+        with instrumentation.span("fix_textures") as counts:
+            for obj_file in sorted(obj_files):
+                mtl_file = obj_file.replace(".obj", ".mtl")
+                has_face, vertices = rewrite_obj(obj_file, model_name, keep_faceless=not remove_faceless)
+                if not has_face and remove_faceless:
+                    print("Removing {}".format(obj_file))
+                    os.remove(obj_file)
+                    if os.path.isfile(mtl_file):
+                        os.remove(mtl_file)
+                    continue
+                if os.path.isfile(mtl_file):
+                    mtl_copies, mtl_missing = rewrite_mtl(mtl_file, model_name, texture_dir)
+                    copies.update(mtl_copies)
+                    missing += ["{}: {}".format(mtl_file, m) for m in mtl_missing]
+                parts.append(os.path.basename(obj_file).replace(".obj", "").replace(model_name + "_", ""))
+                part_vertices.append(vertices)
+                part_files.append(obj_file)
+            counts['files'] = len(obj_files)
+            counts['removed'] = len(obj_files) - len(parts)
+            counts['bytes_written'] = instrumentation.file_bytes(
+                list(obj_files) + [f.replace(".obj", ".mtl") for f in obj_files])
+        with instrumentation.span("metadata") as counts:
+            metadata = model_metadata(parts, part_vertices, is_pickup)
+            if json_metadata:
+                atomic_write("{}/{}_metadata.json".format(folder, model_name),
+                             lambda f: f.write(json.dumps(metadata_json(metadata)).encode('utf-8')))
+            counts['parts'] = len(parts)
+            counts['vertices'] = int(sum(len(v) for v in part_vertices))
+        if bundle:
+            with instrumentation.span("bundle") as counts:
+                part_bundle.bundle_model(bundle_path(folder, model_name), part_files, metadata)
+                counts['bytes_written'] = instrumentation.file_bytes([bundle_path(folder, model_name)])
+    return model_name, copies, missing, metadata
+
+def postprocess(folder, models=None, remove_faceless=True, workers=None, json_metadata=True, bundles=False):
+    '''
+    Fused, parallel version of correct_texture_paths, add_metadata and (with
+    remove_faceless) remove_faceless_models
+
+    Every model is handled by one worker that streams each of its obj and mtl
+    files once, renaming materials, collecting the textures to copy, dropping
+    faceless parts and computing the hinge metadata on the way. Files are
+    replaced atomically, so an interrupted run never leaves half written
+    files behind. With models, only the files of those models are touched.
+
+    The metadata of all models ends up in one table next to the folder (see
+    load_metadata_table), the per-model json files are only written with
+    json_metadata. With bundles, every model also gets a part bundle (see
+    bundle_path).
+    '''
+    obj_files = {}
+    for obj_file in model_files(folder, "*.obj", models):
+        obj_files.setdefault(os.path.basename(obj_file).split("_")[0], []).append(obj_file)
+    pickup_models = get_pickup_models()
+
+    # Create path for texture ims
+    texture_dir = "{}/textures".format(folder)
+    if os.path.isdir(texture_dir) and models is None:
+        shutil.rmtree(texture_dir)
+    os.makedirs(texture_dir, exist_ok=True)
+
+    jobs = [(folder, model_name, files, model_name in pickup_models, remove_faceless, json_metadata, bundles)
+            for model_name, files in sorted(obj_files.items())]
+    texture_copies = {}
+    missing = []
+    model_tables = {}
+    # Blender can't be forked, inside it (automatic_annotation without workers) the models go one by one
+    pool = None if (workers is not None and workers <= 1) or 'bpy' in sys.modules else Pool(workers)
+    results = pool.imap_unordered(postprocess_model, jobs) if pool is not None else map(postprocess_model, jobs)
+    try:
+        for model_name, copies, model_missing, metadata in tqdm(results, total=len(jobs), ncols=100,
+                                                                desc="Post-processing models"):
+            texture_copies.update(copies)
+            missing += model_missing
+            model_tables[model_name] = metadata
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if models is not None:
+        # Models deleted from the folder since the last run drop out of the table as well
+        exported = set(os.path.basename(f).split("_")[0] for f in glob.glob("{}/*.obj".format(folder)))
+        models = set(models) | (set(load_metadata_table(metadata_table_path(folder))['model']) - exported)
+    save_metadata_table(metadata_table_path(folder), model_tables, models)
+    if missing:
+        for m in missing:
+            print("No file at {}".format(m))
+        exit()
+
+    with instrumentation.span("stage_textures", textures=len(texture_copies)) as counts:
+        copied, saved = stage_textures(texture_copies)
+        counts['bytes_written'] = copied
+    print("Staged textures: {:.1f} MB copied, {:.1f} MB saved by deduplicating and linking".format(
+        copied / 1e6, saved / 1e6))
+
 
 if __name__ == '__main__':
     # correct_texture_paths("car_models_hand_annotated")
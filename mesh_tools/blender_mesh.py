@@ -0,0 +1,476 @@
+'''
+Fast obj import for Blender, in place of bpy.ops.import_scene.obj.
+
+The obj is parsed with obj_io (through geometry_cache, so a model imported
+again costs no parse at all) and the mesh datablocks are filled with
+foreach_set on vertices, loops and polygons, so there is no per-vertex python
+work. The result is what the obj importer builds with its default settings:
+
+- one object named after the file, or with separate_objects one object per
+  o / g name (faces of the same name go to the same object), with only the
+  vertices its faces use, in order of first use
+- the usemtl materials of the mtl files, with Kd, Ks, Ns, d and the map_Kd,
+  map_Bump and map_d images (a missing image is kept as a placeholder with
+  its path, like the importer does)
+- one uv layer and the obj normals as custom split normals
+- the object matrix turning obj space (-Z forward, Y up) into Blender space,
+  so mesh coordinates are the file's coordinates
+
+separate_parts is the other way around: it reads a mesh back with
+foreach_get and splits it into part objects in one pass, the way selecting
+each part's vertices and running bpy.ops.mesh.separate does (see
+part_splitter), without going through edit mode once per part.
+
+export_obj writes objects to an obj/mtl pair the way
+bpy.ops.export_scene.obj does with its default settings (object transforms
+applied and turned back into obj space, uvs and normals deduplicated,
+materials with absolute texture paths), through obj_io's block formatting
+instead of a python loop over faces.
+
+This is the one module of mesh_tools that needs bpy. It is written against
+the Blender 2.79 API, with fallbacks for 2.8.
+'''
+
+import os
+from collections import OrderedDict
+import numpy as np
+import bpy
+from bpy_extras.io_utils import axis_conversion
+from bpy_extras.image_utils import load_image
+import obj_io
+import geometry_cache
+import part_splitter
+
+
+def import_obj(obj_file, separate_objects=False, mesh=None):
+    '''
+    Imports an obj file into the scene, returns the new objects
+
+    mesh can be passed in when the obj file has already been read.
+    '''
+    if mesh is None:
+        mesh = geometry_cache.load_obj(obj_file)
+    materials = load_materials(obj_file, mesh)
+    file_name = os.path.splitext(os.path.basename(obj_file))[0]
+    counts = np.diff(mesh.face_offsets)
+    # Blender polygons need three corners
+    faces = counts >= 3
+
+    if not separate_objects:
+        pieces = [(file_name, faces)]
+    else:
+        # Group ids -> ids of their names, faces before any o / g line are named after the file
+        names = []
+        group_names = np.empty(len(mesh.groups) + 1, np.int64)
+        for i, group in enumerate(list(mesh.groups) + [file_name]):
+            group = group or file_name
+            if group not in names:
+                names.append(group)
+            group_names[i] = names.index(group)
+        face_names = group_names[mesh.face_groups]
+        used, first = np.unique(face_names[faces], return_index=True)
+        pieces = [(names[i], faces & (face_names == i)) for i in used[np.argsort(first)]]
+
+    matrix = axis_conversion(from_forward='-Z', from_up='Y').to_4x4()
+    objects = []
+    for name, face_mask in pieces:
+        ref_mask = np.repeat(face_mask, counts)
+        face_vertices = mesh.face_vertices[ref_mask]
+        if separate_objects:
+            vertices, face_vertices = _first_use(mesh.vertices, face_vertices)
+        else:
+            vertices = mesh.vertices
+        face_materials = mesh.face_materials[face_mask]
+        slots = np.unique(face_materials[face_materials >= 0])
+        slot_of = np.zeros(len(mesh.materials) + 1, np.int32)
+        slot_of[slots] = np.arange(len(slots))
+        me = new_mesh(
+            name, vertices, counts[face_mask], face_vertices,
+            uvs=_corner_values(mesh.uvs, mesh.face_uvs[ref_mask]),
+            normals=_corner_values(mesh.normals, mesh.face_normals[ref_mask]),
+            face_materials=slot_of[face_materials],
+            materials=[materials[i] for i in slots])
+        obj = bpy.data.objects.new(name, me)
+        link_object(obj)
+        obj.matrix_world = matrix
+        objects.append(obj)
+    return objects
+
+
+def new_mesh(name, vertices, face_counts, face_vertices, uvs=None, normals=None, face_materials=None,
+             materials=()):
+    '''
+    Returns a new mesh datablock made of numpy arrays
+
+    Faces are flat like in obj_io.ObjMesh: face i has face_counts[i] corners
+    and the corners of all faces are listed in face_vertices. uvs and normals
+    are given per corner, face_materials are indices into materials.
+    '''
+    n_corners = len(face_vertices)
+    loop_starts = np.zeros(len(face_counts), np.int32)
+    np.cumsum(face_counts[:-1], out=loop_starts[1:])
+
+    me = bpy.data.meshes.new(name)
+    me.vertices.add(len(vertices))
+    me.vertices.foreach_set("co", np.ascontiguousarray(vertices, np.float32).ravel())
+    me.loops.add(n_corners)
+    me.loops.foreach_set("vertex_index", np.ascontiguousarray(face_vertices, np.int32))
+    me.polygons.add(len(face_counts))
+    me.polygons.foreach_set("loop_start", loop_starts)
+    me.polygons.foreach_set("loop_total", np.ascontiguousarray(face_counts, np.int32))
+    for material in materials:
+        me.materials.append(material)
+    if face_materials is not None and len(materials):
+        me.polygons.foreach_set("material_index", np.ascontiguousarray(face_materials, np.int32))
+    if uvs is not None:
+        if hasattr(me, 'uv_textures'):
+            me.uv_textures.new()
+        else:
+            me.uv_layers.new()
+        me.uv_layers[0].data.foreach_set("uv", np.ascontiguousarray(uvs, np.float32).ravel())
+    if normals is not None:
+        me.create_normals_split()
+        me.loops.foreach_set("normal", np.ascontiguousarray(normals, np.float32).ravel())
+
+    me.validate(clean_customdata=False)
+    me.update(calc_edges=True)
+
+    if normals is not None:
+        # validate may have dropped bad faces, so read the normals back per remaining loop
+        loop_normals = np.empty(len(me.loops) * 3, np.float32)
+        me.loops.foreach_get("normal", loop_normals)
+        me.polygons.foreach_set("use_smooth", np.ones(len(me.polygons), bool))
+        me.normals_split_custom_set(loop_normals.reshape(-1, 3))
+        me.use_auto_smooth = True
+    return me
+
+
+def mesh_arrays(me):
+    '''
+    Returns the obj_io.ObjMesh of a Blender mesh, read with foreach_get
+
+    uvs and normals are per face corner (face_uvs and face_normals just
+    count up), face_materials are material slots. The object has to be in
+    object mode for the data to be current.
+    '''
+    n_loops = len(me.loops)
+    vertices = np.empty(len(me.vertices) * 3, np.float32)
+    me.vertices.foreach_get("co", vertices)
+    loop_vertices = np.empty(n_loops, np.int32)
+    me.loops.foreach_get("vertex_index", loop_vertices)
+    loop_starts = np.empty(len(me.polygons), np.int32)
+    me.polygons.foreach_get("loop_start", loop_starts)
+    loop_totals = np.empty(len(me.polygons), np.int32)
+    me.polygons.foreach_get("loop_total", loop_totals)
+    face_materials = np.empty(len(me.polygons), np.int32)
+    me.polygons.foreach_get("material_index", face_materials)
+
+    # Loops in polygon order
+    face_offsets = np.zeros(len(loop_totals) + 1, np.int64)
+    np.cumsum(loop_totals, out=face_offsets[1:])
+    loops = np.repeat(loop_starts - face_offsets[:-1], loop_totals) + np.arange(face_offsets[-1])
+    uvs = np.zeros((0, 2), np.float32)
+    if len(me.uv_layers):
+        uvs = np.empty(n_loops * 2, np.float32)
+        me.uv_layers.active.data.foreach_get("uv", uvs)
+        uvs = uvs.reshape(-1, 2)[loops]
+    me.calc_normals_split()
+    normals = np.empty(n_loops * 3, np.float32)
+    me.loops.foreach_get("normal", normals)
+    corners = np.arange(len(loops), dtype=np.int64)
+    return obj_io.ObjMesh(
+        vertices.reshape(-1, 3),
+        uvs=uvs,
+        normals=normals.reshape(-1, 3)[loops],
+        face_offsets=face_offsets,
+        face_vertices=loop_vertices[loops].astype(np.int64),
+        face_uvs=corners if len(uvs) else np.full(len(loops), -1, np.int64),
+        face_normals=corners,
+        face_materials=face_materials,
+        face_groups=np.zeros(len(loop_totals), np.int32),
+        materials=[m.name if m is not None else "" for m in me.materials],
+    )
+
+
+def separate_parts(obj, part_masks):
+    '''
+    Splits obj into one object per part, returns an ordered dict of part ->
+    object
+
+    part_masks is an ordered dict of part -> boolean vertex mask (see
+    part_splitter.masks_from_boxes / masks_from_labels). Parts take the faces
+    that are entirely theirs in order, parts without faces are left out, and
+    obj keeps the faces left over (part_splitter.REMAINDER in the result).
+    Material slots and the object matrix are kept.
+    '''
+    me = obj.data
+    mesh = mesh_arrays(me)
+    materials = list(me.materials)
+    objects = OrderedDict()
+    for part_type, faces in part_splitter.face_masks(mesh, part_masks).items():
+        part = part_splitter.submesh(mesh, faces)
+        part_me = new_mesh(
+            part_type, part.vertices, np.diff(part.face_offsets), part.face_vertices,
+            uvs=part.uvs[part.face_uvs] if len(part.uvs) else None,
+            normals=part.normals[part.face_normals],
+            face_materials=part.face_materials,
+            materials=materials)
+        if part_type == part_splitter.REMAINDER:
+            obj.data = part_me
+            bpy.data.meshes.remove(me, do_unlink=True)
+            objects[part_type] = obj
+            continue
+        part_obj = bpy.data.objects.new(part_type, part_me)
+        link_object(part_obj)
+        part_obj.matrix_world = obj.matrix_world.copy()
+        objects[part_type] = part_obj
+    return objects
+
+
+def export_obj(obj_file, objects):
+    '''
+    Writes the mesh objects to obj_file and its mtl file, returns the two
+    files. Every object gets its own o line, materials are shared by name.
+    '''
+    mtl_file = os.path.splitext(obj_file)[0] + ".mtl"
+    to_obj = np.array(axis_conversion(to_forward='-Z', to_up='Y').to_4x4())
+    parts = []
+    materials = OrderedDict()
+    for obj in objects:
+        if obj.type != 'MESH':
+            continue
+        mesh = mesh_arrays(obj.data)
+        _transform(mesh, to_obj.dot(np.array(obj.matrix_world)))
+        slots = np.zeros(len(mesh.materials) + 1, np.int32) - 1
+        for i, material in enumerate(obj.data.materials):
+            if material is not None:
+                materials.setdefault(material.name, material)
+                slots[i] = list(materials).index(material.name)
+        # Faces of empty or missing slots have no material
+        mesh.face_materials = slots[np.clip(mesh.face_materials, -1, len(mesh.materials))]
+        parts.append((obj.name, mesh))
+
+    mesh = _concatenate(parts, list(materials))
+    obj_io.write_mtl(mtl_file, OrderedDict(
+        (name, material_lines(material)) for name, material in materials.items()))
+    obj_io.write_obj(obj_file, mesh, mtllib=os.path.basename(mtl_file), write_groups=True)
+    return [obj_file, mtl_file]
+
+
+def material_lines(material):
+    ''' The mtl lines of a material, as the obj exporter writes them '''
+    if not hasattr(material, 'texture_slots'):
+        return _node_material_lines(material)
+    lines = [
+        "Ns {:.6f}".format((material.specular_hardness - 1) / 0.51),
+        "Ka {0:.6f} {0:.6f} {0:.6f}".format(material.ambient * _world_ambient()),
+        "Kd {:.6f} {:.6f} {:.6f}".format(*[material.diffuse_intensity * c for c in material.diffuse_color]),
+        "Ks {:.6f} {:.6f} {:.6f}".format(*[material.specular_intensity * c for c in material.specular_color]),
+        "Ke {:.6f} {:.6f} {:.6f}".format(*[material.emit * c for c in material.diffuse_color]),
+        "Ni {:.6f}".format(material.raytrace_transparency.ior if material.use_transparency else 1.0),
+        "d {:.6f}".format(material.alpha),
+        "illum {}".format(2 if material.specular_intensity > 0 else 1),
+    ]
+    for slot in material.texture_slots:
+        if slot is None or slot.texture is None or slot.texture.type != 'IMAGE' or slot.texture.image is None:
+            continue
+        path = _image_path(slot.texture.image)
+        if slot.use_map_color_diffuse:
+            lines.append("map_Kd {}".format(path))
+        if slot.use_map_normal:
+            lines.append("map_Bump {}".format(path))
+        if slot.use_map_alpha:
+            lines.append("map_d {}".format(path))
+    return lines
+
+
+def _node_material_lines(material):
+    # Blender 2.8 and later, only the base color, its image and the alpha
+    from bpy_extras.node_shader_utils import PrincipledBSDFWrapper
+    wrapper = PrincipledBSDFWrapper(material, is_readonly=True)
+    lines = ["Kd {:.6f} {:.6f} {:.6f}".format(*wrapper.base_color[:3]), "d {:.6f}".format(wrapper.alpha)]
+    image = wrapper.base_color_texture.image if wrapper.base_color_texture else None
+    if image is not None:
+        lines.append("map_Kd {}".format(_image_path(image)))
+    return lines
+
+
+def _world_ambient():
+    world = bpy.context.scene.world
+    return world.ambient_color[0] if world is not None and hasattr(world, 'ambient_color') else 0.
+
+
+def _image_path(image):
+    return os.path.normpath(bpy.path.abspath(image.filepath, library=image.library))
+
+
+def _transform(mesh, matrix):
+    # Applies a 4x4 matrix to the vertices and normals of an ObjMesh, in place
+    if np.allclose(matrix, np.eye(4)):
+        return
+    linear = matrix[:3, :3]
+    mesh.vertices = (mesh.vertices.dot(linear.T) + matrix[:3, 3]).astype(np.float32)
+    normals = mesh.normals.dot(np.linalg.inv(linear))
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    mesh.normals = (normals / np.maximum(lengths, 1e-12)).astype(np.float32)
+
+
+def _concatenate(parts, materials):
+    '''
+    One ObjMesh of several (name, ObjMesh) from mesh_arrays, with the uvs and
+    normals of all corners deduplicated and face_groups naming the parts
+    '''
+    vertices, uvs, normals, face_counts, face_vertices = [], [], [], [], []
+    face_uvs, face_materials, face_groups = [], [], []
+    n_vertices = 0
+    for i, (name, mesh) in enumerate(parts):
+        vertices.append(mesh.vertices)
+        face_counts.append(np.diff(mesh.face_offsets))
+        face_vertices.append(mesh.face_vertices + n_vertices)
+        n_vertices += len(mesh.vertices)
+        if len(mesh.uvs):
+            uvs.append(mesh.uvs[mesh.face_uvs])
+        else:
+            uvs.append(np.full((len(mesh.face_uvs), 2), np.nan, np.float32))
+        # Normals are written with four decimals, so equal ones are equal at that precision
+        normals.append(np.round(mesh.normals[mesh.face_normals], 4))
+        face_materials.append(mesh.face_materials)
+        face_groups.append(np.full(mesh.num_faces, i, np.int32))
+
+    face_counts = np.concatenate(face_counts) if parts else np.zeros(0, np.int64)
+    face_offsets = np.zeros(len(face_counts) + 1, np.int64)
+    np.cumsum(face_counts, out=face_offsets[1:])
+    uvs, face_uvs = _unique_rows(np.concatenate(uvs) if parts else np.zeros((0, 2), np.float32))
+    normals, face_normals = _unique_rows(np.concatenate(normals) if parts else np.zeros((0, 3), np.float32))
+    return obj_io.ObjMesh(
+        np.concatenate(vertices) if parts else np.zeros((0, 3), np.float32),
+        uvs=uvs,
+        normals=normals,
+        face_offsets=face_offsets,
+        face_vertices=np.concatenate(face_vertices) if parts else np.zeros(0, np.int64),
+        face_uvs=face_uvs,
+        face_normals=face_normals,
+        face_materials=np.concatenate(face_materials).astype(np.int32) if parts else np.zeros(0, np.int32),
+        face_groups=np.concatenate(face_groups) if parts else np.zeros(0, np.int32),
+        materials=materials,
+        groups=[name for name, _ in parts],
+    )
+
+
+def _unique_rows(rows):
+    '''
+    Returns the distinct rows (in order of first use) and the index of every
+    row among them, rows with a nan are dropped and get -1
+    '''
+    rows = np.ascontiguousarray(rows, np.float32)
+    present = ~np.isnan(rows).any(axis=1)
+    index = np.full(len(rows), -1, np.int64)
+    if not present.any():
+        return np.zeros((0, rows.shape[1]), np.float32), index
+    kept = rows[present] + np.float32(0)  # no -0.0, so equal values have equal bytes
+    keys = kept.view(np.dtype((np.void, kept.dtype.itemsize * kept.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), np.int64)
+    rank[order] = np.arange(len(order))
+    index[present] = rank[inverse.ravel()]
+    return kept[first[order]], index
+
+
+def link_object(obj):
+    scene = bpy.context.scene
+    if hasattr(scene, 'collection'):
+        scene.collection.objects.link(obj)
+    else:
+        scene.objects.link(obj)
+
+
+def load_materials(obj_file, mesh):
+    ''' Returns a new material for every material name of the mesh, set up from its mtl files '''
+    folder = os.path.dirname(os.path.abspath(obj_file))
+    definitions = {}
+    for mtllib in mesh.mtllibs:
+        mtl_file = os.path.join(folder, mtllib)
+        if not os.path.isfile(mtl_file):
+            print("No file at {}".format(mtl_file))
+            continue
+        for name, lines in obj_io.read_mtl(mtl_file).items():
+            definitions.setdefault(name, (lines, os.path.dirname(mtl_file)))
+    return [new_material(name, *definitions.get(name, ([], folder))) for name in mesh.materials]
+
+
+def new_material(name, lines, folder):
+    ''' A material from the lines under its newmtl, texture paths are relative to folder '''
+    values = {}
+    for line in lines:
+        words = line.split()
+        if len(words) > 1:
+            values[words[0]] = words[1:]
+    alpha = float(values['d'][0]) if 'd' in values else 1.0
+
+    material = bpy.data.materials.new(name)
+    if not hasattr(material, 'texture_slots'):
+        return _node_material(material, values, alpha, folder)
+    if _color(values, 'Kd') is not None:
+        material.diffuse_color = _color(values, 'Kd')
+        material.diffuse_intensity = 1.0
+    if _color(values, 'Ks') is not None:
+        material.specular_color = _color(values, 'Ks')
+        material.specular_intensity = 1.0
+    if 'Ns' in values:
+        material.specular_hardness = int(float(values['Ns'][0]) * 0.51 + 1)
+    if alpha < 1:
+        material.alpha = alpha
+        material.use_transparency = True
+    for key, use in [('map_Kd', 'use_map_color_diffuse'), ('map_Bump', 'use_map_normal'),
+                     ('bump', 'use_map_normal'), ('map_d', 'use_map_alpha')]:
+        if key not in values:
+            continue
+        texture = bpy.data.textures.new(name + "_" + key, type='IMAGE')
+        texture.image = _load_image(values[key][-1], folder)
+        slot = material.texture_slots.add()
+        slot.texture = texture
+        slot.texture_coords = 'UV'
+        slot.use_map_color_diffuse = use == 'use_map_color_diffuse'
+        setattr(slot, use, True)
+    return material
+
+
+def _node_material(material, values, alpha, folder):
+    # Blender 2.8 and later, only the base color, its image and the alpha
+    from bpy_extras.node_shader_utils import PrincipledBSDFWrapper
+    wrapper = PrincipledBSDFWrapper(material, is_readonly=False)
+    if _color(values, 'Kd') is not None:
+        wrapper.base_color = _color(values, 'Kd')
+    if alpha < 1:
+        wrapper.alpha = alpha
+    if 'map_Kd' in values:
+        wrapper.base_color_texture.image = _load_image(values['map_Kd'][-1], folder)
+    return material
+
+
+def _color(values, key):
+    return [float(x) for x in values[key][:3]] if key in values else None
+
+
+def _load_image(path, folder):
+    return load_image(path.replace('\\', '/'), folder, place_holder=True, check_existing=True)
+
+
+def _first_use(vertices, refs):
+    # The vertices the references use, in order of first use, and the references into them
+    used, first = np.unique(refs, return_index=True)
+    used = used[np.argsort(first)]
+    remap = np.empty(len(vertices), np.int64)
+    remap[used] = np.arange(len(used))
+    return vertices[used], remap[refs]
+
+
+def _corner_values(values, refs):
+    # Per corner rows of values, zeros where a corner has no reference; None if no corner has one
+    present = refs >= 0
+    if len(values) == 0 or not present.any():
+        return None
+    out = np.zeros((len(refs), values.shape[1]), np.float32)
+    out[present] = values[refs[present]]
+    return out
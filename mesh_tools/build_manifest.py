@@ -0,0 +1,97 @@
+'''
+Bookkeeping for incremental rebuilds.
+
+An output is rebuilt only when the hash of its inputs changed. The inputs hash
+combines the contents of the input files, any extra values that affect the
+output (cluster assignment, settings) and TOOL_VERSION, which should be bumped
+whenever a change to the tools changes what they write. Hashing a file is
+memoized on its mtime and size, so an unchanged input costs one stat.
+'''
+
+import os
+import json
+import hashlib
+
+TOOL_VERSION = 1
+
+
+def file_sha1(file_name):
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FileHashes(object):
+    ''' sha1 of files, memoized on (mtime, size) and optionally kept in a json file '''
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.hashes = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                self.hashes = json.load(f)
+
+    def hash(self, file_name):
+        if not os.path.isfile(file_name):
+            return None
+        stat = os.stat(file_name)
+        key = os.path.abspath(file_name)
+        cached = self.hashes.get(key)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        sha = file_sha1(file_name)
+        self.hashes[key] = [stat.st_mtime_ns, stat.st_size, sha]
+        return sha
+
+    def save(self):
+        if self.cache_file is not None:
+            _write_json(self.cache_file, self.hashes)
+
+
+def inputs_hash(file_hashes, files, extra=()):
+    ''' Hash of the given input files (missing ones count as missing) and extra values '''
+    sha = hashlib.sha1("tool version {}".format(TOOL_VERSION).encode('utf-8'))
+    for file_name in sorted(files):
+        sha.update("{} {}\n".format(os.path.basename(file_name), file_hashes.hash(file_name)).encode('utf-8'))
+    for value in extra:
+        sha.update("{}\n".format(value).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class BuildManifest(object):
+    '''
+    Maps every output (a model id, usually) to the inputs hash it was built
+    from. Kept in a json file next to the output folder.
+    '''
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        data = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                data = json.load(f)
+        self.outputs = data.get('outputs', {})
+        self.file_hashes = FileHashes()
+        self.file_hashes.hashes = data.get('files', {})
+
+    def inputs_hash(self, files, extra=()):
+        return inputs_hash(self.file_hashes, files, extra)
+
+    def is_fresh(self, output, inputs):
+        return self.outputs.get(output) == inputs
+
+    def record(self, output, inputs):
+        self.outputs[output] = inputs
+
+    def forget(self, output):
+        self.outputs.pop(output, None)
+
+    def save(self):
+        _write_json(self.manifest_file, {'outputs': self.outputs, 'files': self.file_hashes.hashes})
+
+
+def _write_json(file_name, data):
+    tmp = "{}.tmp{}".format(file_name, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, file_name)
@@ -0,0 +1,232 @@
+'''
+On-disk cache of parsed obj geometry.
+
+Every source file gets one entry directory named after the hash of its
+absolute path. The entry holds the parsed arrays as .npy files (loaded back
+memory mapped, so a hit costs a few page faults instead of a text parse) and a
+meta.json with the mtime and size of the source, which invalidate the entry.
+With check="hash" a changed mtime is double checked against the sha1 of the
+contents before re-parsing, which is useful after a copy or a git checkout.
+
+load_grid adds a spatial_index.GridIndex over the vertices to the entry, so
+region queries on a model skip the grid build as well. It goes away with
+the rest of the entry when the source changes.
+
+The cache is capped at max_bytes. The mtime of meta.json is bumped on every
+hit. Every write appends its size to SIZE_LOG, and only once the logged total
+goes over max_bytes is the cache scanned and the least recently used entries
+evicted, which also resets the log to the measured size.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import obj_io
+import build_manifest
+import spatial_index
+
+DEFAULT_CACHE_DIR = "geometry_cache"
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+ARRAYS = ['vertices', 'uvs', 'normals', 'face_offsets', 'face_vertices', 'face_uvs',
+          'face_normals', 'face_materials', 'face_groups']
+NAMES = ['materials', 'groups', 'mtllibs']
+# Bytes written since the last full scan, one line per write (a file, so evict skips it)
+SIZE_LOG = "size.log"
+# Eviction frees down to this fraction of max_bytes, so a full cache isn't scanned on every write
+EVICT_TO = .9
+
+
+def load_vertices(obj_file, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, check="stat"):
+    ''' Cached version of obj_io.read_vertices, the array is read-only '''
+    return _load(obj_file, False, cache_dir, max_bytes, check).vertices
+
+
+def load_obj(obj_file, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, check="stat"):
+    ''' Cached version of obj_io.read_obj, the arrays are read-only '''
+    return _load(obj_file, True, cache_dir, max_bytes, check)
+
+
+def load_grid(obj_file, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, check="stat"):
+    ''' spatial_index.GridIndex over the cached vertices of an obj file, built on first use '''
+    vertices = load_vertices(obj_file, cache_dir, max_bytes, check)
+    entry = entry_dir(obj_file, cache_dir)
+    try:
+        grid = spatial_index.GridIndex.load(entry, vertices)
+        if len(grid.order) == len(vertices):
+            return grid
+    except (OSError, ValueError):
+        pass
+    grid = spatial_index.GridIndex.build(vertices)
+    try:
+        grid.save(entry)
+        _note_write(cache_dir, max_bytes, grid.order.nbytes + grid.starts.nbytes)
+    except OSError:
+        # Entry evicted or replaced in the meantime, the grid is still good for this call
+        pass
+    return grid
+
+
+def entry_dir(obj_file, cache_dir=DEFAULT_CACHE_DIR):
+    key = hashlib.sha1(os.path.abspath(obj_file).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def clear(cache_dir=DEFAULT_CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def _load(obj_file, faces, cache_dir, max_bytes, check):
+    entry = entry_dir(obj_file, cache_dir)
+    stat = os.stat(obj_file)
+    meta = _read_meta(entry)
+    if meta is not None and (meta['faces'] or not faces) and _is_fresh(meta, stat, obj_file, entry, check):
+        mesh = _read_entry(entry, meta, faces)
+        if mesh is not None:
+            _touch(entry)
+            return mesh
+
+    mesh = obj_io.read_obj(obj_file, faces=faces)
+    meta = {
+        'source': os.path.abspath(obj_file),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': build_manifest.file_sha1(obj_file) if check == "hash" else None,
+        'faces': faces,
+    }
+    written = _write_entry(entry, mesh, meta, faces, cache_dir)
+    _note_write(cache_dir, max_bytes, written)
+    return mesh
+
+
+def _read_meta(entry):
+    try:
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_fresh(meta, stat, obj_file, entry, check):
+    if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+        return True
+    if check != "hash" or meta['size'] != stat.st_size or meta.get('sha1') is None:
+        return False
+    if build_manifest.file_sha1(obj_file) != meta['sha1']:
+        return False
+    # Same contents, remember the new mtime so the next lookup is a plain stat
+    meta['mtime_ns'] = stat.st_mtime_ns
+    _write_json(os.path.join(entry, 'meta.json'), meta)
+    return True
+
+
+def _read_entry(entry, meta, faces):
+    arrays = {}
+    try:
+        for name in (ARRAYS if faces else ['vertices']):
+            arrays[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    names = {name: meta.get(name, []) for name in NAMES} if faces else {}
+    vertices = arrays.pop('vertices')
+    arrays.update(names)
+    return obj_io.ObjMesh(vertices, **arrays)
+
+
+def _write_entry(entry, mesh, meta, faces, cache_dir):
+    ''' Writes the entry, returns the bytes written '''
+    os.makedirs(cache_dir, exist_ok=True)
+    written = 0
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+    try:
+        for name in (ARRAYS if faces else ['vertices']):
+            values = np.ascontiguousarray(getattr(mesh, name))
+            np.save(os.path.join(tmp, name + '.npy'), values)
+            written += values.nbytes
+        if faces:
+            for name in NAMES:
+                meta[name] = getattr(mesh, name)
+        _write_json(os.path.join(tmp, 'meta.json'), meta)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+    except OSError:
+        # Another process wrote the same entry first, theirs is just as good
+        shutil.rmtree(tmp, ignore_errors=True)
+    return written
+
+
+def _write_json(file_name, data):
+    tmp = file_name + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, file_name)
+
+
+def _touch(entry):
+    try:
+        os.utime(os.path.join(entry, 'meta.json'))
+    except OSError:
+        pass
+
+
+def _note_write(cache_dir, max_bytes, written):
+    '''
+    Logs a write and evicts if the logged total went over max_bytes. Without
+    a log (a cache from before the log, or a fresh one) the cache is scanned
+    once to start it.
+    '''
+    if max_bytes is None:
+        return
+    log_file = os.path.join(cache_dir, SIZE_LOG)
+    if not os.path.isfile(log_file):
+        evict(cache_dir, max_bytes)
+        return
+    # Single appending write, so processes sharing the cache don't mix their lines
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, "{}\n".format(written).encode('utf-8'))
+    finally:
+        os.close(fd)
+    try:
+        with open(log_file, 'r') as f:
+            total = sum(int(line) for line in f if line.strip().isdigit())
+    except OSError:
+        total = None
+    if total is None or total > max_bytes:
+        evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Removes the least recently used entries until the cache fits in
+    EVICT_TO * max_bytes and restarts the size log at what is left
+    '''
+    if max_bytes is None or not os.path.isdir(cache_dir):
+        return
+    entries = []
+    total = 0
+    for d in os.scandir(cache_dir):
+        if not d.is_dir() or d.name.startswith('.tmp_'):
+            continue
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(d.path))
+            last_used = os.stat(os.path.join(d.path, 'meta.json')).st_mtime
+        except OSError:
+            continue
+        entries.append((last_used, size, d.path))
+        total += size
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes * EVICT_TO:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    log_file = os.path.join(cache_dir, SIZE_LOG)
+    tmp = log_file + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        f.write("{}\n".format(total))
+    os.replace(tmp, log_file)
@@ -0,0 +1,188 @@
+'''
+Per-stage timing and memory records for the pipelines.
+
+Stages are wrapped in spans:
+
+    with instrumentation.span("export", model=model) as counts:
+        ...
+        counts['bytes_written'] = ...
+
+Every span appends one json line to the trace file with its wall time, cpu
+time, the peak resident memory of the process so far and whatever counts the
+stage filled in (vertices, faces, bytes_written, ...). Spans nest, the record
+of an inner span names its parent, and the values of the enclosing context()
+blocks (the model being worked on, usually) are added to every record.
+
+Nothing is recorded until a trace file is set, with configure() or the
+PIPELINE_TRACE environment variable, which configure() also sets so Blender
+subprocesses and pool workers write to the same file. Lines are appended
+with a single write, so several processes can share one trace.
+
+python mesh_tools/instrumentation.py trace.jsonl shows the slowest stages and
+models of a trace.
+'''
+
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+try:
+    import resource
+except ImportError:
+    # Windows, no peak rss
+    resource = None
+
+TRACE_VARIABLE = "PIPELINE_TRACE"
+
+_context = {}
+_stack = []
+
+
+def configure(trace_file):
+    ''' Starts recording spans to trace_file (None stops), in this process and its children '''
+    if trace_file is None:
+        os.environ.pop(TRACE_VARIABLE, None)
+    else:
+        os.environ[TRACE_VARIABLE] = os.path.abspath(trace_file)
+
+
+def trace_file():
+    return os.environ.get(TRACE_VARIABLE) or None
+
+
+@contextlib.contextmanager
+def context(**values):
+    ''' Adds the values (the model being worked on, usually) to every record made in the block '''
+    saved = dict(_context)
+    _context.update(values)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(saved)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on macOS
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+@contextlib.contextmanager
+def span(name, **counts):
+    '''
+    Times the block and records it. Yields a dict the block can add counts
+    to. Costs nothing but a dict when no trace file is set.
+    '''
+    path = trace_file()
+    if path is None:
+        yield counts
+        return
+    parent = _stack[-1] if _stack else None
+    _stack.append(name)
+    wall, cpu = time.time(), time.process_time()
+    try:
+        yield counts
+    finally:
+        _stack.pop()
+        record = {'span': name, 'parent': parent, 'pid': os.getpid(), 'start': wall}
+        record.update(_context)
+        record['wall'] = time.time() - wall
+        record['cpu'] = time.process_time() - cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+        record.update(counts)
+        _append(path, record)
+
+
+def timed(name=None):
+    ''' Decorator version of span, named after the function by default '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def file_bytes(files):
+    ''' Total size of the files that exist, for bytes_written counts '''
+    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+
+
+def _json_value(value):
+    # numpy scalars in the counts
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def _append(path, record):
+    line = (json.dumps(record, default=_json_value) + "\n").encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_trace(path):
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Half written line from a crash
+                continue
+    return records
+
+
+def summarize(records, top=10):
+    '''
+    Returns the summary lines of a trace: time per stage, the slowest models
+    (by the time of their top level spans) and the slowest single spans
+    '''
+    lines = []
+    stages = {}
+    for r in records:
+        stage = stages.setdefault(r['span'], {'count': 0, 'wall': 0., 'cpu': 0., 'max': 0., 'rss': 0.})
+        stage['count'] += 1
+        stage['wall'] += r['wall']
+        stage['cpu'] += r['cpu']
+        stage['max'] = max(stage['max'], r['wall'])
+        stage['rss'] = max(stage['rss'], r.get('peak_rss_mb') or 0)
+    lines.append("{:<28}{:>8}{:>11}{:>11}{:>10}{:>10}{:>12}".format(
+        "stage", "count", "wall", "cpu", "mean", "max", "peak rss"))
+    for name, s in sorted(stages.items(), key=lambda x: -x[1]['wall']):
+        lines.append("{:<28}{:>8}{:>10.1f}s{:>10.1f}s{:>9.2f}s{:>9.2f}s{:>9.0f} MB".format(
+            name, s['count'], s['wall'], s['cpu'], s['wall'] / s['count'], s['max'], s['rss']))
+
+    models = {}
+    for r in records:
+        if r.get('model') is not None and r.get('parent') is None:
+            models[r['model']] = models.get(r['model'], 0.) + r['wall']
+    if models:
+        lines.append("")
+        lines.append("Slowest models")
+        for model, wall in sorted(models.items(), key=lambda x: -x[1])[:top]:
+            lines.append("  {:<40}{:>9.2f}s".format(model, wall))
+
+    lines.append("")
+    lines.append("Slowest spans")
+    for r in sorted(records, key=lambda r: -r['wall'])[:top]:
+        counts = ", ".join("{}={}".format(k, v) for k, v in sorted(r.items())
+                           if k not in ('span', 'parent', 'pid', 'start', 'wall', 'cpu', 'peak_rss_mb', 'model'))
+        lines.append("  {:<28}{:<40}{:>9.2f}s  {}".format(r['span'], str(r.get('model', '')), r['wall'], counts))
+    return lines
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a pipeline trace.')
+    parser.add_argument('trace', help='Json lines trace file')
+    parser.add_argument('-n', '--top', type=int, default=10, help='Number of slowest models and spans to show')
+    args = parser.parse_args()
+    print("\n".join(summarize(read_trace(args.trace), args.top)))
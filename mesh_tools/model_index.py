@@ -0,0 +1,348 @@
+'''
+SQLite index of the ShapeNet category.
+
+One row per model with the paths of its obj and mtl files, their mtime, size
+and sha1, the vertex and face counts, the bounding box, the materials and the
+textures the mtl references (and which of those are missing). A second table
+lists the hand annotated models (the csv files in the annotations folder).
+The folders the index was built from are kept in it too, so the tools look
+models up in the index instead of globbing the dataset or knowing where it
+lives on every host.
+
+update() scans the dataset with a process pool. Models whose obj and mtl
+kept their mtime and size aren't opened again, so after the first build an
+update costs a directory listing and two stats per model. Only update()
+writes to the index, lookups open it read-only.
+
+python mesh_tools/model_index.py --dataset_dir /path/to/02958343 builds or
+updates the index, python mesh_tools/model_index.py shows what it holds.
+'''
+
+import os
+import json
+import socket
+import contextlib
+from collections import OrderedDict
+from multiprocessing import Pool
+from urllib.request import pathname2url
+try:
+    import sqlite3
+except ImportError:
+    # Blender builds without _sqlite3
+    sqlite3 = None
+import obj_io
+import build_manifest
+
+DEFAULT_INDEX_FILE = "model_index.sqlite"
+DEFAULT_ANNOTATIONS_DIR = "annotations"
+SCHEMA_VERSION = 1
+MODEL_FILE = os.path.join("models", "model_normalized.obj")
+# Where the category is on the machines it was used on, for the first scan
+DATASET_DIRS = {
+    'Michaels-MacBook-Pro.local': '/Users/mpeven/Downloads/02958343',
+    'titan': '/home/mike/Projects/DIVA/car_models/02958343',
+}
+# Rows are committed in batches, so an interrupted scan keeps what it did
+COMMIT_EVERY = 200
+
+MODEL_COLUMNS = [
+    ('model', 'TEXT PRIMARY KEY'),
+    ('obj_file', 'TEXT'),
+    ('obj_mtime_ns', 'INTEGER'),
+    ('obj_size', 'INTEGER'),
+    ('obj_sha1', 'TEXT'),
+    ('mtl_file', 'TEXT'),
+    ('mtl_mtime_ns', 'INTEGER'),
+    ('mtl_size', 'INTEGER'),
+    ('mtl_sha1', 'TEXT'),
+    ('vertices', 'INTEGER'),
+    ('faces', 'INTEGER'),
+    ('bbox_min', 'TEXT'),
+    ('bbox_max', 'TEXT'),
+    ('materials', 'TEXT'),
+    ('textures', 'TEXT'),
+    ('missing_textures', 'TEXT'),
+    ('error', 'TEXT'),
+]
+ANNOTATION_COLUMNS = [
+    ('model', 'TEXT PRIMARY KEY'),
+    ('vertex_file', 'TEXT'),
+    ('object_file', 'TEXT'),
+    ('mtime_ns', 'INTEGER'),
+]
+# Columns holding json lists
+JSON_COLUMNS = ['bbox_min', 'bbox_max', 'materials', 'textures', 'missing_textures']
+
+
+def scan_model(job):
+    ''' Row of one model, job is (model, obj_file, mtl_file), errors end up in the error column '''
+    model, obj_file, mtl_file = job
+    row = {'model': model, 'obj_file': obj_file, 'mtl_file': mtl_file}
+    row.update(_file_columns('obj', obj_file))
+    row.update(_file_columns('mtl', mtl_file))
+    try:
+        mesh = obj_io.read_obj(obj_file)
+        row['vertices'] = len(mesh.vertices)
+        row['faces'] = mesh.num_faces
+        if len(mesh.vertices):
+            row['bbox_min'] = mesh.vertices.min(axis=0).tolist()
+            row['bbox_max'] = mesh.vertices.max(axis=0).tolist()
+        row['materials'] = list(mesh.materials)
+        row['textures'] = []
+        if os.path.isfile(mtl_file):
+            for lines in obj_io.read_mtl(mtl_file).values():
+                row['textures'] += [line.split()[-1] for line in lines
+                                    if line.startswith("map_") and len(line.split()) > 1]
+        row['textures'] = sorted(set(row['textures']))
+        texture_dir = os.path.dirname(mtl_file)
+        row['missing_textures'] = [t for t in row['textures'] if not os.path.isfile(os.path.join(texture_dir, t))]
+    except Exception as e:
+        row['error'] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+class ModelIndex(object):
+    '''
+    The index in index_file, created by the first update()
+
+    index.model_files() maps every model that was read fine to its obj file,
+    index.get(model) returns its row as a dict (json columns decoded) and
+    index.annotated() lists the hand annotated models.
+    '''
+    def __init__(self, index_file=DEFAULT_INDEX_FILE):
+        if sqlite3 is None:
+            raise RuntimeError("The model index needs the sqlite3 module, which this python doesn't have")
+        self.index_file = index_file
+
+    def update(self, dataset_dir=None, annotations_dir=None, workers=None):
+        '''
+        Brings the index up to date with dataset_dir (by default the folder
+        of the last update, see get_dataset_dir) and the annotations folder.
+        Returns the number of models read, unchanged and dropped.
+        '''
+        from tqdm import tqdm
+        self._create()
+        dataset_dir = os.path.abspath(dataset_dir or self.get_dataset_dir())
+        with self._connect() as db:
+            known = {row[0]: tuple(row)[1:] for row in db.execute(
+                "SELECT model, obj_file, obj_mtime_ns, obj_size, mtl_mtime_ns, mtl_size FROM models")}
+        jobs = []
+        found = set()
+        for model in sorted(os.listdir(dataset_dir)):
+            obj_file = os.path.join(dataset_dir, model, MODEL_FILE)
+            if not os.path.isfile(obj_file):
+                continue
+            found.add(model)
+            mtl_file = os.path.splitext(obj_file)[0] + ".mtl"
+            obj_stat = _stat(obj_file)
+            mtl_stat = _stat(mtl_file)
+            if known.get(model) != (obj_file,) + obj_stat + mtl_stat:
+                jobs.append((model, obj_file, mtl_file))
+        removed = set(known) - found
+
+        with self._connect() as db:
+            db.executemany("DELETE FROM models WHERE model = ?", [(m,) for m in removed])
+            self._set_setting(db, 'dataset_dir', dataset_dir)
+        if jobs:
+            with Pool(workers) as pool:
+                rows = iter(tqdm(pool.imap_unordered(scan_model, jobs, chunksize=4), total=len(jobs), ncols=100,
+                                 desc="Indexing models"))
+                for start in range(0, len(jobs), COMMIT_EVERY):
+                    with self._connect() as db:
+                        for _, row in zip(range(COMMIT_EVERY), rows):
+                            _insert(db, 'models', MODEL_COLUMNS, row)
+        self.update_annotations(annotations_dir)
+        print("Indexed {} models ({} unchanged, {} dropped)".format(len(jobs), len(found) - len(jobs), len(removed)))
+        return len(jobs), len(found) - len(jobs), len(removed)
+
+    def update_annotations(self, annotations_dir=None):
+        '''
+        Syncs the annotations table with the csv files of the annotations
+        folder ({model}.csv and {model}_objects.csv), one listing
+        '''
+        self._create()
+        annotations_dir = os.path.abspath(annotations_dir or self.get_annotations_dir())
+        rows = {}
+        if os.path.isdir(annotations_dir):
+            for file_name in os.listdir(annotations_dir):
+                if not file_name.endswith(".csv"):
+                    continue
+                model = file_name.split("_")[0].split(".csv")[0]
+                row = rows.setdefault(model, {'model': model, 'mtime_ns': 0})
+                column = 'object_file' if file_name.endswith("_objects.csv") else 'vertex_file'
+                row[column] = os.path.join(annotations_dir, file_name)
+                row['mtime_ns'] = max(row['mtime_ns'], os.stat(row[column]).st_mtime_ns)
+        with self._connect() as db:
+            db.execute("DELETE FROM annotations")
+            for row in rows.values():
+                _insert(db, 'annotations', ANNOTATION_COLUMNS, row)
+            self._set_setting(db, 'annotations_dir', annotations_dir)
+
+    def get_dataset_dir(self):
+        '''
+        SHAPENET_CAR_DIR if it is set (another copy of the category, or a
+        synthetic one, see benchmarks), then the folder the index was built
+        from, then the folder of this host in DATASET_DIRS
+        '''
+        if os.environ.get("SHAPENET_CAR_DIR"):
+            return os.environ["SHAPENET_CAR_DIR"]
+        dataset_dir = self._setting('dataset_dir')
+        if dataset_dir is not None:
+            return dataset_dir
+        host = socket.gethostname()
+        if host in DATASET_DIRS:
+            return DATASET_DIRS[host]
+        raise ValueError("No dataset folder for host {}, build the index with --dataset_dir".format(host))
+
+    def get_annotations_dir(self):
+        return self._setting('annotations_dir') or os.path.abspath(DEFAULT_ANNOTATIONS_DIR)
+
+    def model_files(self):
+        ''' Ordered dict of model -> obj file, models that failed to read left out '''
+        return _ordered(self._read("SELECT model, obj_file FROM models WHERE error IS NULL ORDER BY model"))
+
+    def model_file(self, model):
+        rows = self._read("SELECT obj_file FROM models WHERE model = ?", (model,))
+        if not rows:
+            raise KeyError("{} is not in {}, update the index (python mesh_tools/model_index.py)".format(
+                model, self.index_file))
+        return rows[0][0]
+
+    def get(self, model):
+        ''' Row of a model as a dict, None if it isn't in the index '''
+        rows = self._read("SELECT * FROM models WHERE model = ?", (model,))
+        return _decode(rows[0]) if rows else None
+
+    def rows(self):
+        return [_decode(row) for row in self._read("SELECT * FROM models ORDER BY model")]
+
+    def file_hashes(self):
+        '''
+        The sha1 of every indexed obj and mtl in the format of
+        build_manifest.FileHashes.hashes (absolute path -> [mtime, size, sha1]),
+        so the update's parallel hashing isn't redone
+        '''
+        hashes = {}
+        for row in self._read("SELECT obj_file, obj_mtime_ns, obj_size, obj_sha1, "
+                              "mtl_file, mtl_mtime_ns, mtl_size, mtl_sha1 FROM models"):
+            for file_name, mtime_ns, size, sha in [tuple(row)[:4], tuple(row)[4:]]:
+                if sha is not None:
+                    hashes[os.path.abspath(file_name)] = [mtime_ns, size, sha]
+        return hashes
+
+    def annotated(self):
+        ''' Models with a csv in the annotations folder as of the last update '''
+        return [row[0] for row in self._read("SELECT model FROM annotations ORDER BY model")]
+
+    def _create(self):
+        # Tables of this SCHEMA_VERSION, older ones are dropped and rebuilt by the update
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            row = db.execute("SELECT value FROM settings WHERE key = 'schema_version'").fetchone()
+            if row is None or row[0] != str(SCHEMA_VERSION):
+                db.execute("DROP TABLE IF EXISTS models")
+                db.execute("DROP TABLE IF EXISTS annotations")
+            db.execute("CREATE TABLE IF NOT EXISTS models ({})".format(_column_list(MODEL_COLUMNS)))
+            db.execute("CREATE TABLE IF NOT EXISTS annotations ({})".format(_column_list(ANNOTATION_COLUMNS)))
+            self._set_setting(db, 'schema_version', SCHEMA_VERSION)
+
+    def _read(self, query, values=()):
+        '''
+        Rows of a query on a read-only connection, none if the index hasn't
+        been built yet
+        '''
+        if not os.path.isfile(self.index_file):
+            return []
+        uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(self.index_file)))
+        db = sqlite3.connect(uri, uri=True, timeout=60)
+        db.row_factory = sqlite3.Row
+        try:
+            return db.execute(query, values).fetchall()
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return []
+            raise
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # One short connection per call, so the index can be used from forked pool workers. Writes only.
+        db = sqlite3.connect(self.index_file, timeout=60)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _setting(self, key):
+        rows = self._read("SELECT value FROM settings WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def _set_setting(self, db, key, value):
+        db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def _column_list(columns):
+    return ", ".join("{} {}".format(name, kind) for name, kind in columns)
+
+
+def _stat(file_name):
+    # (mtime, size), None for both if the file is missing
+    if not os.path.isfile(file_name):
+        return (None, None)
+    stat = os.stat(file_name)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _file_columns(prefix, file_name):
+    mtime_ns, size = _stat(file_name)
+    return {
+        prefix + '_mtime_ns': mtime_ns,
+        prefix + '_size': size,
+        prefix + '_sha1': build_manifest.file_sha1(file_name) if size is not None else None,
+    }
+
+
+def _insert(db, table, columns, row):
+    names = [name for name, _ in columns]
+    values = [json.dumps(row.get(name)) if name in JSON_COLUMNS and row.get(name) is not None else row.get(name)
+              for name in names]
+    db.execute("INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+        table, ", ".join(names), ", ".join("?" * len(names))), values)
+
+
+def _decode(row):
+    row = dict(row)
+    for name in JSON_COLUMNS:
+        if row.get(name) is not None:
+            row[name] = json.loads(row[name])
+    return row
+
+
+def _ordered(rows):
+    return OrderedDict((row[0], row[1]) for row in rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build, update or show the index of the ShapeNet category.')
+    parser.add_argument('--dataset_dir', help='ShapeNet category folder, e.g. 02958343 (default: the indexed one)')
+    parser.add_argument('--annotations_dir', help='Folder of the annotation csv files (default: the indexed one)')
+    parser.add_argument('-i', '--index', default=DEFAULT_INDEX_FILE, help='Index file')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Processes reading models')
+    parser.add_argument('--show', action='store_true', help="Only print what the index holds, don't update it")
+    args = parser.parse_args()
+    index = ModelIndex(args.index)
+    if not args.show:
+        index.update(args.dataset_dir, args.annotations_dir, args.workers)
+    rows = index.rows()
+    print("{}: {} models from {}".format(args.index, len(rows), index.get_dataset_dir()))
+    print("  {} vertices, {} faces".format(sum(r['vertices'] or 0 for r in rows), sum(r['faces'] or 0 for r in rows)))
+    print("  {} without faces".format(sum(1 for r in rows if r['faces'] == 0)))
+    print("  {} with missing textures".format(sum(1 for r in rows if r['missing_textures'])))
+    print("  {} hand annotated".format(len(index.annotated())))
+    for r in rows:
+        if r['error'] is not None:
+            print("  {} failed: {}".format(r['model'], r['error']))
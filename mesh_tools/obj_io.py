@@ -0,0 +1,489 @@
+'''
+Fast .obj reading and writing with numpy.
+
+The file is memory mapped and parsed a chunk at a time. Lines are classified
+by their first two bytes and every record of one kind in a chunk is handed to
+numpy in a single call, so there is no per-vertex python object. Vertices are
+counted first and written straight into one preallocated (N, 3) float32 array,
+so peak memory is the output plus one chunk, not the text of the file.
+
+Writing goes the other way: rows are formatted in large blocks with a single
+% operation each and written through a big buffer.
+'''
+
+import mmap
+from collections import OrderedDict
+import numpy as np
+
+CHUNK_SIZE = 1 << 24
+WRITE_BUFFER = 1 << 22
+ROWS_PER_BLOCK = 1 << 16
+
+# Line kinds
+OTHER, VERTEX, UV, NORMAL, FACE, USEMTL, GROUP, MTLLIB = range(8)
+
+
+class ObjMesh(object):
+    '''
+    Parsed contents of an obj file
+
+    Faces are stored flat: the references of face i are
+    face_vertices[face_offsets[i]:face_offsets[i + 1]] (same for face_uvs and
+    face_normals). All indices are 0-based, -1 means the reference is missing.
+    face_materials and face_groups index into materials and groups, -1 means
+    the face came before any usemtl / g line.
+    '''
+    def __init__(self, vertices, uvs=None, normals=None, face_offsets=None, face_vertices=None,
+                 face_uvs=None, face_normals=None, face_materials=None, face_groups=None,
+                 materials=None, groups=None, mtllibs=None):
+        self.vertices = vertices
+        self.uvs = uvs if uvs is not None else np.zeros((0, 2), np.float32)
+        self.normals = normals if normals is not None else np.zeros((0, 3), np.float32)
+        self.face_offsets = face_offsets if face_offsets is not None else np.zeros(1, np.int64)
+        self.face_vertices = face_vertices if face_vertices is not None else np.zeros(0, np.int64)
+        self.face_uvs = face_uvs if face_uvs is not None else np.zeros(0, np.int64)
+        self.face_normals = face_normals if face_normals is not None else np.zeros(0, np.int64)
+        self.face_materials = face_materials if face_materials is not None else np.zeros(0, np.int32)
+        self.face_groups = face_groups if face_groups is not None else np.zeros(0, np.int32)
+        self.materials = materials if materials is not None else []
+        self.groups = groups if groups is not None else []
+        self.mtllibs = mtllibs if mtllibs is not None else []
+
+    @property
+    def num_faces(self):
+        return len(self.face_offsets) - 1
+
+
+def read_vertices(obj_file):
+    ''' Returns the vertices of an obj file as a contiguous (N, 3) float32 array '''
+    return read_obj(obj_file, faces=False).vertices
+
+
+def read_obj(obj_file, faces=True, chunk_size=CHUNK_SIZE):
+    '''
+    Reads an obj file into an ObjMesh
+
+    With faces=False only the vertex positions are parsed, everything else in
+    the returned ObjMesh is left empty.
+    '''
+    with open(obj_file, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return ObjMesh(np.zeros((0, 3), np.float32))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _read_mapped(mm, size, faces, chunk_size)
+
+
+def iter_chunks(obj_file, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the contents of a file in pieces of about chunk_size bytes that
+    always end on a newline, for single pass processing of large files
+    '''
+    with open(obj_file, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for chunk in _chunks(mm, size, chunk_size):
+                yield chunk
+
+
+def chunk_vertices(chunk):
+    ''' Returns the vertex positions of a chunk from iter_chunks as an (N, 3) float32 array '''
+    buf = np.frombuffer(chunk, np.uint8)
+    kind, starts, ends = _classify_lines(buf, False)
+    return _parse_floats(chunk, buf, starts[kind == VERTEX] + 2, ends[kind == VERTEX], 3)
+
+
+def _chunks(mm, size, chunk_size):
+    # Yield pieces of the file that always end on a newline
+    start = 0
+    while start < size:
+        end = min(start + chunk_size, size)
+        if end < size:
+            newline = mm.rfind(b'\n', start, end)
+            if newline == -1:
+                newline = mm.find(b'\n', end)
+            end = size if newline == -1 else newline + 1
+        chunk = mm[start:end]
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+        yield chunk
+        start = end
+
+
+def _count_records(mm, size, chunk_size, prefixes):
+    counts = {p: 0 for p in prefixes}
+    for chunk in _chunks(mm, size, chunk_size):
+        for p in prefixes:
+            counts[p] += chunk.count(b'\n' + p) + chunk.startswith(p)
+    return counts
+
+
+def _read_mapped(mm, size, faces, chunk_size):
+    if faces:
+        counts = _count_records(mm, size, chunk_size, [b'v ', b'vt ', b'vn '])
+    else:
+        counts = _count_records(mm, size, chunk_size, [b'v '])
+    vertices = np.empty((counts[b'v '], 3), np.float32)
+    n_vertices = 0
+    if faces:
+        uvs = np.empty((counts[b'vt '], 2), np.float32)
+        normals = np.empty((counts[b'vn '], 3), np.float32)
+        n_uvs = n_normals = 0
+        face_counts, face_refs, face_materials, face_groups = [], [], [], []
+        materials, material_ids, groups = [], {}, []
+        mtllibs = []
+        current_material = current_group = -1
+
+    for chunk in _chunks(mm, size, chunk_size):
+        buf = np.frombuffer(chunk, np.uint8)
+        kind, starts, ends = _classify_lines(buf, faces)
+
+        # Vertices
+        parsed = _parse_floats(chunk, buf, starts[kind == VERTEX] + 2, ends[kind == VERTEX], 3)
+        vertices[n_vertices:n_vertices + len(parsed)] = parsed
+        n_vertices += len(parsed)
+        if not faces:
+            continue
+        parsed = _parse_floats(chunk, buf, starts[kind == UV] + 3, ends[kind == UV], 2)
+        uvs[n_uvs:n_uvs + len(parsed)] = parsed
+        n_uvs += len(parsed)
+        parsed = _parse_floats(chunk, buf, starts[kind == NORMAL] + 3, ends[kind == NORMAL], 3)
+        normals[n_normals:n_normals + len(parsed)] = parsed
+        n_normals += len(parsed)
+
+        # Names used by the faces of this chunk
+        for i in np.flatnonzero(kind == MTLLIB):
+            mtllibs.append(_line_text(chunk, starts[i], ends[i])[7:].strip())
+        usemtl_lines = np.flatnonzero(kind == USEMTL)
+        usemtl_ids = []
+        for i in usemtl_lines:
+            name = _line_text(chunk, starts[i], ends[i])[7:].strip()
+            if name not in material_ids:
+                material_ids[name] = len(materials)
+                materials.append(name)
+            usemtl_ids.append(material_ids[name])
+        group_lines = np.flatnonzero(kind == GROUP)
+        group_ids = []
+        for i in group_lines:
+            groups.append(_line_text(chunk, starts[i], ends[i])[2:].strip())
+            group_ids.append(len(groups) - 1)
+
+        # Faces
+        face_lines = np.flatnonzero(kind == FACE)
+        if len(face_lines):
+            counts_in_chunk, refs = _parse_faces(chunk, buf, starts[face_lines] + 2, ends[face_lines])
+            refs = _resolve_references(refs, counts_in_chunk, face_lines, kind,
+                                       (n_vertices, n_uvs, n_normals))
+            face_counts.append(counts_in_chunk)
+            face_refs.append(refs)
+            face_materials.append(_runs(face_lines, usemtl_lines, usemtl_ids, current_material))
+            face_groups.append(_runs(face_lines, group_lines, group_ids, current_group))
+        if usemtl_ids:
+            current_material = usemtl_ids[-1]
+        if group_ids:
+            current_group = group_ids[-1]
+
+    vertices = vertices[:n_vertices]
+    if not faces:
+        return ObjMesh(vertices)
+
+    if face_counts:
+        face_counts = np.concatenate(face_counts)
+        face_refs = np.concatenate(face_refs)
+        face_materials = np.concatenate(face_materials)
+        face_groups = np.concatenate(face_groups)
+    else:
+        face_counts = np.zeros(0, np.int64)
+        face_refs = np.zeros((0, 3), np.int64)
+        face_materials = np.zeros(0, np.int32)
+        face_groups = np.zeros(0, np.int32)
+    face_offsets = np.zeros(len(face_counts) + 1, np.int64)
+    np.cumsum(face_counts, out=face_offsets[1:])
+    return ObjMesh(
+        vertices,
+        uvs=uvs[:n_uvs],
+        normals=normals[:n_normals],
+        face_offsets=face_offsets,
+        face_vertices=np.ascontiguousarray(face_refs[:, 0]),
+        face_uvs=np.ascontiguousarray(face_refs[:, 1]),
+        face_normals=np.ascontiguousarray(face_refs[:, 2]),
+        face_materials=face_materials,
+        face_groups=face_groups,
+        materials=materials,
+        groups=groups,
+        mtllibs=mtllibs,
+    )
+
+
+def _classify_lines(buf, faces):
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    padded = np.append(buf, np.zeros(2, np.uint8))
+    b0 = padded[starts]
+    b1 = padded[starts + 1]
+    kind = np.full(len(starts), OTHER, np.int8)
+    is_v = b0 == ord('v')
+    kind[is_v & (b1 == ord(' '))] = VERTEX
+    if faces:
+        b2 = padded[starts + 2]
+        kind[is_v & (b1 == ord('t')) & (b2 == ord(' '))] = UV
+        kind[is_v & (b1 == ord('n')) & (b2 == ord(' '))] = NORMAL
+        kind[(b0 == ord('f')) & (b1 == ord(' '))] = FACE
+        kind[((b0 == ord('g')) | (b0 == ord('o'))) & ((b1 == ord(' ')) | (starts + 1 == ends))] = GROUP
+        b6 = padded[np.minimum(starts + 6, len(buf))]
+        kind[(b0 == ord('u')) & (b1 == ord('s')) & (b6 == ord(' '))] = USEMTL
+        kind[(b0 == ord('m')) & (b1 == ord('t')) & (b6 == ord(' '))] = MTLLIB
+    return kind, starts, ends
+
+
+def _line_text(chunk, start, end):
+    return chunk[start:end].decode('utf-8', 'replace').rstrip('\r')
+
+
+def _select(buf, starts, ends):
+    # Bytes of [start, end] for every record, each record keeps its trailing '\n'
+    marks = np.zeros(len(buf) + 1, np.int8)
+    marks[starts] += 1
+    marks[ends + 1] -= 1
+    return buf[np.cumsum(marks[:-1], dtype=np.int8) > 0].tobytes()
+
+
+def _parse_floats(chunk, buf, starts, ends, width):
+    n = len(starts)
+    if n == 0:
+        return np.zeros((0, width), np.float32)
+    text = _select(buf, starts, ends)
+    try:
+        values = np.fromstring(text, dtype=np.float32, sep=' ')
+    except ValueError:
+        values = np.zeros(0, np.float32)
+    if len(values) == n * width:
+        return values.reshape(n, width)
+    counts = _tokens_per_line(text, n)
+    if len(values) == counts.sum() and (counts == counts[0]).all() and counts[0] > width:
+        # Extra values on every line (vertex colors, w coordinates)
+        return values.reshape(n, -1)[:, :width]
+    # Uneven lines, parse them one by one
+    out = np.zeros((n, width), np.float32)
+    for i, (s, e) in enumerate(zip(starts, ends)):
+        words = chunk[s:e].split()[:width]
+        out[i, :len(words)] = [float(w) for w in words]
+    return out
+
+
+def _tokens_per_line(text, n_lines):
+    data = np.frombuffer(text, np.uint8)
+    space = (data == ord(' ')) | (data == ord('\n')) | (data == ord('\t')) | (data == ord('\r'))
+    token_start = ~space
+    token_start[1:] &= space[:-1]
+    line_of_byte = np.cumsum(data == ord('\n'), dtype=np.int64)
+    return np.bincount(line_of_byte[token_start], minlength=n_lines)
+
+
+def _parse_faces(chunk, buf, starts, ends):
+    '''
+    Returns the number of references in every face and an (R, 3) array of
+    1-based v/vt/vn references, 0 where a reference is missing
+    '''
+    text = _select(buf, starts, ends)
+    counts = _tokens_per_line(text, len(starts))
+    n_refs = int(counts.sum())
+
+    text = text.replace(b'//', b'/0/')
+    n_slashes = text.count(b'/')
+    refs = None
+    if n_slashes in (0, n_refs, 2 * n_refs) and _same_format(text, n_slashes // n_refs if n_refs else 0):
+        width = n_slashes // n_refs + 1 if n_refs else 1
+        try:
+            values = np.fromstring(text.replace(b'/', b' '), dtype=np.int64, sep=' ')
+        except ValueError:
+            values = np.zeros(0, np.int64)
+        if len(values) == n_refs * width:
+            refs = np.zeros((n_refs, 3), np.int64)
+            refs[:, :width] = values.reshape(n_refs, width)
+    if refs is None:
+        # Mixed reference formats, parse them one by one
+        refs = np.zeros((n_refs, 3), np.int64)
+        r = 0
+        for s, e in zip(starts, ends):
+            for word in chunk[s:e].split():
+                for j, value in enumerate(word.split(b'/')[:3]):
+                    if value:
+                        refs[r, j] = int(value)
+                r += 1
+    return counts, refs
+
+
+def _same_format(text, slashes):
+    # True if every reference token of text has the given number of slashes
+    if slashes == 0:
+        return True
+    data = np.frombuffer(text, np.uint8)
+    space = (data == ord(' ')) | (data == ord('\n')) | (data == ord('\t')) | (data == ord('\r'))
+    token_start = ~space
+    token_start[1:] &= space[:-1]
+    token_of_byte = np.cumsum(token_start) - 1
+    per_token = np.bincount(token_of_byte[data == ord('/')], minlength=int(token_start.sum()))
+    return bool((per_token == slashes).all())
+
+
+def _resolve_references(refs, counts, face_lines, kind, totals):
+    '''
+    Converts 1-based (or negative, relative) references to 0-based indices.
+    totals are the number of v, vt and vn records read up to the end of this chunk.
+    '''
+    out = refs - 1
+    negative = refs < 0
+    if negative.any():
+        # Relative references count back from the records read before their line
+        ref_lines = np.repeat(face_lines, counts)
+        for j, record_kind in enumerate((VERTEX, UV, NORMAL)):
+            if not negative[:, j].any():
+                continue
+            record_lines = np.flatnonzero(kind == record_kind)
+            before_chunk = totals[j] - len(record_lines)
+            before_line = before_chunk + np.searchsorted(record_lines, ref_lines)
+            out[:, j] = np.where(negative[:, j], before_line + refs[:, j], out[:, j])
+    return out
+
+
+def _runs(face_lines, marker_lines, marker_ids, current):
+    # Value of the last marker line before each face
+    if len(marker_lines) == 0:
+        return np.full(len(face_lines), current, np.int32)
+    which = np.searchsorted(marker_lines, face_lines, side='right') - 1
+    ids = np.asarray(marker_ids, np.int32)
+    return np.where(which >= 0, ids[np.maximum(which, 0)], current).astype(np.int32)
+
+
+def write_obj(obj_file, mesh, mtllib=None, object_name=None, write_groups=False):
+    '''
+    Writes an ObjMesh to an obj file
+
+    Faces keep their order and a usemtl line is written every time the
+    material changes. With write_groups an o line is written every time the
+    group changes, to keep several objects apart in one file.
+    '''
+    with open(obj_file, 'w', buffering=WRITE_BUFFER) as f:
+        f.write("# Blender-Annotation-Tool\n")
+        if mtllib is not None:
+            f.write("mtllib {}\n".format(mtllib))
+        if object_name is not None:
+            f.write("o {}\n".format(object_name))
+        _write_rows(f, 'v', mesh.vertices, '%.6f')
+        _write_rows(f, 'vt', mesh.uvs, '%.6f')
+        _write_rows(f, 'vn', mesh.normals, '%.4f')
+        _write_faces(f, mesh, write_groups)
+
+
+def read_mtl(mtl_file):
+    ''' Returns an ordered dict of material name -> list of the lines under its newmtl '''
+    materials = OrderedDict()
+    current = None
+    with open(mtl_file, 'r', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('newmtl'):
+                current = line[6:].strip()
+                materials[current] = []
+            elif current is not None and line and not line.startswith('#'):
+                materials[current].append(line)
+    return materials
+
+
+def write_mtl(mtl_file, materials):
+    with open(mtl_file, 'w') as f:
+        f.write("# Blender-Annotation-Tool\n")
+        f.write("# Material Count: {}\n".format(len(materials)))
+        for name, lines in materials.items():
+            f.write("\nnewmtl {}\n".format(name))
+            for line in lines:
+                f.write(line + "\n")
+
+
+def _write_rows(f, prefix, values, fmt):
+    if len(values) == 0:
+        return
+    width = values.shape[1]
+    line = prefix + (" " + fmt) * width + "\n"
+    for start in range(0, len(values), ROWS_PER_BLOCK):
+        block = values[start:start + ROWS_PER_BLOCK]
+        f.write((line * len(block)) % tuple(block.ravel().tolist()))
+
+
+# Reference formats, indexed by has_uv + 2 * has_normal
+REF_FORMATS = [" %d", " %d/%d", " %d//%d", " %d/%d/%d"]
+
+
+def _write_faces(f, mesh, write_groups=False):
+    n_faces = mesh.num_faces
+    if n_faces == 0:
+        return
+    counts = np.diff(mesh.face_offsets)
+    refs = len(mesh.face_vertices)
+    face_of_ref = np.repeat(np.arange(n_faces), counts)
+    uv_missing = np.bincount(face_of_ref, weights=mesh.face_uvs < 0, minlength=n_faces)
+    normal_missing = np.bincount(face_of_ref, weights=mesh.face_normals < 0, minlength=n_faces)
+    has_uv = uv_missing == 0
+    has_normal = normal_missing == 0
+    # Faces with only some of their uvs or normals are written one by one
+    mixed = ((uv_missing > 0) & (uv_missing < counts)) | ((normal_missing > 0) & (normal_missing < counts))
+    ref_format = np.where(mixed, -1, has_uv.astype(np.int64) + 2 * has_normal)
+
+    materials = mesh.face_materials if len(mesh.face_materials) == n_faces else np.full(n_faces, -1)
+    groups = mesh.face_groups if write_groups and len(mesh.face_groups) == n_faces else np.full(n_faces, -1)
+    key_change = np.ones(n_faces, bool)
+    key_change[1:] = ((counts[1:] != counts[:-1]) | (materials[1:] != materials[:-1]) |
+                      (ref_format[1:] != ref_format[:-1]) | (groups[1:] != groups[:-1]))
+    segment_starts = np.flatnonzero(key_change)
+    segment_ends = np.append(segment_starts[1:], n_faces)
+
+    # 1-based references, interleaved per corner
+    columns = np.stack([mesh.face_vertices, mesh.face_uvs, mesh.face_normals], 1) + 1 if refs else None
+    current_material = current_group = -1
+    for start, end in zip(segment_starts, segment_ends):
+        if groups[start] != current_group:
+            f.write("o {}\n".format(mesh.groups[groups[start]]))
+            current_group = groups[start]
+            # Every object starts with its own usemtl
+            current_material = -1
+        material = materials[start]
+        if material != current_material:
+            name = mesh.materials[material] if material >= 0 else "(null)"
+            f.write("usemtl {}\n".format(name))
+            current_material = material
+        ref_start = mesh.face_offsets[start]
+        ref_end = mesh.face_offsets[end]
+        if ref_format[start] == -1:
+            for i in range(start, end):
+                f.write(_face_line(columns[mesh.face_offsets[i]:mesh.face_offsets[i + 1]]))
+            continue
+        count = counts[start]
+        if count == 0:
+            continue
+        code = ref_format[start]
+        used = [0] + ([1] if code & 1 else []) + ([2] if code & 2 else [])
+        line = "f" + REF_FORMATS[code] * count + "\n"
+        faces_per_block = max(1, ROWS_PER_BLOCK // max(count, 1))
+        for block_start in range(ref_start, ref_end, faces_per_block * count):
+            block_end = min(block_start + faces_per_block * count, ref_end)
+            block = columns[block_start:block_end][:, used]
+            f.write((line * ((block_end - block_start) // count)) % tuple(block.ravel().tolist()))
+
+
+def _face_line(corners):
+    words = []
+    for v, vt, vn in corners.tolist():
+        if vt > 0 and vn > 0:
+            words.append("{}/{}/{}".format(v, vt, vn))
+        elif vt > 0:
+            words.append("{}/{}".format(v, vt))
+        elif vn > 0:
+            words.append("{}//{}".format(v, vn))
+        else:
+            words.append(str(v))
+    return "f " + " ".join(words) + "\n"
@@ -0,0 +1,228 @@
+'''
+All the exported parts of one model in a single binary file.
+
+A bundle holds the parts as one shared vertex, uv and normal buffer plus one
+buffer of each face array, every part owning a contiguous range of each with
+indices local to its ranges. So a part is a handful of slices, and read
+through np.memmap nothing is copied or parsed: loading a car costs opening
+one file and reading its header.
+
+Layout, all little-endian:
+
+    8 bytes    MAGIC
+    8 bytes    length of the json header
+    header     arrays (dtype, shape, offset), parts (name and ranges),
+               materials (name -> mtl lines) and metadata (columns)
+    arrays     each starting at a multiple of ALIGN from the start of the file
+
+Metadata columns (the hinge table of utils.model_metadata, usually) are
+stored as arrays, string columns go into the header.
+
+python mesh_tools/part_bundle.py model_parts.bundle prints what a bundle holds.
+'''
+
+import os
+import json
+import struct
+from collections import OrderedDict
+import numpy as np
+import obj_io
+
+MAGIC = b"PRTBNDL1"
+VERSION = 1
+ALIGN = 64
+BUNDLE_SUFFIX = "_parts.bundle"
+
+# Arrays shared by all parts, with their dtype and what their part ranges are named after
+BUFFERS = [
+    ('vertices', '<f4', 'vertices'),
+    ('uvs', '<f4', 'uvs'),
+    ('normals', '<f4', 'normals'),
+    ('face_offsets', '<i8', 'offsets'),
+    ('face_vertices', '<i8', 'refs'),
+    ('face_uvs', '<i8', 'refs'),
+    ('face_normals', '<i8', 'refs'),
+    ('face_materials', '<i4', 'faces'),
+]
+
+
+def write_bundle(bundle_file, part_meshes, materials=None, metadata=None):
+    '''
+    Writes a bundle
+
+    part_meshes is an ordered dict of part name -> obj_io.ObjMesh, materials
+    an ordered dict of material name -> mtl lines and metadata a dict of
+    columns. Material references of the parts are looked up by name, a
+    material the parts use that isn't in materials gets no lines.
+    '''
+    materials = OrderedDict(materials or {})
+    for mesh in part_meshes.values():
+        for name in mesh.materials:
+            materials.setdefault(name, [])
+    material_ids = {name: i for i, name in enumerate(materials)}
+
+    pieces = {name: [] for name, _, _ in BUFFERS}
+    parts = []
+    starts = {'vertices': 0, 'uvs': 0, 'normals': 0, 'offsets': 0, 'refs': 0, 'faces': 0}
+    for part_name, mesh in part_meshes.items():
+        lookup = np.array([material_ids[name] for name in mesh.materials] + [-1], np.int32)
+        values = {
+            'vertices': mesh.vertices,
+            'uvs': mesh.uvs,
+            'normals': mesh.normals,
+            'face_offsets': mesh.face_offsets - mesh.face_offsets[0],
+            'face_vertices': mesh.face_vertices,
+            'face_uvs': mesh.face_uvs,
+            'face_normals': mesh.face_normals,
+            'face_materials': lookup[mesh.face_materials],
+        }
+        part = {'name': part_name}
+        for name, dtype, kind in BUFFERS:
+            pieces[name].append(np.asarray(values[name], dtype))
+        for kind, length in [('vertices', len(mesh.vertices)), ('uvs', len(mesh.uvs)),
+                             ('normals', len(mesh.normals)), ('offsets', mesh.num_faces + 1),
+                             ('refs', len(mesh.face_vertices)), ('faces', mesh.num_faces)]:
+            part[kind] = [starts[kind], starts[kind] + length]
+            starts[kind] += length
+        parts.append(part)
+
+    arrays = OrderedDict()
+    for name, dtype, _ in BUFFERS:
+        width = {'vertices': 3, 'uvs': 2, 'normals': 3}.get(name)
+        empty = np.zeros((0, width) if width else 0, dtype)
+        arrays[name] = np.concatenate(pieces[name]) if pieces[name] else empty
+    strings = {}
+    for column, values in (metadata or {}).items():
+        values = np.asarray(values)
+        if values.dtype.kind in 'USO':
+            strings[column] = [str(v) for v in values]
+        else:
+            arrays['metadata/' + column] = values
+
+    header = {
+        'version': VERSION,
+        'arrays': OrderedDict(),
+        'parts': parts,
+        'materials': [[name, list(lines)] for name, lines in materials.items()],
+        'metadata': strings,
+    }
+    # Offsets depend on the header length, which depends on the offsets
+    data_start = 0
+    while True:
+        offset = data_start
+        for name, values in arrays.items():
+            header['arrays'][name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+            offset = _aligned(offset + values.nbytes)
+        encoded = json.dumps(header).encode('utf-8')
+        if _aligned(16 + len(encoded)) <= data_start:
+            break
+        data_start = _aligned(16 + len(encoded))
+
+    tmp = "{}.tmp{}".format(bundle_file, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(encoded)) + encoded)
+            for name, values in arrays.items():
+                f.write(b'\0' * (header['arrays'][name]['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(values).tobytes())
+        os.replace(tmp, bundle_file)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+
+def bundle_model(bundle_file, obj_files, metadata=None):
+    '''
+    Writes the bundle of the part files of one model, {model}_{part}.obj and
+    their mtl files, returns the parts it holds
+    '''
+    part_meshes = OrderedDict()
+    materials = OrderedDict()
+    for obj_file in sorted(obj_files):
+        part_name = part_of(obj_file)
+        part_meshes[part_name] = obj_io.read_obj(obj_file)
+        mtl_file = os.path.splitext(obj_file)[0] + ".mtl"
+        if os.path.isfile(mtl_file):
+            for name, lines in obj_io.read_mtl(mtl_file).items():
+                materials.setdefault(name, lines)
+    write_bundle(bundle_file, part_meshes, materials, metadata)
+    return list(part_meshes)
+
+
+def part_of(obj_file):
+    # {model}_{part}.obj, part names have underscores of their own
+    return os.path.splitext(os.path.basename(obj_file))[0].split("_", 1)[1]
+
+
+class PartBundle(object):
+    '''
+    Memory mapped bundle
+
+    bundle.parts lists the part names and bundle.part(name) returns a part
+    as an obj_io.ObjMesh of read-only views into the file.
+    '''
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        with open(bundle_file, 'rb') as f:
+            start = f.read(16)
+            if len(start) < 16 or start[:8] != MAGIC:
+                raise ValueError("{} is not a part bundle".format(bundle_file))
+            header = json.loads(f.read(struct.unpack('<Q', start[8:])[0]).decode('utf-8'))
+        if header['version'] != VERSION:
+            raise ValueError("{} is a version {} bundle, expected {}".format(bundle_file, header['version'], VERSION))
+        data = np.memmap(bundle_file, np.uint8, mode='r')
+        self.arrays = {}
+        for name, info in header['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            count = int(np.prod(info['shape'], dtype=np.int64))
+            values = data[info['offset']:info['offset'] + count * dtype.itemsize]
+            self.arrays[name] = values.view(dtype).reshape(info['shape'])
+        self._parts = OrderedDict((part['name'], part) for part in header['parts'])
+        self.materials = OrderedDict((name, lines) for name, lines in header['materials'])
+        self.metadata = {name[len('metadata/'):]: values for name, values in self.arrays.items()
+                         if name.startswith('metadata/')}
+        self.metadata.update({column: np.array(values, dtype=str) for column, values in header['metadata'].items()})
+
+    @property
+    def parts(self):
+        return list(self._parts)
+
+    def part(self, name):
+        ranges = self._parts[name]
+        views = {}
+        for array, _, kind in BUFFERS:
+            start, end = ranges[kind]
+            views[array] = self.arrays[array][start:end]
+        return obj_io.ObjMesh(
+            views['vertices'],
+            uvs=views['uvs'],
+            normals=views['normals'],
+            face_offsets=views['face_offsets'],
+            face_vertices=views['face_vertices'],
+            face_uvs=views['face_uvs'],
+            face_normals=views['face_normals'],
+            face_materials=views['face_materials'],
+            face_groups=np.zeros(len(views['face_materials']), np.int32),
+            materials=list(self.materials),
+        )
+
+    def __iter__(self):
+        for name in self._parts:
+            yield name, self.part(name)
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show what a part bundle holds.')
+    parser.add_argument('bundle', help='Bundle file')
+    args = parser.parse_args()
+    bundle = PartBundle(args.bundle)
+    for name, mesh in bundle:
+        print("{:<15}{:>10} vertices{:>10} faces".format(name, len(mesh.vertices), mesh.num_faces))
+    print("{} materials".format(len(bundle.materials)))
+    for column, values in sorted(bundle.metadata.items()):
+        print("{}: {}".format(column, values.tolist()))
@@ -0,0 +1,177 @@
+'''
+Blender-free version of automatic_annotation.save_out_parts.
+
+Splits an obj file into one obj/mtl pair per part, the same way selecting a
+vertex group and running bpy.ops.mesh.separate does: parts are taken in order,
+each one gets the remaining faces whose vertices are all in the part, and
+whatever is left over is written as car_body. Vertices, uvs and normals are
+reindexed per part and usemtl runs are kept.
+
+Parts that end up without faces are not written (remove_faceless_models would
+delete them afterwards anyway), and neither are loose vertices.
+'''
+
+import os
+from collections import OrderedDict
+import numpy as np
+import obj_io
+
+REMAINDER = "car_body"
+TEXTURE_KEYWORDS = ('map_', 'bump', 'disp', 'decal', 'refl')
+
+
+def padded_box(part_type, bbox_min, bbox_max):
+    '''
+    Returns copies of a cluster center's part box, grown so that the same part
+    of a slightly different car still falls inside it
+    '''
+    bbox_min = np.array(bbox_min, dtype=np.float64)
+    bbox_max = np.array(bbox_max, dtype=np.float64)
+    if "right" in part_type:
+        bbox_max += [1, .02, .01]
+        bbox_min -= [.02, .02, .01]
+    if "left" in part_type:
+        bbox_max += [.02, .02, .01]
+        bbox_min -= [1, .02, .01]
+    if "trunk" in part_type:
+        bbox_max += [0, 1, 1]
+        bbox_min -= [0, .02, .02]
+    return bbox_min, bbox_max
+
+
+def masks_from_boxes(vertices, part_boxes, grid=None):
+    '''
+    Returns an ordered dict of part -> boolean vertex mask for the padded part
+    boxes. With a spatial_index.GridIndex over the vertices only the vertices
+    near each box are tested.
+    '''
+    masks = OrderedDict()
+    for part_type, bbox_dict in part_boxes.items():
+        bbox_min, bbox_max = padded_box(part_type, bbox_dict['bbox_min'], bbox_dict['bbox_max'])
+        if grid is not None:
+            in_bounds = grid.box_mask(bbox_min, bbox_max)
+        else:
+            in_bounds = ((vertices <= bbox_max) & (vertices >= bbox_min)).all(axis=1)
+        if in_bounds.any():
+            masks[part_type] = in_bounds
+    return masks
+
+
+def masks_from_labels(labels, names):
+    '''
+    Returns an ordered dict of part -> boolean vertex mask from a per-vertex
+    label array (index into names, -1 for no part), e.g. from label_transfer
+    '''
+    masks = OrderedDict()
+    for label, part_type in enumerate(names):
+        in_part = labels == label
+        if in_part.any():
+            masks[part_type] = in_part
+    return masks
+
+
+def face_masks(mesh, part_masks):
+    '''
+    Assigns every face to at most one part
+
+    Returns an ordered dict of part -> boolean face mask, with the faces left
+    over at the end under REMAINDER.
+    '''
+    counts = np.diff(mesh.face_offsets)
+    face_of_ref = np.repeat(np.arange(mesh.num_faces), counts)
+    remaining = counts > 0
+    masks = OrderedDict()
+    for part_type, vertex_mask in part_masks.items():
+        outside = np.bincount(face_of_ref, weights=~vertex_mask[mesh.face_vertices], minlength=mesh.num_faces)
+        faces = remaining & (outside == 0)
+        if not faces.any():
+            continue
+        remaining &= ~faces
+        masks[part_type] = faces
+    masks[REMAINDER] = remaining
+    return masks
+
+
+def submesh(mesh, face_mask):
+    ''' Returns the ObjMesh made of the selected faces, with compact vertex, uv and normal indices '''
+    counts = np.diff(mesh.face_offsets)
+    ref_mask = np.repeat(face_mask, counts)
+    face_offsets = np.zeros(int(face_mask.sum()) + 1, np.int64)
+    np.cumsum(counts[face_mask], out=face_offsets[1:])
+    vertices, face_vertices = _compact(mesh.vertices, mesh.face_vertices[ref_mask])
+    uvs, face_uvs = _compact(mesh.uvs, mesh.face_uvs[ref_mask])
+    normals, face_normals = _compact(mesh.normals, mesh.face_normals[ref_mask])
+    return obj_io.ObjMesh(
+        vertices,
+        uvs=uvs,
+        normals=normals,
+        face_offsets=face_offsets,
+        face_vertices=face_vertices,
+        face_uvs=face_uvs,
+        face_normals=face_normals,
+        face_materials=mesh.face_materials[face_mask],
+        face_groups=mesh.face_groups[face_mask],
+        materials=mesh.materials,
+        groups=mesh.groups,
+    )
+
+
+def _compact(values, refs):
+    # Keep the referenced rows (in their original order), missing references stay -1
+    present = refs >= 0
+    used = np.unique(refs[present])
+    new_refs = np.full(len(refs), -1, np.int64)
+    new_refs[present] = np.searchsorted(used, refs[present])
+    return values[used], new_refs
+
+
+def split_obj(obj_file, part_masks, save_path, mesh=None):
+    '''
+    Writes {save_path}_{part}.obj/.mtl for every part with faces plus the rest
+    as {save_path}_car_body.obj, returns the list of obj files written
+
+    part_masks is an ordered dict of part -> boolean vertex mask. mesh can be
+    passed in when the obj file has already been read.
+    '''
+    if mesh is None:
+        mesh = obj_io.read_obj(obj_file)
+    source_materials = read_source_materials(obj_file, mesh)
+    written = []
+    for part_type, faces in face_masks(mesh, part_masks).items():
+        if not faces.any():
+            continue
+        print("Saving {} as an obj file".format(part_type))
+        part = submesh(mesh, faces)
+        file_name = save_path + "_{}.obj".format(part_type)
+        mtl_file = file_name[:-4] + ".mtl"
+        used = [mesh.materials[i] for i in np.unique(part.face_materials) if i >= 0]
+        obj_io.write_mtl(mtl_file, OrderedDict((name, source_materials.get(name, [])) for name in used))
+        obj_io.write_obj(file_name, part, mtllib=os.path.basename(mtl_file), object_name=part_type)
+        written.append(file_name)
+    return written
+
+
+def read_source_materials(obj_file, mesh):
+    '''
+    Reads the material libraries of an obj file, with texture paths made
+    absolute so the part files can live in any folder
+    '''
+    folder = os.path.dirname(os.path.abspath(obj_file))
+    materials = OrderedDict()
+    for mtllib in mesh.mtllibs:
+        mtl_file = os.path.join(folder, mtllib)
+        if not os.path.isfile(mtl_file):
+            print("No file at {}".format(mtl_file))
+            continue
+        mtl_folder = os.path.dirname(mtl_file)
+        for name, lines in obj_io.read_mtl(mtl_file).items():
+            materials[name] = [_absolute_texture_path(line, mtl_folder) for line in lines]
+    return materials
+
+
+def _absolute_texture_path(line, mtl_folder):
+    words = line.split()
+    if len(words) < 2 or not words[0].startswith(TEXTURE_KEYWORDS) or os.path.isabs(words[-1]):
+        return line
+    words[-1] = os.path.normpath(os.path.join(mtl_folder, words[-1]))
+    return " ".join(words)
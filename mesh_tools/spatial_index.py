@@ -0,0 +1,124 @@
+'''
+Uniform grid over the vertices of a mesh, for box and radius queries that
+only look at the vertices near the region instead of all of them.
+
+The bounding box of the vertices is cut into cells of about POINTS_PER_CELL
+vertices each and the vertex indices are sorted by cell, so every run of
+cells along z is one contiguous slice of that order. A box query gathers
+the slices of the cells it overlaps and tests only those vertices exactly,
+so results are the same as a full scan (bounds inclusive).
+
+The grid is three small arrays and is kept next to the parsed arrays in the
+geometry cache (see geometry_cache.load_grid), so it is built once per model.
+'''
+
+import os
+import numpy as np
+
+POINTS_PER_CELL = 32
+FILES = ['grid_order.npy', 'grid_starts.npy', 'grid_params.npy']
+
+
+class GridIndex(object):
+    '''
+    Grid over an (N, 3) vertex array
+
+    order lists the vertex indices sorted by cell, the vertices of cell c are
+    order[starts[c]:starts[c + 1]]. Cell (i, j, k) is c = (i * dims[1] + j) *
+    dims[2] + k and covers low + (i, j, k) * cell_size up to the next cell.
+    '''
+    def __init__(self, vertices, order, starts, low, cell_size, dims):
+        self.vertices = vertices
+        self.order = order
+        self.starts = starts
+        self.low = np.asarray(low, np.float64)
+        self.cell_size = np.asarray(cell_size, np.float64)
+        self.dims = np.asarray(dims, np.int64)
+
+    @classmethod
+    def build(cls, vertices, points_per_cell=POINTS_PER_CELL):
+        vertices = np.asarray(vertices)
+        if len(vertices) == 0:
+            return cls(vertices, np.zeros(0, np.int32), np.zeros(2, np.int64), np.zeros(3), np.ones(3), np.ones(3))
+        low = vertices.min(axis=0).astype(np.float64)
+        extent = np.maximum(vertices.max(axis=0) - low, 1e-9)
+        # Cubic cells, as many as it takes to hold about points_per_cell vertices each. Flat axes (a planar
+        # part, say) get a single cell and the cell size comes from the others, or the cell count explodes.
+        n_cells = max(len(vertices) / float(points_per_cell), 1.)
+        spread = extent > extent.max() * 1e-6
+        side = (np.prod(extent[spread]) / n_cells) ** (1. / spread.sum())
+        dims = np.where(spread, np.clip(np.ceil(extent / side), 1, None), 1).astype(np.int64)
+        cell_size = extent / dims
+        index = cls(vertices, None, None, low, cell_size, dims)
+        cells = index._cell_ids(vertices)
+        index.order = np.argsort(cells, kind='stable').astype(np.int32)
+        index.starts = np.zeros(int(np.prod(dims)) + 1, np.int64)
+        np.cumsum(np.bincount(cells, minlength=int(np.prod(dims))), out=index.starts[1:])
+        return index
+
+    @classmethod
+    def load(cls, folder, vertices):
+        ''' Reads a grid saved with save(), memory mapped '''
+        order, starts, params = [np.load(os.path.join(folder, f), mmap_mode='r') for f in FILES]
+        return cls(vertices, order, starts, params[0], params[1], params[2].astype(np.int64))
+
+    def save(self, folder):
+        params = np.stack([self.low, self.cell_size, self.dims.astype(np.float64)])
+        for file_name, values in zip(FILES, [self.order, self.starts, params]):
+            tmp = os.path.join(folder, '.tmp{}_{}'.format(os.getpid(), file_name))
+            np.save(tmp, np.ascontiguousarray(values))
+            os.replace(tmp, os.path.join(folder, file_name))
+
+    def box(self, bbox_min, bbox_max):
+        ''' Sorted indices of the vertices inside the box, bounds included '''
+        bbox_min = np.asarray(bbox_min, np.float64)
+        bbox_max = np.asarray(bbox_max, np.float64)
+        if len(self.vertices) == 0 or (bbox_min > bbox_max).any():
+            return np.zeros(0, np.int64)
+        first = self._cells(bbox_min)
+        last = self._cells(bbox_max)
+        i, j = np.meshgrid(np.arange(first[0], last[0] + 1), np.arange(first[1], last[1] + 1), indexing='ij')
+        rows = (i.ravel() * self.dims[1] + j.ravel()) * self.dims[2]
+        candidates = self.order[_ranges(self.starts[rows + first[2]], self.starts[rows + last[2] + 1])]
+        points = self.vertices[candidates]
+        inside = ((points >= bbox_min) & (points <= bbox_max)).all(axis=1)
+        return np.sort(candidates[inside]).astype(np.int64)
+
+    def boxes(self, bbox_mins, bbox_maxs):
+        ''' box() for every row of bbox_mins and bbox_maxs, a list of index arrays '''
+        return [self.box(low, high) for low, high in zip(bbox_mins, bbox_maxs)]
+
+    def radius(self, points, radius):
+        ''' Sorted indices of the vertices within radius of each point, a list of index arrays '''
+        found = []
+        for point in np.asarray(points, np.float64).reshape(-1, 3):
+            candidates = self.box(point - radius, point + radius)
+            distances = np.linalg.norm(self.vertices[candidates] - point, axis=1)
+            found.append(candidates[distances <= radius])
+        return found
+
+    def box_mask(self, bbox_min, bbox_max):
+        ''' Boolean vertex mask of box() '''
+        mask = np.zeros(len(self.vertices), bool)
+        mask[self.box(bbox_min, bbox_max)] = True
+        return mask
+
+    def _cells(self, points):
+        # Cell coordinates of points, clipped to the grid
+        cells = np.floor((np.asarray(points, np.float64) - self.low) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.dims - 1)
+
+    def _cell_ids(self, points):
+        cells = self._cells(points)
+        return (cells[:, 0] * self.dims[1] + cells[:, 1]) * self.dims[2] + cells[:, 2]
+
+
+def _ranges(starts, ends):
+    # Concatenation of arange(start, end) for every pair
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, np.int64)
+    skipped = np.zeros(len(lengths), np.int64)
+    np.cumsum(lengths[:-1], out=skipped[1:])
+    return np.repeat(starts - skipped, lengths) + np.arange(total)
@@ -0,0 +1,61 @@
+'''
+Finding the same vertices again after a mesh has been exported and re-imported.
+
+annotate.py remembers the (x, y, z, nx, ny, nz) rows of the annotated vertices,
+saves the object annotated parts out, re-imports the rest and has to find the
+annotated vertices in it. The positions only survive the round trip up to the
+precision of the obj file and the normals are recomputed, so rows are matched
+with a tolerance: positions are hashed into a grid with cells the size of the
+position tolerance and each vertex is compared against the rows in the 27
+cells around it. That is near linear in the number of vertices.
+'''
+
+import itertools
+import numpy as np
+
+POSITION_TOLERANCE = 1e-5
+NORMAL_TOLERANCE = 1e-3
+
+
+def rows_in(target, source, position_tolerance=POSITION_TOLERANCE, normal_tolerance=NORMAL_TOLERANCE):
+    '''
+    Boolean mask over the rows of target (N, 3) or (N, 6) that have a row in
+    source within the tolerances on every position / normal column
+    '''
+    target = np.asarray(target, np.float64)
+    source = np.asarray(source, np.float64)
+    found = np.zeros(len(target), bool)
+    if len(target) == 0 or len(source) == 0:
+        return found
+    tolerance = np.full(target.shape[1], normal_tolerance)
+    tolerance[:3] = position_tolerance
+
+    source_cells = np.floor(source[:, :3] / position_tolerance).astype(np.int64)
+    target_cells = np.floor(target[:, :3] / position_tolerance).astype(np.int64)
+    low = np.minimum(source_cells.min(0), target_cells.min(0)) - 1
+    dims = np.maximum(source_cells.max(0), target_cells.max(0)) - low + 2
+    if np.prod(dims.astype(np.float64)) >= 2 ** 62:
+        raise ValueError("Position tolerance {} is too small for this mesh".format(position_tolerance))
+
+    # Sort the target rows by cell and look the (usually far fewer) source rows up in it
+    target_keys = _cell_keys(target_cells - low, dims)
+    order = np.argsort(target_keys, kind='stable')
+    sorted_keys = target_keys[order]
+    source_order = np.argsort(_cell_keys(source_cells - low, dims), kind='stable')
+    source = source[source_order]
+    source_cells = source_cells[source_order]
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        keys = _cell_keys(source_cells - low + offset, dims)
+        first = np.searchsorted(sorted_keys, keys, side='left')
+        count = np.searchsorted(sorted_keys, keys, side='right') - first
+        # A cell holds a handful of rows at most (split vertices along uv seams)
+        for k in range(int(count.max())):
+            candidates = np.flatnonzero(count > k)
+            rows = order[first[candidates] + k]
+            close = (np.abs(source[candidates] - target[rows]) <= tolerance).all(axis=1)
+            found[rows[close]] = True
+    return found
+
+
+def _cell_keys(cells, dims):
+    return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
@@ -0,0 +1,103 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "annotation_tools")
+sys.path.append(STORE_DIR)
+import annotation_store
+
+
+@pytest.fixture
+def vertex_csv(tmpdir):
+    return str(tmpdir.join("abc123.csv"))
+
+
+@pytest.fixture
+def object_csv(tmpdir):
+    return str(tmpdir.join("abc123_objects.csv"))
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def test_reopen_replays_the_log(vertex_csv, object_csv):
+    store = annotation_store.AnnotationStore(vertex_csv)
+    store.add("trunk", [7, 3, 5])
+    store.add("door", [1, 2])
+    store.remove("trunk", [5, 100])
+    objects = annotation_store.AnnotationStore(object_csv)
+    objects.add("trunk", ["lid", "handle"])
+    objects.remove("trunk", ["handle"])
+    assert not os.path.isfile(vertex_csv)
+    assert annotation_store.exists(vertex_csv)
+
+    reopened = annotation_store.AnnotationStore(vertex_csv)
+    assert reopened.get("trunk").tolist() == [3, 7]
+    assert reopened.get("door").tolist() == [1, 2]
+    assert reopened.part_types() == ["door", "trunk"]
+    assert annotation_store.AnnotationStore(object_csv).get("trunk") == ["lid"]
+
+
+def test_compact_writes_the_csv_and_drops_the_log(vertex_csv):
+    store = annotation_store.AnnotationStore(vertex_csv)
+    store.add("trunk", [4, 2])
+    store.add("door", [9])
+    store.remove("door", [9])
+    store.add("door", [8])
+    store.compact(wait=True)
+    assert not os.path.isfile(annotation_store.log_path(vertex_csv))
+    assert not os.path.isfile(annotation_store.log_path(vertex_csv) + ".compacting")
+
+    from_csv = annotation_store.AnnotationStore(vertex_csv)
+    for part_type in ["trunk", "door"]:
+        assert np.array_equal(from_csv.get(part_type), store.get(part_type))
+    assert read(vertex_csv) == "part_type,vert_index\ndoor,8\ntrunk,2\ntrunk,4\n"
+
+
+def test_leftover_compacting_log_is_folded_back_in(vertex_csv):
+    store = annotation_store.AnnotationStore(vertex_csv)
+    store.add("trunk", [1, 2])
+    store.compact(wait=True)
+    store.add("trunk", [3])
+    # Crash after the log was rotated, before the snapshot got written
+    store._rotate_log()
+    store.add("door", [5])
+    compacting = annotation_store.log_path(vertex_csv) + ".compacting"
+    assert os.path.isfile(compacting)
+    assert read(vertex_csv) == "part_type,vert_index\ntrunk,1\ntrunk,2\n"
+
+    reopened = annotation_store.AnnotationStore(vertex_csv)
+    assert reopened.get("trunk").tolist() == [1, 2, 3]
+    assert reopened.get("door").tolist() == [5]
+    reopened.compact(wait=True)
+    assert not os.path.isfile(compacting)
+    assert not os.path.isfile(annotation_store.log_path(vertex_csv))
+    assert read(vertex_csv) == "part_type,vert_index\ndoor,5\ntrunk,1\ntrunk,2\ntrunk,3\n"
+
+
+def test_to_csv_writes_the_baseline_format(vertex_csv, object_csv, tmpdir):
+    store = annotation_store.AnnotationStore(vertex_csv)
+    store.add("trunk", [10, 2])
+    store.add("back_left", [7])
+    store.to_csv(str(tmpdir.join("vertices.csv")))
+    assert read(str(tmpdir.join("vertices.csv"))) == "part_type,vert_index\nback_left,7\ntrunk,2\ntrunk,10\n"
+
+    objects = annotation_store.AnnotationStore(object_csv)
+    objects.add("trunk", ["lid", "Mesh, 2"])
+    objects.add("door", ["handle"])
+    objects.to_csv(str(tmpdir.join("objects.csv")))
+    assert read(str(tmpdir.join("objects.csv"))) == \
+        'part_type,object_name\ndoor,handle\ntrunk,"Mesh, 2"\ntrunk,lid\n'
+
+
+def test_main_folds_leftover_logs_into_the_csv(vertex_csv, object_csv):
+    annotation_store.AnnotationStore(vertex_csv).add("trunk", [6, 1])
+    annotation_store.AnnotationStore(object_csv).add("trunk", ["lid"])
+    subprocess.check_call([sys.executable, os.path.join(STORE_DIR, "annotation_store.py"), vertex_csv, object_csv])
+    assert read(vertex_csv) == "part_type,vert_index\ntrunk,1\ntrunk,6\n"
+    assert read(object_csv) == "part_type,object_name\ntrunk,lid\n"
+    for path in [vertex_csv, object_csv]:
+        assert not os.path.isfile(annotation_store.log_path(path))
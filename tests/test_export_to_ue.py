@@ -0,0 +1,125 @@
+import os
+import sys
+import types
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "export_tools"))
+import export_to_ue
+
+
+class Properties(object):
+    def __init__(self, *args):
+        self.properties = {}
+
+    def set_editor_property(self, name, value):
+        self.properties[name] = value
+
+    def get_editor_property(self, name):
+        return self.properties.get(name)
+
+
+class FbxImportUI(Properties):
+    def __init__(self):
+        Properties.__init__(self)
+        self.static_mesh_import_data = Properties()
+
+
+class SlowTask(object):
+    def __init__(self, total, text):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def make_dialog(self, cancelable):
+        pass
+
+    def should_cancel(self):
+        return False
+
+    def enter_progress_frame(self, work, text):
+        pass
+
+
+@pytest.fixture
+def unreal(monkeypatch):
+    ''' Stub of the editor module: a set of asset paths, the import batches and the number of saves '''
+    stub = types.ModuleType("unreal")
+    stub.assets = set()
+    stub.batches = []
+    stub.saves = [0]
+
+    def import_asset_tasks(tasks):
+        stub.batches.append([os.path.basename(t.get_editor_property('filename')) for t in tasks])
+        for task in tasks:
+            name = os.path.splitext(os.path.basename(task.get_editor_property('filename')))[0]
+            path = "{}/{}".format(task.get_editor_property('destination_path'), name)
+            stub.assets.add(path)
+            task.set_editor_property('imported_object_paths', [path])
+
+    def save_dirty_packages(save_map_packages, save_content_packages):
+        stub.saves[0] += 1
+
+    stub.EditorAssetLibrary = types.SimpleNamespace(
+        does_asset_exist=lambda path: path in stub.assets,
+        delete_asset=lambda path: stub.assets.discard(path),
+        delete_directory=lambda directory_path: stub.assets.clear())
+    stub.AssetToolsHelpers = types.SimpleNamespace(
+        get_asset_tools=lambda: types.SimpleNamespace(import_asset_tasks=import_asset_tasks))
+    stub.EditorLoadingAndSavingUtils = types.SimpleNamespace(save_dirty_packages=save_dirty_packages)
+    stub.ScopedSlowTask = SlowTask
+    stub.AssetImportTask = Properties
+    stub.FbxImportUI = FbxImportUI
+    stub.Vector = stub.Rotator = lambda *args: args
+    monkeypatch.setitem(sys.modules, "unreal", stub)
+    return stub
+
+
+@pytest.fixture
+def folder(tmpdir):
+    folder = tmpdir.mkdir("car_models_hand_annotated")
+    for i in range(5):
+        folder.join("m{}_trunk.obj".format(i)).write("mtllib m{}_trunk.mtl\nv 0 0 0\n".format(i))
+        folder.join("m{}_trunk.mtl".format(i)).write("newmtl red\nmap_Kd textures/m{}.png\n".format(i))
+    folder.mkdir("textures")
+    for i in range(5):
+        folder.join("textures", "m{}.png".format(i)).write("png {}".format(i))
+    return str(folder)
+
+
+def test_imports_in_batches(unreal, folder):
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    assert [len(b) for b in unreal.batches] == [2, 2, 1]
+    assert unreal.saves[0] == 3
+    assert len(unreal.assets) == 5
+
+
+def test_skips_unchanged_and_reimports_changed_texture(unreal, folder):
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    unreal.batches[:] = []
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    assert unreal.batches == []
+
+    with open(os.path.join(folder, "textures", "m3.png"), 'w') as f:
+        f.write("new texture")
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    assert unreal.batches == [["m3_trunk.obj"]]
+
+
+def test_reimports_missing_asset_and_removes_stale_ones(unreal, folder):
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    unreal.batches[:] = []
+    unreal.assets.discard("/Game/Test/m1_trunk")
+    os.remove(os.path.join(folder, "m4_trunk.obj"))
+    export_to_ue.main(folder, "/Game/Test", batch_size=2)
+    assert unreal.batches == [["m1_trunk.obj"]]
+    assert "/Game/Test/m4_trunk" not in unreal.assets
+
+
+def test_full_deletes_and_imports_everything(unreal, folder):
+    export_to_ue.main(folder, "/Game/Test", batch_size=10)
+    unreal.batches[:] = []
+    export_to_ue.main(folder, "/Game/Test", batch_size=10, full=True)
+    assert [len(b) for b in unreal.batches] == [5]
@@ -0,0 +1,28 @@
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mesh_tools"))
+import obj_io
+
+VERTICES = "v 0 0 0\nv 1 0 0\nv 0 1 0\nvt 0 0\nvt 1 0\nvn 0 0 1\n"
+
+
+def read(tmpdir, text):
+    obj_file = str(tmpdir.join("mesh.obj"))
+    with open(obj_file, 'w') as f:
+        f.write(text)
+    return obj_io.read_obj(obj_file)
+
+
+def test_mixed_full_and_relative_references(tmpdir):
+    mesh = read(tmpdir, VERTICES + "f 1/1/1 2/2/1 3/1/1\nf -3 -2 -1\n")
+    assert mesh.face_vertices.tolist() == [0, 1, 2, 0, 1, 2]
+    assert mesh.face_uvs.tolist() == [0, 1, 0, -1, -1, -1]
+    assert mesh.face_normals.tolist() == [0, 0, 0, -1, -1, -1]
+
+
+def test_mixed_normal_only_and_plain_references(tmpdir):
+    mesh = read(tmpdir, VERTICES + "f 1//1 2//1 3//1\nf 1 2 3\n")
+    assert mesh.face_vertices.tolist() == [0, 1, 2, 0, 1, 2]
+    assert mesh.face_normals.tolist() == [0, 0, 0, -1, -1, -1]
+    assert np.array_equal(mesh.face_offsets, [0, 3, 6])